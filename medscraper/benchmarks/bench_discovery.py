@@ -0,0 +1,90 @@
+# Micro-benchmark for reading sitemaps
+#
+# Reads a large synthetic sitemap (plain and gzipped, gunzipped up front the same as the spider does) with iter_sitemap, which drops each
+# entry once it's read, against parsing the whole document into a tree and walking it, and reports the time each takes and how far each grows the peak RSS of a fresh process (most of
+# the memory is libxml2's, which tracemalloc doesn't see)
+#
+# Usage (from the project directory containing scrapy.cfg):
+#   python benchmarks/bench_discovery.py [--urls 50000] [--repeat 3]
+import os
+import sys
+import gzip
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from lxml import etree
+from scrapy.utils.gz import gunzip
+from medscraper.discovery import iter_sitemap
+
+SITE = "https://ahca.myflorida.com/medicaid/rules"
+NS = "{http://www.sitemaps.org/schemas/sitemap/0.9}"
+
+def synthetic_sitemap(count):
+    entries = "".join(f"<url><loc>{SITE}/page-{i}</loc><lastmod>2025-01-{i % 28 + 1:02d}</lastmod></url>" for i in range(count))
+    return f'<?xml version="1.0" encoding="UTF-8"?><urlset xmlns="{NS[1:-1]}">{entries}</urlset>'.encode()
+
+# The sitemap read the simple way, parsed into a whole tree first
+def tree_sitemap(body):
+    if body[:2] == b"\x1f\x8b":
+        body = gzip.decompress(body)
+    root = etree.fromstring(body)
+    for url in root.iter(f"{NS}url"):
+        yield "url", url.findtext(f"{NS}loc"), url.findtext(f"{NS}lastmod")
+
+# The sitemap read the way the spider reads it, gunzipped and then streamed
+def streamed_sitemap(body):
+    if body[:2] == b"\x1f\x8b":
+        body = gunzip(body)
+    return iter_sitemap(body)
+
+READERS = {"tree": tree_sitemap, "streamed": streamed_sitemap}
+
+# Run in a fresh process for each reader and sitemap, so the peak RSS of one doesn't hide another's: reads every entry once to measure
+# how far the peak RSS grows past the sitemap's own bytes, then reports the best time over repeat passes
+def worker(reader, compressed, urls, repeat):
+    body = synthetic_sitemap(urls)
+    if compressed:
+        body = gzip.compress(body)
+    read = READERS[reader]
+    # ru_maxrss is in KB on Linux
+    before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    count = sum(1 for _ in read(body))
+    grown = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before) / 1024
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        sum(1 for _ in read(body))
+        best = min(best, time.perf_counter() - start)
+    print(json.dumps({"entries": count, "elapsed_s": best, "rss_growth_mb": grown}))
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark reading sitemaps")
+    parser.add_argument("--urls", type=int, default=50000, help="Number of urls in the sitemap")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed passes")
+    parser.add_argument("--worker", nargs=2, metavar=("READER", "COMPRESSED"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        worker(args.worker[0], args.worker[1] == "1", args.urls, args.repeat)
+        return
+
+    body = synthetic_sitemap(min(args.urls, 1000))
+    assert list(streamed_sitemap(body)) == list(tree_sitemap(body)) == list(streamed_sitemap(gzip.compress(body)))
+
+    print(f"{'sitemap':<12}{'reader':<10}{'entries':>10}{'elapsed_s':>12}{'rss_growth_mb':>15}")
+    for label, compressed in (("plain", "0"), ("gzipped", "1")):
+        for reader in READERS:
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--urls", str(args.urls), "--repeat", str(args.repeat), "--worker", reader, compressed],
+                check=True, capture_output=True, text=True
+            ).stdout
+            result = json.loads(output)
+            print(f"{label:<12}{reader:<10}{result['entries']:>10}{result['elapsed_s']:>12.3f}{result['rss_growth_mb']:>15.1f}")
+
+if __name__ == "__main__":
+    main()
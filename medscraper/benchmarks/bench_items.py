@@ -0,0 +1,111 @@
+# Micro-benchmark for building packages and their metadata records
+#
+# Runs the original ItemLoader-filled scrapy Item (a processor chain per field, and a freshly formatted timestamp for every package)
+# against the slotted dataclass built by load_package, for pages with and without document links, and reports the time and memory each
+# package takes. Also times turning a package into its metadata record, the original deep-copied pandas Series against the plain dict
+# the pipeline now builds
+#
+# Usage (from the project directory containing scrapy.cfg):
+#   python benchmarks/bench_items.py [--packages N] [--links N] [--repeat N]
+import os
+import sys
+import copy
+import argparse
+import timeit
+import tracemalloc
+from datetime import datetime
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+import pandas as pd
+from itemadapter import ItemAdapter
+from scrapy.item import Item, Field
+from scrapy.loader import ItemLoader
+from itemloaders.processors import TakeFirst
+from medscraper.items import load_package
+
+SITE_PATH = "https://ahca.myflorida.com/medicaid/rules/index"
+
+# The package item as it was originally defined
+class OriginalPackage(Item):
+    file_urls = Field()
+    files = Field()
+    package_retrieval_date = Field(output_processor=TakeFirst())
+    package_last_checked = Field(output_processor=TakeFirst())
+    package_site_path = Field(output_processor=TakeFirst())
+    package_file_count = Field(output_processor=TakeFirst())
+    package_state = Field(output_processor=TakeFirst())
+    package_changes = Field(output_processor=TakeFirst())
+    package_depth = Field(output_processor=TakeFirst())
+
+# The package as the spider originally built it
+def load_package_original(site_path, state, file_urls, depth=0):
+    loader = ItemLoader(item=OriginalPackage())
+    loader.add_value("package_state", state)
+    loader.add_value("file_urls", file_urls)
+    loader.add_value("package_file_count", len(file_urls))
+    timestamp = datetime.now().strftime("%m/%d/%Y %I:%M:%S %p")
+    loader.add_value("package_retrieval_date", timestamp)
+    loader.add_value("package_last_checked", timestamp)
+    loader.add_value("package_site_path", site_path)
+    loader.add_value("package_depth", depth)
+    return loader.load_item()
+
+# The metadata record as the pipeline originally built it
+def record_original(item):
+    return pd.Series(copy.deepcopy({k: v for k, v in dict(item).items() if k not in ("package_depth", "files")}))
+
+# The metadata record as the pipeline builds it now
+def record_compact(item):
+    record = {k: copy.copy(v) for k, v in ItemAdapter(item).items() if k not in ("package_depth", "files")}
+    if record.get("package_changes") is None:
+        record.pop("package_changes", None)
+    return record
+
+# Helper function, the best time over repeat passes of building count packages, in microseconds per package
+def time_packages(build, file_urls, count, repeat):
+    elapsed = min(timeit.repeat(lambda: [build(SITE_PATH, "Florida", file_urls, 2) for _ in range(count)], number=1, repeat=repeat))
+    return elapsed / count * 1e6
+
+# Helper function, the memory held by count live packages, in bytes per package
+def memory_packages(build, file_urls, count):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    packages = [build(SITE_PATH, "Florida", file_urls, 2) for _ in range(count)]
+    held = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    del packages
+    return held / count
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark building packages and their metadata records")
+    parser.add_argument("--packages", type=int, default=20000, help="Number of packages built per timed pass")
+    parser.add_argument("--links", type=int, default=5, help="Number of document links on a page that has any")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed passes")
+    args = parser.parse_args()
+
+    file_urls = [f"{SITE_PATH.rsplit('/', 1)[0]}/manuals/provider_manual_{i}.pdf" for i in range(args.links)]
+    original = load_package_original(SITE_PATH, "Florida", file_urls, 2)
+    compact = load_package(SITE_PATH, "Florida", file_urls, 2)
+    # Both carry the same fields and values, apart from the timestamps possibly falling in different seconds
+    ignored = ("package_retrieval_date", "package_last_checked", "files", "package_changes")
+    assert {k: v for k, v in dict(original).items() if k not in ignored} == {k: v for k, v in ItemAdapter(compact).items() if k not in ignored}
+    assert dict(record_original(original)).keys() - {"package_changes"} == record_compact(compact).keys()
+
+    print(f"{'':<26}{'original':>12}{'compact':>12}{'speedup':>10}")
+    for label, urls in (("empty page (us/package)", []), (f"{args.links} documents (us/package)", file_urls)):
+        before = time_packages(load_package_original, urls, args.packages, args.repeat)
+        after = time_packages(load_package, urls, args.packages, args.repeat)
+        print(f"{label:<26}{before:>12.2f}{after:>12.2f}{before / after:>9.2f}x")
+
+    before = memory_packages(load_package_original, file_urls, args.packages)
+    after = memory_packages(load_package, file_urls, args.packages)
+    print(f"{'memory (bytes/package)':<26}{before:>12.0f}{after:>12.0f}{before / after:>9.2f}x")
+
+    count = args.packages // 10
+    before = min(timeit.repeat(lambda: [record_original(original) for _ in range(count)], number=1, repeat=args.repeat)) / count * 1e6
+    after = min(timeit.repeat(lambda: [record_compact(compact) for _ in range(count)], number=1, repeat=args.repeat)) / count * 1e6
+    print(f"{'metadata record (us)':<26}{before:>12.2f}{after:>12.2f}{before / after:>9.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,295 @@
+# End-to-end benchmark for the crawl: ManualSpider and MedscraperPipeline against local stand-ins for the state sites and the s3 bucket
+#
+# The state sites are served from fixtures on loopback addresses (see fixture_sites.py): recorded copies of the sites if a folder of them
+# is given, otherwise a synthetic corpus of the given size. The s3 bucket is a moto server started in this process, or any other
+# S3-compatible endpoint. Each corpus size is crawled in a fresh scrapy process, first into an empty bucket (cold), then again with
+# nothing changed (warm), reporting pages/s, documents/s, MB/s downloaded, s3 calls per document, peak RSS and the time spent merging
+# records into the master table in insert_or_update. With --check, any metric worse than the stored baseline by more than the tolerance
+# fails the run; --save-baseline stores this run's results as the new baseline
+#
+# Usage (from the project directory containing scrapy.cfg):
+#   python benchmarks/bench_pipeline.py [--sizes small,medium,large] [--fixtures recorded_sites/] [--latency 50]
+#       [--s3-endpoint http://localhost:9000] [--set NAME=VALUE ...] [--check | --save-baseline] [--tolerance 0.25] [--keep]
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from fixture_sites import FixtureSites
+
+# Documents per state site in the synthetic corpus for each size
+CORPUS_SIZES = {"small": 10, "medium": 50, "large": 200}
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "bench_pipeline.json")
+BUCKET = "medscraper-bench"
+
+# Metrics compared against the baseline: whether higher values are better, and how far off a metric may be on top of the tolerance
+# before it counts as a regression, so near-zero values (e.g. MB/s on a warm pass) don't fail on noise
+METRICS = {
+    "pages_per_s": (True, 0.5),
+    "docs_per_s": (True, 1.0),
+    "mb_per_s": (True, 0.1),
+    "s3_calls_per_doc": (False, 0.05),
+    "peak_rss_mb": (False, 10.0),
+    "insert_or_update_s": (False, 0.05)
+}
+
+# Helper function, finding a free port on the loopback interface for the s3 stand-in
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+# Run every corpus size in a scrapy process of its own (the Twisted reactor can't be restarted), returning each one's metrics by pass
+def run_benchmarks(args):
+    workdir = tempfile.mkdtemp(prefix="medscraper-bench-")
+    endpoint = args.s3_endpoint
+    moto_server = None
+    if endpoint is None:
+        from moto.server import ThreadedMotoServer
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        port = free_port()
+        moto_server = ThreadedMotoServer(ip_address="127.0.0.1", port=port, verbose=False)
+        moto_server.start()
+        endpoint = f"http://127.0.0.1:{port}"
+
+    results = {}
+    try:
+        for size in args.sizes:
+            size_dir = os.path.join(workdir, size)
+            sites = FixtureSites(os.path.join(size_dir, "sites"), latency=args.latency / 1000).start()
+            try:
+                if args.fixtures:
+                    sites.copy_recorded(args.fixtures)
+                else:
+                    sites.generate(CORPUS_SIZES[size])
+                results[size] = run_worker(size, size_dir, sites, endpoint, args)
+            finally:
+                sites.stop()
+    finally:
+        if moto_server is not None:
+            moto_server.stop()
+        if args.keep:
+            print(f"Kept the corpora, crawl logs and doc-data in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+# Helper function, crawling one corpus in a separate process, run from a scratch folder so it never reads the project's .env or doc-data
+def run_worker(size, size_dir, sites, endpoint, args):
+    config = {
+        "sites": sites.sites,
+        "bucket": f"{BUCKET}-{size}",
+        "endpoint": endpoint,
+        "workdir": size_dir,
+        "passes": args.passes,
+        "settings": dict(setting.split("=", 1) for setting in args.set)
+    }
+    config_path = os.path.join(size_dir, "config.json")
+    results_path = os.path.join(size_dir, "results.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f)
+    open(os.path.join(size_dir, ".env"), "w").close()
+
+    env = {**os.environ, "AWS_ACCESS_KEY_ID": "bench", "AWS_SECRET_ACCESS_KEY": "bench", "AWS_DEFAULT_REGION": "us-east-1",
+           "AWS_ENDPOINT_URL": endpoint, "SCRAPY_SETTINGS_MODULE": "medscraper.settings"}
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", config_path, results_path], cwd=size_dir, env=env, check=True)
+    with open(results_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+# Runs in the worker process; crawls the stand-in sites once per pass and writes each pass's metrics to the results file
+def worker(config_path, results_path):
+    import boto3
+    from scrapy.crawler import CrawlerProcess
+    from scrapy.utils.project import get_project_settings
+    from scrapy.utils.reactor import install_reactor
+
+    # Install the configured reactor before the pipeline's worker pools import the default one
+    settings = get_project_settings()
+    install_reactor(settings["TWISTED_REACTOR"])
+    from twisted.internet import defer
+    from medscraper.pipelines import MedscraperPipeline
+    from medscraper.spiders.manual_spider import ManualSpider
+
+    with open(config_path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    workdir = config["workdir"]
+    boto3.client("s3").create_bucket(Bucket=config["bucket"])
+
+    # Count every request made to the bucket by the pipeline's own client and the files store's, and time insert_or_update
+    class BenchPipeline(MedscraperPipeline):
+        instances = []
+
+        @classmethod
+        def from_crawler(cls, crawler):
+            pipeline = super().from_crawler(crawler)
+            pipeline.s3_calls = 0
+            pipeline.insert_or_update_seconds = 0.0
+            for client in (pipeline.s3_client, getattr(pipeline.store, "s3_client", None)):
+                if client is not None:
+                    client.meta.events.register("before-send.s3", pipeline.count_s3_call)
+            cls.instances.append(pipeline)
+            return pipeline
+
+        def count_s3_call(self, **kwargs):
+            self.s3_calls += 1
+
+        def insert_or_update(self, df, new_record):
+            start = time.perf_counter()
+            try:
+                return super().insert_or_update(df, new_record)
+            finally:
+                self.insert_or_update_seconds += time.perf_counter() - start
+
+    # ManualSpider, pointed at the stand-ins, starting from every state site and keeping each real host's politeness profile
+    sites = config["sites"]
+    def stand_in(url):
+        site = next(site for site in sites if url.startswith(site["origin"]))
+        return site["stand_in"] + url[len(site["origin"]):]
+    hosts = {site["origin"].split("//", 1)[1]: site["stand_in"].split("//", 1)[1].split(":")[0] for site in sites}
+
+    class BenchSpider(ManualSpider):
+        name = "bench_manuals"
+        allowed_domains = list(hosts.values())
+        valid_base_urls = [stand_in(url) for site in sites for url in site["base_urls"]]
+        state_dict = {stand_in(site["origin"] + "/"): site["state"] for site in sites}
+        start_urls_by_state = {site["state"]: [stand_in(url) for url in site["start_urls"]] for site in sites}
+        domain_profiles = {hosts[host]: profile for host, profile in ManualSpider.domain_profiles.items() if host in hosts}
+
+    settings.setdict({
+        "ITEM_PIPELINES": {BenchPipeline: 1},
+        "FILES_STORE": f"s3://{config['bucket']}/",
+        "S3_BUCKET": config["bucket"],
+        "AWS_ENDPOINT_URL": config["endpoint"],
+        "AWS_ACCESS_KEY_ID": "bench",
+        "AWS_SECRET_ACCESS_KEY": "bench",
+        "ROBOTSTXT_OBEY": False,
+        "TELNETCONSOLE_ENABLED": False,
+        "LOG_LEVEL": "WARNING",
+        "METADATA_LOCAL_DIR": os.path.join(workdir, "doc-data"),
+        "HASH_INDEX_PATH": os.path.join(workdir, "doc-data", "hash_index.json"),
+        "URL_VALIDATORS_PATH": os.path.join(workdir, "doc-data", "url_validators.json"),
+        "DOCUMENT_MANIFEST_PATH": os.path.join(workdir, "doc-data", "document_manifest.json"),
+        "DOCUMENT_FRONTIER_PATH": os.path.join(workdir, "doc-data", "document_frontier.jsonl"),
+        "CRAWLSTATE_PATH": os.path.join(workdir, "doc-data", "crawl_state.sqlite3"),
+        # Nothing the bench writes may end up in the project's own doc-data, where the next real crawl would pick it up
+        "METADATA_JOURNAL_DIR": os.path.join(workdir, "doc-data", "journal"),
+        "TEXT_INDEX_PATH": os.path.join(workdir, "doc-data", "text_index.json"),
+        "METRICS_EXPORT_PATH": os.path.join(workdir, "doc-data", "metrics.prom")
+    })
+    settings.setdict(config["settings"])
+
+    process = CrawlerProcess(settings, install_root_handler=True)
+    results = {}
+
+    @defer.inlineCallbacks
+    def crawl():
+        for name in config["passes"]:
+            crawler = process.create_crawler(BenchSpider)
+            yield process.crawl(crawler)
+            results[name] = pass_metrics(crawler.stats.get_stats(), BenchPipeline.instances[-1])
+
+    crawl()
+    process.start()
+    with open(results_path, "w", encoding="utf-8") as f:
+        json.dump(results, f)
+
+# Helper function, working out a pass's metrics from its crawl stats and the pipeline's counters
+def pass_metrics(stats, pipeline):
+    elapsed = (stats["finish_time"] - stats["start_time"]).total_seconds()
+    pages = stats.get("frontier/size", 0)
+    docs = stats.get("file_count", 0) + stats.get("file_status_count/notmodified", 0)
+    return {
+        "elapsed_s": round(elapsed, 3),
+        "pages": pages,
+        "docs": docs,
+        "pages_per_s": round(pages / elapsed, 2),
+        "docs_per_s": round(docs / elapsed, 2),
+        "mb_per_s": round(stats.get("downloader/response_bytes", 0) / 1e6 / elapsed, 2),
+        "s3_calls": pipeline.s3_calls,
+        "s3_calls_per_doc": round(pipeline.s3_calls / docs, 3) if docs else 0.0,
+        # ru_maxrss is in KB on Linux
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "insert_or_update_s": round(pipeline.insert_or_update_seconds, 4)
+    }
+
+# Helper function, finding every metric worse than its baseline value by more than the tolerance
+def regressions(results, baseline, tolerance):
+    found = []
+    for size, passes in results.items():
+        for name, metrics in passes.items():
+            expected = baseline.get(size, {}).get(name, {})
+            for metric, (higher_is_better, slack) in METRICS.items():
+                if metric not in expected:
+                    continue
+                if higher_is_better:
+                    limit = expected[metric] * (1 - tolerance) - slack
+                else:
+                    limit = expected[metric] * (1 + tolerance) + slack
+                if (metrics[metric] < limit) if higher_is_better else (metrics[metric] > limit):
+                    found.append(f"{size}/{name} {metric}: {metrics[metric]} vs baseline {expected[metric]} (limit {round(limit, 3)})")
+    return found
+
+def print_results(results):
+    columns = ["elapsed_s", "pages", "docs"] + list(METRICS)
+    print(f"{'corpus':<14}" + "".join(f"{column:>20}" for column in columns))
+    for size, passes in results.items():
+        for name, metrics in passes.items():
+            print(f"{size + '/' + name:<14}" + "".join(f"{metrics[column]:>20}" for column in columns))
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--worker":
+        worker(sys.argv[2], sys.argv[3])
+        return
+
+    parser = argparse.ArgumentParser(description="End-to-end benchmark for the crawl against local stand-ins for the state sites and s3")
+    parser.add_argument("--sizes", default="small,medium", help="comma-separated corpus sizes to run: small, medium, large")
+    parser.add_argument("--fixtures", help="folder of recorded sites, one folder per real host as written by wget -m, used instead of the synthetic corpus")
+    parser.add_argument("--latency", type=float, default=0, help="milliseconds the stand-in sites wait before answering each request")
+    parser.add_argument("--passes", default="cold,warm", help="comma-separated passes to crawl each corpus for")
+    parser.add_argument("--s3-endpoint", help="S3-compatible endpoint to use instead of starting a moto server")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE", help="scrapy setting to crawl with, may be repeated")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline results file")
+    parser.add_argument("--check", action="store_true", help="fail if any metric is worse than the baseline by more than the tolerance")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run's results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed fraction a metric may be worse than its baseline")
+    parser.add_argument("--keep", action="store_true", help="keep the generated corpora and each crawl's doc-data afterwards")
+    args = parser.parse_args()
+    args.sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    args.passes = [name.strip() for name in args.passes.split(",") if name.strip()]
+    # Recorded sites are a single corpus of whatever size they were recorded at
+    if args.fixtures:
+        args.sizes = ["recorded"]
+    unknown = [size for size in args.sizes if size not in CORPUS_SIZES and size != "recorded"]
+    if unknown:
+        parser.error(f"unknown corpus sizes: {', '.join(unknown)}")
+
+    results = run_benchmarks(args)
+    print_results(results)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+    if args.check:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+if __name__ == "__main__":
+    main()
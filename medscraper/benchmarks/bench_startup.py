@@ -0,0 +1,146 @@
+# Startup benchmark for the project: how long it takes before a crawl can send its first request
+#
+# Each probe runs in a fresh Python process, timed from the parent, since an interpreter only ever pays for an import once: the scrapy
+# command line listing the spiders (which loads every project command), importing the spider, and importing and building the pipeline
+# for a full crawl and for a discovery-only one. Every probe also reports which of the heavy dependencies (pandas, boto3, botocore's
+# session, pyarrow) it ended up importing; the spider, the command line and discovery-only crawls must never import pandas or boto3. With
+# --check, any probe slower than the stored baseline by more than the tolerance fails the run; --save-baseline stores this run's results
+# as the new baseline
+#
+# Usage (from the project directory containing scrapy.cfg):
+#   python benchmarks/bench_startup.py [--repeat 5] [--check | --save-baseline] [--tolerance 0.25]
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines", "bench_startup.json")
+
+# Modules reported for every probe, and the probes that must not import the first two
+HEAVY_MODULES = ["pandas", "boto3", "botocore.session", "pyarrow"]
+LIGHT_PROBES = {"cli", "spider", "discovery_pipeline"}
+FORBIDDEN_MODULES = ["pandas", "boto3"]
+
+# Seconds a probe may be slower than its baseline on top of the tolerance before it counts as a regression, so fast probes don't fail on noise
+SLACK = 0.05
+
+# Runs in the probe process; does the probe's work and writes the heavy modules it imported to the results file
+def probe(name, results_path):
+    if name == "cli":
+        import scrapy.cmdline
+        sys.argv = ["scrapy", "list"]
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+        try:
+            scrapy.cmdline.execute()
+        except SystemExit:
+            pass
+        finally:
+            sys.stdout = stdout
+    elif name == "spider":
+        import medscraper.spiders.manual_spider  # noqa: F401
+    else:
+        from scrapy.utils.project import get_project_settings
+        from scrapy.utils.reactor import install_reactor
+        from scrapy.utils.test import get_crawler
+
+        # Install the configured reactor before the pipeline's worker pools import the default one
+        settings = get_project_settings()
+        install_reactor(settings["TWISTED_REACTOR"])
+        from medscraper.pipelines import MedscraperPipeline
+        from medscraper.spiders.manual_spider import ManualSpider
+
+        overrides = {"LOG_ENABLED": False}
+        if name == "discovery_pipeline":
+            overrides.update({"DISCOVERY_ONLY": True, "DOCUMENT_FRONTIER_PATH": os.path.join(tempfile.gettempdir(), "bench_startup_frontier.jsonl")})
+        crawler = get_crawler(ManualSpider, {**settings.copy_to_dict(), **overrides})
+        pipeline = MedscraperPipeline.from_crawler(crawler)
+        pipeline.stop_workers(None)
+
+    with open(results_path, "w", encoding="utf-8") as f:
+        json.dump([module for module in HEAVY_MODULES if module in sys.modules], f)
+
+# Run a probe in a process of its own, returning how long the process took and the heavy modules it imported
+def run_probe(name):
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        results_path = f.name
+    env = {**os.environ, "SCRAPY_SETTINGS_MODULE": "medscraper.settings"}
+    start = time.perf_counter()
+    subprocess.run([sys.executable, os.path.abspath(__file__), "--probe", name, results_path], env=env, check=True)
+    elapsed = time.perf_counter() - start
+    with open(results_path, "r", encoding="utf-8") as f:
+        modules = json.load(f)
+    os.remove(results_path)
+    return elapsed, modules
+
+# Run every probe repeat times, returning the median time of each along with the heavy modules it imported
+def run_benchmarks(repeat):
+    results = {}
+    for name in ["cli", "spider", "full_pipeline", "discovery_pipeline"]:
+        times = []
+        for _ in range(repeat):
+            elapsed, modules = run_probe(name)
+            times.append(elapsed)
+        results[name] = {"median_s": round(statistics.median(times), 3), "min_s": round(min(times), 3), "heavy_modules": modules}
+    return results
+
+# Helper function, finding every probe slower than its baseline by more than the tolerance, and every light probe importing what it mustn't
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, metrics in results.items():
+        forbidden = [module for module in metrics["heavy_modules"] if module in FORBIDDEN_MODULES]
+        if name in LIGHT_PROBES and forbidden:
+            found.append(f"{name} imports {', '.join(forbidden)}")
+        expected = baseline.get(name, {}).get("median_s")
+        if expected is None:
+            continue
+        limit = expected * (1 + tolerance) + SLACK
+        if metrics["median_s"] > limit:
+            found.append(f"{name} median_s: {metrics['median_s']} vs baseline {expected} (limit {round(limit, 3)})")
+    return found
+
+def print_results(results):
+    print(f"{'probe':<22}{'median_s':>10}{'min_s':>10}  heavy modules")
+    for name, metrics in results.items():
+        print(f"{name:<22}{metrics['median_s']:>10}{metrics['min_s']:>10}  {', '.join(metrics['heavy_modules']) or '-'}")
+
+def main():
+    if len(sys.argv) == 4 and sys.argv[1] == "--probe":
+        probe(sys.argv[2], sys.argv[3])
+        return
+
+    parser = argparse.ArgumentParser(description="Startup benchmark for the project's command line, spider and pipeline")
+    parser.add_argument("--repeat", type=int, default=5, help="number of processes to time for each probe")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline results file")
+    parser.add_argument("--check", action="store_true", help="fail if any probe is slower than the baseline by more than the tolerance")
+    parser.add_argument("--save-baseline", action="store_true", help="store this run's results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed fraction a probe may be slower than its baseline")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.repeat)
+    print_results(results)
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline), exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+
+    if args.check:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        if found:
+            sys.exit(1)
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+
+if __name__ == "__main__":
+    main()
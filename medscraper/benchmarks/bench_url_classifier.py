@@ -0,0 +1,105 @@
+# Micro-benchmark for the spider's link classification
+#
+# Runs the original per-link checks (two uncompiled regex searches, a linear scan over every allowed base path, and a scan over
+# every state prefix) against the precompiled UrlClassifier, over the links of a large index page. Pass the path of a saved page
+# to benchmark against real markup; otherwise a synthetic page with a mix of document, in-scope and out-of-scope links is used
+#
+# Usage (from the project directory containing scrapy.cfg):
+#   python benchmarks/bench_url_classifier.py [saved_page.html] [--repeat N]
+import os
+import re
+import sys
+import argparse
+import timeit
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from scrapy.http import HtmlResponse
+from medscraper.urls import UrlClassifier
+from medscraper.spiders.manual_spider import ManualSpider
+
+PAGE_URL = "https://ahca.myflorida.com/medicaid/rules/index"
+
+# Helper function, building a large listing page similar to a state's manual index
+def synthetic_page(link_count=20000):
+    links = []
+    for i in range(link_count):
+        kind = i % 5
+        if kind == 0:
+            links.append(f"/medicaid/rules/manuals/provider_manual_{i}.pdf")
+        elif kind == 1:
+            links.append(f"/medicaid/rules/handbooks/handbook_{i}.docx?ver={i % 7}")
+        elif kind == 2:
+            links.append(f"/medicaid/rules/section_{i}/")
+        elif kind == 3:
+            links.append(f"https://www.kymmis.com/kymmis/Provider%20Relations/page_{i}.aspx")
+        else:
+            links.append(f"https://www.example.org/outside/page_{i}.html")
+    anchors = "\n".join(f'<li><a href="{link}">Link {i}</a></li>' for i, link in enumerate(links))
+    return f"<html><body><ul>{anchors}</ul></body></html>".encode("utf-8")
+
+# The link checks as ManualSpider.parse originally ran them; links are joined to the page url up front so only the checks are timed
+def classify_original(spider, response, links):
+    state = "Invalid"
+    for state_url in spider.state_dict.keys():
+        if response.url.startswith(state_url):
+            state = spider.state_dict[state_url]
+
+    file_urls, requests = [], []
+    for link, full_link in links:
+        if re.search(r'\.pdf$', link, re.IGNORECASE) or re.search(r'\.docx$', link, re.IGNORECASE):
+            file_urls.append(full_link)
+        if any(full_link.startswith(prefix) for prefix in spider.valid_base_urls):
+            requests.append(full_link)
+    return state, file_urls, requests
+
+# The same checks through the precompiled classifier
+def classify_compiled(classifier, response, links):
+    state = classifier.state_for(response.url)
+
+    file_urls, requests = [], []
+    for link, full_link in links:
+        if classifier.is_document(link):
+            file_urls.append(full_link)
+        if classifier.is_allowed(full_link):
+            requests.append(full_link)
+    return state, file_urls, requests
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the spider's link classification")
+    parser.add_argument("page", nargs="?", help="Path of a saved HTML page to extract links from")
+    parser.add_argument("--url", default=PAGE_URL, help="Url the saved page was fetched from")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of timed passes over the page")
+    args = parser.parse_args()
+
+    if args.page:
+        with open(args.page, "rb") as f:
+            body = f.read()
+    else:
+        body = synthetic_page()
+
+    response = HtmlResponse(url=args.url, body=body, encoding="utf-8")
+    all_links = response.css("a::attr(href)").getall()
+    links = [(link, response.urljoin(link)) for link in all_links]
+    spider = ManualSpider()
+    classifier = UrlClassifier(spider.valid_base_urls, spider.state_dict)
+
+    original = classify_original(spider, response, links)
+    compiled = classify_compiled(classifier, response, links)
+    # The compiled classifier also picks up .doc/.xls/.xlsx and links with query strings, so only compare what the original covered
+    assert original[0] == compiled[0]
+    assert original[2] == compiled[2]
+    assert set(original[1]) <= set(compiled[1])
+
+    original_time = min(timeit.repeat(lambda: classify_original(spider, response, links), number=1, repeat=args.repeat))
+    compiled_time = min(timeit.repeat(lambda: classify_compiled(classifier, response, links), number=1, repeat=args.repeat))
+
+    print(f"links on page:      {len(all_links)}")
+    print(f"document links:     {len(original[1])} original, {len(compiled[1])} compiled")
+    print(f"followed links:     {len(compiled[2])}")
+    print(f"original checks:    {original_time * 1000:.1f} ms ({len(all_links) / original_time:,.0f} links/s)")
+    print(f"compiled checks:    {compiled_time * 1000:.1f} ms ({len(all_links) / compiled_time:,.0f} links/s)")
+    print(f"speedup:            {original_time / compiled_time:.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# Micro-benchmark for hashing and link extraction on the worker pools
+#
+# Hashes a batch of large synthetic documents, and extracts the links of a batch of large listing pages, with each on the reactor thread
+# (0 threads) and on pools of increasing size, while a timer on the reactor ticks every few milliseconds. Reports the wall time for the
+# batch and the longest the reactor went without ticking, which is how long every other response (and download) waited on the work
+#
+# Usage (from the project directory containing scrapy.cfg):
+#   python benchmarks/bench_workers.py [--files 16] [--file-mb 32] [--pages 16] [--threads 0,1,2,4]
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from scrapy.utils.reactor import install_reactor
+
+install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
+
+from twisted.internet import defer, task
+from scrapy.http import HtmlResponse
+from medscraper.streaming import hash_body
+from medscraper.workers import WorkerPool
+from medscraper.spiders.manual_spider import ManualSpider
+from bench_url_classifier import synthetic_page, PAGE_URL
+
+TICK = 0.002
+
+# Run a batch of calls on a pool of the given size, returning the wall time and the longest gap between reactor ticks
+@defer.inlineCallbacks
+def run_batch(threads, func, batch):
+    pool = WorkerPool("bench", threads)
+    pool.start()
+    ticks = []
+    ticker = task.LoopingCall(lambda: ticks.append(time.perf_counter()))
+    ticker.start(TICK)
+    start = time.perf_counter()
+    yield defer.gatherResults([pool.run(func, *args) for args in batch])
+    elapsed = time.perf_counter() - start
+    ticks.append(time.perf_counter())
+    ticker.stop()
+    pool.stop()
+    return elapsed, max(b - a for a, b in zip(ticks, ticks[1:]))
+
+@defer.inlineCallbacks
+def main(args):
+    body = os.urandom(args.file_mb * 1024 * 1024)
+    hashes = [(body,)] * args.files
+    page = synthetic_page(args.links)
+    spider = ManualSpider()
+    pages = [(HtmlResponse(url=PAGE_URL, body=page, encoding="utf-8"),) for _ in range(args.pages)]
+
+    print(f"{'work':<24}{'threads':>8}{'elapsed_s':>12}{'max_stall_ms':>14}")
+    for label, func, batch in ((f"hash {args.files}x{args.file_mb}MB", hash_body, hashes), (f"links {args.pages}x{args.links}", spider.extract_links, pages)):
+        for threads in args.threads:
+            # Every response caches its parsed selector, so parse fresh copies each time
+            if func is spider.extract_links:
+                batch = [(response.replace(body=page),) for (response,) in batch]
+            elapsed, stall = yield run_batch(threads, func, batch)
+            print(f"{label:<24}{threads:>8}{elapsed:>12.3f}{stall * 1000:>14.1f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark hashing and link extraction on the worker pools")
+    parser.add_argument("--files", type=int, default=16, help="Number of documents hashed")
+    parser.add_argument("--file-mb", type=int, default=32, help="Size of each document in MB")
+    parser.add_argument("--pages", type=int, default=16, help="Number of listing pages parsed for links")
+    parser.add_argument("--links", type=int, default=5000, help="Number of links on each listing page")
+    parser.add_argument("--threads", default="0,1,2,4", help="Comma-separated pool sizes to run, 0 for the reactor thread")
+    args = parser.parse_args()
+    args.threads = [int(threads) for threads in args.threads.split(",")]
+    task.react(lambda _: main(args))
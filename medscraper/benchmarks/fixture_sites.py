@@ -0,0 +1,166 @@
+# Local stand-ins for the state sites, for running the crawl end to end without touching the real ones
+#
+# Every state site ManualSpider knows about is served from a loopback address of its own (127.0.0.2, 127.0.0.3, ...), so each one still
+# gets its own download slot and politeness profile, the same as the real hosts. A site's pages and documents are served from a folder
+# named after the real host, the same layout wget -m uses, so recorded copies of the sites can be dropped in as they are; links to the
+# real hosts in recorded pages are rewritten to their stand-ins. Without recorded copies, a synthetic corpus of listing pages and
+# documents is generated under each state's base paths
+import os
+import time
+import random
+import shutil
+import threading
+import functools
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, unquote
+from medscraper.spiders.manual_spider import ManualSpider
+
+# Content types for the document files; anything else (.html, .aspx, folders) is served as a page
+DOCUMENT_TYPES = {
+    ".pdf": "application/pdf",
+    ".doc": "application/msword",
+    ".docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    ".xls": "application/vnd.ms-excel",
+    ".xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+}
+
+# Number of documents linked from each listing page of the synthetic corpus
+DOCUMENTS_PER_PAGE = 10
+
+class FixtureHandler(SimpleHTTPRequestHandler):
+    # Seconds to wait before answering each request, to imitate a remote site
+    latency = 0
+
+    def guess_type(self, path):
+        return DOCUMENT_TYPES.get(os.path.splitext(path)[1].lower(), "text/html")
+
+    def send_head(self):
+        if self.latency:
+            time.sleep(self.latency)
+        return super().send_head()
+
+    def log_message(self, format, *args):
+        pass
+
+# Helper function, listing the state sites the spider knows about: each state's origin, base paths and start urls. States without
+# start urls on the spider (commented out there) start from their first base path
+def state_sites():
+    sites = []
+    for prefix, state in ManualSpider.state_dict.items():
+        origin = prefix[:prefix.index("/", prefix.index("//") + 2)]
+        base_urls = [url for url in ManualSpider.valid_base_urls if url.startswith(prefix)]
+        if not base_urls:
+            continue
+        start_urls = ManualSpider.start_urls_by_state.get(state) or [base_urls[0] + "/"]
+        sites.append({"state": state, "origin": origin, "base_urls": base_urls, "start_urls": start_urls})
+    return sites
+
+class FixtureSites:
+    def __init__(self, root, latency=0):
+        self.root = root
+        self.latency = latency
+        self.sites = state_sites()
+        self.servers = []
+
+    # Start a server for every state site on its own loopback address, filling in each site's stand-in origin
+    def start(self):
+        handler = type("Handler", (FixtureHandler,), {"latency": self.latency})
+        for i, site in enumerate(self.sites):
+            directory = os.path.join(self.root, urlparse(site["origin"]).hostname)
+            os.makedirs(directory, exist_ok=True)
+            server = ThreadingHTTPServer((f"127.0.0.{i + 2}", 0), functools.partial(handler, directory=directory))
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            self.servers.append(server)
+            site["stand_in"] = f"http://127.0.0.{i + 2}:{server.server_address[1]}"
+        return self
+
+    def stop(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+    # Helper function, pointing a url on one of the real sites at its stand-in
+    def rewrite(self, url):
+        for site in self.sites:
+            if url.startswith(site["origin"]):
+                return site["stand_in"] + url[len(site["origin"]):]
+        return url
+
+    # Helper function, rewriting every link to one of the real sites in a page to its stand-in, over both http and https
+    def rewrite_page(self, text):
+        for site in self.sites:
+            host = urlparse(site["origin"]).hostname
+            for scheme in ("https://", "http://"):
+                text = text.replace(scheme + host, site["stand_in"])
+        return text
+
+    # Copy recorded copies of the sites (one folder per real host, as written by wget -m) into the served folders
+    def copy_recorded(self, source):
+        for site in self.sites:
+            host = urlparse(site["origin"]).hostname
+            if not os.path.isdir(os.path.join(source, host)):
+                continue
+            target = os.path.join(self.root, host)
+            shutil.copytree(os.path.join(source, host), target, dirs_exist_ok=True)
+            for folder, _, names in os.walk(target):
+                for name in names:
+                    if os.path.splitext(name)[1].lower() in DOCUMENT_TYPES:
+                        continue
+                    path = os.path.join(folder, name)
+                    with open(path, "r", encoding="utf-8", errors="surrogateescape") as f:
+                        text = f.read()
+                    with open(path, "w", encoding="utf-8", errors="surrogateescape") as f:
+                        f.write(self.rewrite_page(text))
+
+    # Generate a synthetic corpus for every state: its start page links to listing pages under its base path, each linking a batch of
+    # documents along with the start page, the next listing page and one document from the previous page, the way the real indexes
+    # cross-link. Every 25th document is the same form in every state, so identical files turn up under different names and sites
+    def generate(self, documents_per_state, seed=0):
+        shared_form = random.Random(seed).randbytes(120 * 1024)
+        for i, site in enumerate(self.sites):
+            rng = random.Random(seed + i + 1)
+            base = self.rewrite(site["base_urls"][0])
+            start = self.rewrite(site["start_urls"][0])
+            slug = site["state"].lower().replace(" ", "-")
+            page_count = max(1, -(-documents_per_state // DOCUMENTS_PER_PAGE))
+            pages = [f"{base}/bench-section-{p}.html" for p in range(page_count)]
+
+            documents = []
+            for d in range(documents_per_state):
+                extension = ".docx" if d % 4 == 3 else ".pdf"
+                url = f"{base}/bench-documents/{slug}-manual-{d}{extension}"
+                body = shared_form if d % 25 == 24 else self.document_body(rng, extension)
+                self.write(url, body)
+                documents.append(url)
+
+            self.write(start, self.page(f"{site['state']} provider manuals", pages))
+            for p, page in enumerate(pages):
+                batch = documents[p * DOCUMENTS_PER_PAGE:(p + 1) * DOCUMENTS_PER_PAGE]
+                links = batch + [start, pages[(p + 1) % len(pages)]]
+                if p > 0:
+                    links.append(documents[(p - 1) * DOCUMENTS_PER_PAGE])
+                self.write(page, self.page(f"{site['state']} section {p}", links))
+
+    # Helper function, random document contents with a realistic spread of sizes, mostly around 100 KB with the odd much larger manual
+    def document_body(self, rng, extension):
+        size = int(min(2 * 1024 * 1024, max(8 * 1024, rng.lognormvariate(11.5, 0.9))))
+        header = b"%PDF-1.4\n" if extension == ".pdf" else b"PK\x03\x04"
+        return header + rng.randbytes(size - len(header))
+
+    def page(self, title, links):
+        anchors = "\n".join(f'<li><a href="{link}">{os.path.basename(link.rstrip("/")) or link}</a></li>' for link in links)
+        return f"<html><head><title>{title}</title></head><body><h1>{title}</h1><ul>\n{anchors}\n</ul></body></html>".encode("utf-8")
+
+    # Helper function, writing a page or document to the file a stand-in url is served from
+    def write(self, url, body):
+        parsed = urlparse(url)
+        site = next(site for site in self.sites if url.startswith(site["stand_in"]))
+        path = unquote(parsed.path)
+        if path.endswith("/"):
+            path += "index.html"
+        target = os.path.join(self.root, urlparse(site["origin"]).hostname, *path.lstrip("/").split("/"))
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as f:
+            f.write(body)
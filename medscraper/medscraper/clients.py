@@ -0,0 +1,55 @@
+# Lazily created s3 clients, so a crawl only pays for importing boto3 and building its clients once something actually talks to the bucket
+#
+# Importing boto3 and creating a client takes a good part of a second, which short incremental and single-state crawls used to spend
+# before their first request, and discovery-only crawls spent without ever using the bucket. A LazyClient stands in for the client
+# everywhere it's passed around (the manifests, the metadata stores, the files store), creating it the first time any of its attributes
+# is used, from whichever thread gets there first
+import threading
+
+class LazyClient:
+    def __init__(self, factory):
+        self.factory = factory
+        self.instance = None
+        self.callbacks = []
+        self.lock = threading.Lock()
+
+    @property
+    def created(self):
+        return self.instance is not None
+
+    # The client itself, created on first use
+    @property
+    def client(self):
+        if self.instance is None:
+            with self.lock:
+                if self.instance is None:
+                    client = self.factory()
+                    for callback in self.callbacks:
+                        callback(client)
+                    self.instance = client
+        return self.instance
+
+    # Call back with the client once it's created (straight away, if it already has been), e.g. to register event hooks on it
+    def when_created(self, callback):
+        with self.lock:
+            if self.instance is None:
+                self.callbacks.append(callback)
+                return
+        callback(self.instance)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+# Helper function, creating the s3 client shared by the pipeline's worker threads, with enough pooled connections for each of them
+def create_s3_client(max_pool_connections=10):
+    import boto3
+    from botocore.config import Config
+    return boto3.client('s3', config=Config(max_pool_connections=max_pool_connections))
+
+def lazy_s3_client(max_pool_connections=10):
+    return LazyClient(lambda: create_s3_client(max_pool_connections))
+
+# Helper function, whether an s3 request failed because the key doesn't exist, rather than because it was refused, throttled or failed on
+# the bucket's side; get requests report a missing key as NoSuchKey, and head requests (which have no body) as a bare 404
+def is_not_found(error):
+    return error.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
@@ -0,0 +1,4 @@
+# This package contains the project's custom scrapy commands
+#
+# Please refer to the documentation for information on how to create and manage
+# your commands: https://docs.scrapy.org/en/latest/topics/commands.html#custom-project-commands
@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import subprocess
+from scrapy.commands import ScrapyCommand
+from medscraper.clients import lazy_s3_client
+from medscraper.shards import split_states, merge_shards, shard_path
+from medscraper.journal import CrawlJournal, journal_dir
+from medscraper.spiders.manual_spider import ManualSpider
+
+# Custom scrapy command crawl_sharded; splits the states across several scrapy processes, each crawling its own states into its own
+# shard of the metadata tables and manifests, then merges the shards back into the shared tables once every process has finished.
+# Any -s settings are passed on to every shard, apart from JOBDIR, which every shard gets its own folder of (under shards/<shard>/ next to
+# it), so a paused sharded crawl resumes when run again with the same JOBDIR, states and --shards. The shards are only merged once every
+# one of them has finished; if any failed or was paused, they're kept as they are, journals and all, for the next run to pick up
+#
+# Usage: scrapy crawl_sharded [--shards N] [--states Florida,Alabama] [--merge-only] [-s NAME=VALUE ...]
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Run the manuals spider as several processes, split by state, and merge their metadata"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            "--shards",
+            type=int,
+            default=os.cpu_count() or 1,
+            help="number of processes to split the states between (default: number of CPUs, at most one per state)"
+        )
+        parser.add_argument(
+            "--states",
+            help="comma-separated states to crawl; defaults to CRAWL_STATES, or else every state with start urls"
+        )
+        parser.add_argument(
+            "--merge-only",
+            action="store_true",
+            help="skip crawling and merge the shards left by an earlier run"
+        )
+
+    def run(self, args, opts):
+        s3_client = lazy_s3_client()
+        local_dir = self.settings.get('METADATA_LOCAL_DIR')
+        plan_path = os.path.join(local_dir, "shards", "plan.json")
+
+        if opts.merge_only:
+            if not os.path.exists(plan_path):
+                print(f"No sharded crawl to merge; {plan_path} doesn't exist")
+                self.exitcode = 1
+                return
+            with open(plan_path, "r", encoding="utf-8") as f:
+                shards = [(shard, states) for shard, states in json.load(f).items()]
+        else:
+            states = opts.states.split(",") if opts.states else self.settings.getlist('CRAWL_STATES') or list(ManualSpider.start_urls_by_state)
+            states = [state.strip() for state in states if state.strip()]
+            shards = [(f"shard-{i}", group) for i, group in enumerate(split_states(states, opts.shards))]
+
+            # Keep the plan next to the shards, so they can still be merged with --merge-only if this process is interrupted
+            os.makedirs(os.path.dirname(plan_path), exist_ok=True)
+            with open(plan_path, "w", encoding="utf-8") as f:
+                json.dump(dict(shards), f)
+
+            if not self.crawl(shards, opts.set or []):
+                print("Not merging the shards until every one of them has finished; run crawl_sharded again to carry on with them")
+                self.exitcode = 1
+                return
+
+        # A shard that died partway leaves its journal behind in its folder, which merging would delete along with the rest of the shard;
+        # crawling the shard again replays it into the shard's tables first
+        unrecovered = [shard for shard, _ in shards if CrawlJournal(journal_dir(self.shard_settings(shard), shard)).segments()]
+        if unrecovered:
+            print(f"Not merging; journaled records are left to recover in {', '.join(unrecovered)}, run crawl_sharded again to recover them")
+            self.exitcode = 1
+            return
+
+        if not merge_shards(self.settings, s3_client, shards):
+            print("Not everything merged could be stored, so the shards are kept; run crawl_sharded --merge-only to merge them again")
+            self.exitcode = 1
+            return
+        os.remove(plan_path)
+        print(f"Merged {len(shards)} shards into s3://{self.settings.get('S3_BUCKET')}/doc-data/")
+
+    # Helper function, the JOBDIR of a shard, if the sharded crawl was given one
+    def shard_jobdir(self, shard):
+        jobdir = self.settings.get('JOBDIR')
+        return shard_path(jobdir, shard) if jobdir else None
+
+    # Helper function, the settings a shard's process runs with, as far as finding its journal goes
+    def shard_settings(self, shard):
+        return {'JOBDIR': self.shard_jobdir(shard), 'METADATA_JOURNAL_DIR': self.settings.get('METADATA_JOURNAL_DIR')}
+
+    # Helper function, running one scrapy process per shard at once and waiting for all of them to finish; returns whether every one succeeded
+    def crawl(self, shards, settings):
+        local_dir = self.settings.get('METADATA_LOCAL_DIR')
+        processes = []
+        for shard, states in shards:
+            log_path = os.path.join(local_dir, "shards", f"{shard}.log")
+            command = [sys.executable, "-m", "scrapy", "crawl", ManualSpider.name,
+                       "-s", f"SHARD_NAME={shard}", "-s", f"CRAWL_STATES={','.join(states)}", "-s", f"LOG_FILE={log_path}"]
+            for setting in settings:
+                if setting.partition("=")[0].strip() != "JOBDIR":
+                    command += ["-s", setting]
+            if self.shard_jobdir(shard):
+                command += ["-s", f"JOBDIR={self.shard_jobdir(shard)}"]
+            processes.append((shard, states, log_path, subprocess.Popen(command)))
+            print(f"Started {shard} ({', '.join(states)}), logging to {log_path}")
+
+        succeeded = True
+        try:
+            for shard, states, log_path, process in processes:
+                if process.wait() != 0:
+                    print(f"{shard} ({', '.join(states)}) exited with code {process.returncode}; see {log_path}")
+                    succeeded = False
+        except KeyboardInterrupt:
+            # Ctrl-C reaches every shard too, which each shut down (and with a JOBDIR, pause) on their own; wait for them, and leave the
+            # shards unmerged
+            print("Interrupted; waiting for the shards to stop")
+            for _, _, _, process in processes:
+                process.wait()
+            succeeded = False
+        return succeeded
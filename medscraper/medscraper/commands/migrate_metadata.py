@@ -0,0 +1,46 @@
+from scrapy.commands import ScrapyCommand
+from medscraper.clients import create_s3_client
+from medscraper.metadata import MetadataStore, build_rollups
+
+# Custom scrapy command migrate_metadata; converts the CSV metadata tables in the s3 bucket to Parquet in a single pass.
+# The rollups are recomputed from the master table, since the CSV copies in the bucket were written without their group keys
+class Command(ScrapyCommand):
+    requires_project = True
+    default_settings = {"LOG_ENABLED": False}
+
+    def syntax(self):
+        return "[options]"
+
+    def short_desc(self):
+        return "Convert the CSV metadata tables in the s3 bucket to Parquet"
+
+    def add_options(self, parser):
+        super().add_options(parser)
+        parser.add_argument(
+            "--partition-by-state",
+            action="store_true",
+            help="partition the Parquet master table by package_state (default: METADATA_PARTITION_BY_STATE)"
+        )
+
+    def run(self, args, opts):
+        s3_client = create_s3_client()
+        s3_bucket = self.settings.get('S3_BUCKET')
+        local_dir = self.settings.get('METADATA_LOCAL_DIR')
+        partition_by_state = opts.partition_by_state or self.settings.getbool('METADATA_PARTITION_BY_STATE')
+
+        source = MetadataStore(s3_client, s3_bucket, local_dir, table_format="csv")
+        target = MetadataStore(s3_client, s3_bucket, local_dir, table_format="parquet", partition_by_state=partition_by_state)
+
+        master_table = source.load("master_table")
+        if master_table is None:
+            print(f"No CSV master table found at s3://{s3_bucket}/{source.key('master_table')}")
+            self.exitcode = 1
+            return
+
+        state_table, file_count_table = build_rollups(master_table)
+        for name, table in zip(["master_table", "state_table", "file_count_table"], [master_table, state_table, file_count_table]):
+            target.save(name, table)
+
+        print(f"Migrated {len(master_table)} master table rows to Parquet in s3://{s3_bucket}/doc-data/"
+              + (" (partitioned by state)" if partition_by_state else ""))
+        print("Set METADATA_FORMAT = \"parquet\" in settings.py to have crawls read and write the Parquet tables")
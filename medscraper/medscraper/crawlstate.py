@@ -0,0 +1,131 @@
+# Persistent crawl state for the spider's listing pages, kept in a SQLite database under doc-data/
+#
+# For every page crawled, the database remembers when it was last fetched, the validators (ETag/Last-Modified) the server sent for it,
+# the hash of its HTML, and the document and page links extracted from it. On the next run, pages whose HTML hasn't changed reuse their
+# stored links instead of being parsed again, and pages that aren't due for a revisit yet aren't fetched at all. Pages discovered from a
+# sitemap or listing also keep the last modified date it gave for them, so they're only fetched again once it changes
+import os
+import json
+import time
+import sqlite3
+import logging
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    url TEXT PRIMARY KEY,
+    site_path TEXT,
+    state TEXT,
+    fetched_at REAL,
+    etag TEXT,
+    last_modified TEXT,
+    content_hash TEXT,
+    doc_links TEXT,
+    page_links TEXT
+);
+CREATE TABLE IF NOT EXISTS lastmods (
+    url TEXT PRIMARY KEY,
+    lastmod TEXT
+);
+"""
+
+class CrawlState:
+    def __init__(self, path, revisit_hours=0, state_revisit_hours=None, commit_every=100):
+        # An empty path keeps the state in memory only, so every page is fetched and nothing is carried over to the next run
+        self.path = path or ":memory:"
+        self.revisit_hours = revisit_hours
+        self.state_revisit_hours = state_revisit_hours or {}
+        self.commit_every = commit_every
+        self.uncommitted = 0
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # Shards of a sharded crawl share the same database, so wait on another process's write rather than failing straight away
+        self.db = sqlite3.connect(self.path, timeout=30)
+        self.db.row_factory = sqlite3.Row
+        if self.path != ":memory:":
+            self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        logger.info(f"[Crawl State] Opened {self.path} with {len(self)} pages")
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+
+    # Look up a page's stored state, with its link lists decoded, or None if it has never been crawled
+    def get(self, url):
+        row = self.db.execute("SELECT * FROM pages WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        page = dict(row)
+        page["doc_links"] = json.loads(page["doc_links"] or "[]")
+        page["page_links"] = json.loads(page["page_links"] or "[]")
+        return page
+
+    # Check whether a page should be fetched again, from how long ago it was last fetched and its state's revisit interval
+    def is_due(self, page, now=None):
+        if page is None:
+            return True
+        hours = self.state_revisit_hours.get(page["state"], self.revisit_hours)
+        if not hours:
+            return True
+        now = time.time() if now is None else now
+        return now - (page["fetched_at"] or 0) >= hours * 3600
+
+    # Helper function, building the conditional request headers for a page from the validators stored for it
+    def conditional_headers(self, page):
+        headers = {}
+        if page:
+            if page.get("etag"):
+                headers["If-None-Match"] = page["etag"]
+            if page.get("last_modified"):
+                headers["If-Modified-Since"] = page["last_modified"]
+        return headers
+
+    # Store a page's state after it's been fetched, replacing whatever was stored for it before
+    def record(self, url, site_path, state, response, content_hash, doc_links, page_links):
+        etag = response.headers.get(b"ETag")
+        last_modified = response.headers.get(b"Last-Modified")
+        self.db.execute(
+            "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                url,
+                site_path,
+                state,
+                time.time(),
+                etag.decode("latin-1") if etag else None,
+                last_modified.decode("latin-1") if last_modified else None,
+                content_hash,
+                json.dumps(doc_links),
+                json.dumps(page_links)
+            )
+        )
+        self.mark_changed()
+
+    # The last modified date a sitemap or listing gave for a page when it was last fetched, or None
+    def lastmod(self, url):
+        row = self.db.execute("SELECT lastmod FROM lastmods WHERE url = ?", (url,)).fetchone()
+        return row[0] if row else None
+
+    def record_lastmod(self, url, lastmod):
+        self.db.execute("INSERT OR REPLACE INTO lastmods VALUES (?, ?)", (url, lastmod))
+        self.mark_changed()
+
+    # Update a page's fetch time without touching anything else, for pages the server reported as not modified
+    def touch(self, url):
+        self.db.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), url))
+        self.mark_changed()
+
+    # Helper function, committing the database every commit_every changes so an interrupted crawl keeps most of its progress
+    def mark_changed(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+        logger.info(f"[Crawl State] Saved crawl state to {self.path}")
@@ -0,0 +1,77 @@
+# Discovery strategies for finding a state's pages and documents without crawling every page of its site
+#
+# By default the spider starts from a state's start urls and follows every in-scope link recursively. Sites that publish a sitemap or a
+# structured listing of their pages can be discovered from that instead, set per state in the spider's discovery_strategies:
+#
+#   {"type": "sitemap", "url": ".../sitemap.xml"}
+#       A sitemap or sitemap index (optionally gzipped). Every in-scope page it lists is fetched without following its links, and pages whose
+#       <lastmod> hasn't changed since the last crawl aren't fetched at all; their documents are replayed from the crawl state instead
+#   {"type": "listing", "url": "..."}
+#       An HTML page listing the state's manuals; its documents and the in-scope pages it links to are collected, one level deep
+#   {"type": "listing", "url": "...", "format": "json", "entries": "data.items", "url_key": "url", "lastmod_key": "modified"}
+#       A JSON endpoint listing pages and documents, found at the dotted path in entries, each with a url and optionally a last modified
+#       date, handled the same way as a sitemap's entries
+#
+# If a strategy's url can't be fetched or lists nothing in scope, the state falls back to the recursive crawl from its start urls
+import io
+from lxml import etree
+
+STRATEGY_TYPES = ("sitemap", "listing")
+LISTING_FORMATS = ("html", "json")
+
+# Helper function, checking a state's strategy, filling in the defaults for a listing endpoint
+def parse_strategy(state, spec):
+    if spec.get("type") not in STRATEGY_TYPES:
+        raise ValueError(f"Unknown discovery strategy for {state}: {spec.get('type')!r}; expected one of {', '.join(STRATEGY_TYPES)}")
+    if not spec.get("url"):
+        raise ValueError(f"The {spec['type']} discovery strategy for {state} needs a url")
+    strategy = dict(spec)
+    if strategy["type"] == "listing":
+        strategy.setdefault("format", "html")
+        if strategy["format"] not in LISTING_FORMATS:
+            raise ValueError(f"Unknown listing format for {state}: {strategy['format']!r}; expected one of {', '.join(LISTING_FORMATS)}")
+        strategy.setdefault("entries", "")
+        strategy.setdefault("url_key", "url")
+        strategy.setdefault("lastmod_key", "lastmod")
+    return strategy
+
+# Read a sitemap's entries as ("sitemap", loc, lastmod) for the sitemaps listed by a sitemap index, and ("url", loc, lastmod) for the
+# pages and documents listed by a sitemap, as they're parsed, from the sitemap's XML (gunzipped first if it was fetched gzipped). Each
+# entry's element is dropped once it's read, so a sitemap with tens of thousands of urls never builds the whole tree
+def iter_sitemap(body):
+    # Sitemaps come from the state sites, so don't resolve entities or fetch anything they point to, and keep libxml2's default limits on
+    # text and nesting, which no real sitemap comes near. Only the entries themselves are reported back by the parser, in any namespace
+    # (or none)
+    entries = etree.iterparse(
+        io.BytesIO(body), events=("end",), tag=("{*}url", "{*}sitemap"), resolve_entities=False, no_network=True, recover=True
+    )
+    for _, element in entries:
+        kind = etree.QName(element).localname
+
+        loc, lastmod = None, None
+        for child in element:
+            if not isinstance(child.tag, str):
+                continue
+            name = etree.QName(child).localname
+            if name == "loc":
+                loc = (child.text or "").strip()
+            elif name == "lastmod":
+                lastmod = (child.text or "").strip() or None
+        if loc:
+            yield kind, loc, lastmod
+
+        # Drop the entry, along with the ones already read before it
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+# Read a JSON listing's entries as ("url", url, lastmod), from the list at the strategy's dotted entries path
+def iter_listing(data, strategy):
+    for key in filter(None, strategy["entries"].split(".")):
+        data = data.get(key, []) if isinstance(data, dict) else []
+    for entry in data if isinstance(data, list) else []:
+        if isinstance(entry, str):
+            yield "url", entry, None
+        elif isinstance(entry, dict) and entry.get(strategy["url_key"]):
+            lastmod = entry.get(strategy["lastmod_key"])
+            yield "url", str(entry[strategy["url_key"]]), str(lastmod) if lastmod else None
@@ -0,0 +1,124 @@
+# Text extraction for the policy documents, so a manual is only treated as changed when its text changes
+#
+# A PDF's bytes change whenever it's re-exported, even if not a word of it did (a new producer timestamp, document id or embedded metadata),
+# so comparing byte hashes alone flags those as new versions. With text extraction enabled, the text of every PDF and .docx file is pulled
+# out page by page (sections, for .docx files, split at each heading), normalized and hashed. A file whose bytes changed but whose text
+# didn't keeps the version already stored; one whose text did change gets a summary of which pages changed in the metadata tables.
+# Extraction runs in a pool of worker processes, since parsing a large PDF is CPU-bound and would hold up the crawl on any thread
+#
+# Each object's text is extracted at most once. The full text and page hashes are stored next to the object in the s3 bucket, as
+# objects/<SHA-256>.text.json, and the text index keeps every object's text hash and page hashes for comparing against later versions
+import io
+import re
+import hashlib
+import difflib
+import unicodedata
+from urllib.parse import urlparse
+
+# Characters of each page's hash kept in the text index; enough to tell pages apart, without the index growing with every page's full hash
+PAGE_HASH_LENGTH = 16
+
+WHITESPACE = re.compile(r"\s+")
+
+# Helper function, the extension of a document's url, without any query string or fragment
+def document_extension(url):
+    path = urlparse(url).path.lower()
+    return path.rsplit(".", 1)[-1] if "." in path.rsplit("/", 1)[-1] else ""
+
+def derivative_key(file_hash):
+    return f"objects/{file_hash}.text.json"
+
+# Helper function, normalizing extracted text so layout and encoding differences between exports don't count as changes; compatibility
+# characters are folded (ligatures, non-breaking spaces), runs of whitespace collapsed, and blank lines dropped
+def normalize_text(text):
+    text = unicodedata.normalize("NFKC", text)
+    lines = (WHITESPACE.sub(" ", line).strip() for line in text.splitlines())
+    return "\n".join(line for line in lines if line)
+
+def extract_pdf_pages(body):
+    from pypdf import PdfReader
+    reader = PdfReader(io.BytesIO(body))
+    return [page.extract_text() or "" for page in reader.pages]
+
+# .docx files have no pages, so they're split into sections at every heading; tables are kept with the section they're in
+def extract_docx_sections(body):
+    import docx
+    from docx.table import Table
+    from docx.text.paragraph import Paragraph
+    document = docx.Document(io.BytesIO(body))
+    sections = [[]]
+    for block in document.element.body.iterchildren():
+        tag = block.tag.rsplit("}", 1)[-1]
+        if tag == "p":
+            paragraph = Paragraph(block, document)
+            if paragraph.style is not None and paragraph.style.name.startswith("Heading") and sections[-1]:
+                sections.append([])
+            sections[-1].append(paragraph.text)
+        elif tag == "tbl":
+            table = Table(block, document)
+            for row in table.rows:
+                sections[-1].append(" | ".join(cell.text for cell in row.cells))
+    return ["\n".join(section) for section in sections if section]
+
+# Extractors for each supported extension, along with what their parts are called in change summaries
+EXTRACTORS = {
+    "pdf": (extract_pdf_pages, "page"),
+    "docx": (extract_docx_sections, "section")
+}
+
+# Run in a worker process; extracts a document's normalized text, returning it with the hash of each page and of the text as a whole
+def extract_derivative(body, extension):
+    extract, unit = EXTRACTORS[extension]
+    pages = [normalize_text(page) for page in extract(body)]
+    page_hashes = [hashlib.sha256(page.encode("utf-8")).hexdigest() for page in pages]
+    return {
+        "unit": unit,
+        "pages": pages,
+        "page_hashes": page_hashes,
+        "text_sha256": hashlib.sha256("\n".join(page_hashes).encode("utf-8")).hexdigest()
+    }
+
+# Helper function, the text index's entry for a derivative: its text hash and shortened page hashes
+def text_index_entry(derivative):
+    return {
+        "unit": derivative["unit"],
+        "text_sha256": derivative["text_sha256"],
+        "page_hashes": [page_hash[:PAGE_HASH_LENGTH] for page_hash in derivative["page_hashes"]]
+    }
+
+# Helper function, describing which pages changed between two versions of a document from their page hashes, e.g.
+# "pages 3-4, 9 changed; page 12 added". Pages are lined up the way diff lines up lines, so a page inserted near the start doesn't
+# count every page after it as changed; page numbers are the new version's, or the old version's for removed pages
+def summarize_page_changes(old_hashes, new_hashes, unit="page"):
+    old_hashes = [page_hash[:PAGE_HASH_LENGTH] for page_hash in old_hashes]
+    new_hashes = [page_hash[:PAGE_HASH_LENGTH] for page_hash in new_hashes]
+    changed, added, removed = [], [], []
+    for op, i1, i2, j1, j2 in difflib.SequenceMatcher(None, old_hashes, new_hashes, autojunk=False).get_opcodes():
+        if op == "replace":
+            paired = min(i2 - i1, j2 - j1)
+            changed.extend(range(j1 + 1, j1 + paired + 1))
+            added.extend(range(j1 + paired + 1, j2 + 1))
+            removed.extend(range(i1 + paired + 1, i2 + 1))
+        elif op == "insert":
+            added.extend(range(j1 + 1, j2 + 1))
+        elif op == "delete":
+            removed.extend(range(i1 + 1, i2 + 1))
+
+    parts = []
+    for pages, verb in [(changed, "changed"), (added, "added"), (removed, "removed")]:
+        if pages:
+            parts.append(f"{unit}{'s' if len(pages) > 1 else ''} {page_ranges(pages)} {verb}")
+    return "; ".join(parts) or "no text changes"
+
+# Helper function, collapsing sorted page numbers into ranges, e.g. [1, 2, 3, 7] -> "1-3, 7"
+def page_ranges(pages):
+    ranges = []
+    start = previous = pages[0]
+    for page in pages[1:] + [None]:
+        if page is not None and page == previous + 1:
+            previous = page
+            continue
+        ranges.append(f"{start}-{previous}" if previous > start else str(start))
+        if page is not None:
+            start = previous = page
+    return ", ".join(ranges)
@@ -0,0 +1,247 @@
+# HTTP cache storage for development and replay runs, so iterating on the spider doesn't mean downloading every state site and manual again
+#
+# Responses are indexed in a SQLite database by request fingerprint, with their bodies kept next to it as content-addressed files under
+# objects/<hash[:2]>/<hash>: HTML and other text is gzipped, while documents are kept as they are (they're compressed already) and read
+# back in one go without decompressing them. Bodies aren't mapped into memory, since scrapy responses need their body as bytes and would
+# copy a mapping out anyway. A body shared by several responses (the same form linked from every state, or a page
+# served at several urls) is stored once. The cache is kept under a size limit by evicting the least recently used responses, and entries
+# expire after HTTPCACHE_EXPIRATION_SECS, or a per-domain interval from HTTPCACHE_DOMAIN_EXPIRATION_SECS. With HTTPCACHE_OFFLINE set, the
+# crawl is replayed from the cache alone: nothing expires, and any request that isn't cached is ignored instead of being downloaded.
+# 304 Not Modified responses are never stored; they'd replace the full response cached for the same request (conditional headers aren't
+# part of the fingerprint), and leave replays with an empty body
+#
+# Usage: HTTPCACHE_ENABLED = True with HTTPCACHE_STORAGE = "medscraper.httpcache.ContentCacheStorage" (see settings.py); the cache is
+# shared by every spider and by the shards of a sharded crawl
+import os
+import gzip
+import time
+import sqlite3
+import hashlib
+import logging
+from urllib.parse import urlparse
+from scrapy.exceptions import IgnoreRequest
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+from scrapy.utils.project import data_path
+from w3lib.http import headers_dict_to_raw, headers_raw_to_dict
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    fingerprint TEXT PRIMARY KEY,
+    url TEXT,
+    domain TEXT,
+    status INTEGER,
+    response_url TEXT,
+    headers BLOB,
+    body_hash TEXT,
+    stored_at REAL,
+    accessed_at REAL
+);
+CREATE INDEX IF NOT EXISTS responses_body_hash ON responses (body_hash);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+CREATE TABLE IF NOT EXISTS objects (
+    hash TEXT PRIMARY KEY,
+    compressed INTEGER,
+    size INTEGER
+);
+"""
+
+# Content types stored gzipped; anything else is stored as it is
+COMPRESSED_TYPES = (b"text/", b"application/xhtml+xml", b"application/xml", b"application/json", b"application/javascript")
+
+# gzip level for text bodies; replays decompress every page, so this favours speed over the last few percent of size
+COMPRESS_LEVEL = 6
+
+# Once over the size limit, responses are evicted until the cache is back under this fraction of it, so eviction doesn't run on every store
+EVICTION_TARGET = 0.9
+
+class ContentCacheStorage:
+    def __init__(self, settings):
+        self.cachedir = data_path(settings["HTTPCACHE_DIR"])
+        self.expiration_secs = settings.getint("HTTPCACHE_EXPIRATION_SECS")
+        self.domain_expiration_secs = settings.getdict("HTTPCACHE_DOMAIN_EXPIRATION_SECS")
+        self.max_size = settings.getint("HTTPCACHE_MAX_SIZE")
+        self.offline = settings.getbool("HTTPCACHE_OFFLINE")
+        self.commit_every = 100
+        self.uncommitted = 0
+        # A policy other than DummyPolicy can decide a cached response is stale and send the request anyway, which a replay mustn't do
+        if self.offline and not settings.get("HTTPCACHE_POLICY", "").endswith("DummyPolicy"):
+            raise ValueError("HTTPCACHE_OFFLINE replays need HTTPCACHE_POLICY = 'scrapy.extensions.httpcache.DummyPolicy'")
+        self.db = None
+        self.size = 0
+        self.stats = None
+        self.fingerprinter = None
+
+    def open_spider(self, spider):
+        os.makedirs(os.path.join(self.cachedir, "objects"), exist_ok=True)
+        path = os.path.join(self.cachedir, "index.sqlite3")
+        # The shards of a sharded crawl share the cache, so wait on another process's write rather than failing straight away
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.size = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+        self.stats = spider.crawler.stats
+        self.fingerprinter = spider.crawler.request_fingerprinter
+        entries = self.db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        logger.info(f"[HTTP Cache] Opened {path} with {entries} responses in {self.size / 1024 ** 2:.1f} MB{' (offline replay)' if self.offline else ''}")
+        self.evict()
+
+    def close_spider(self, spider):
+        self.commit()
+        self.db.close()
+
+    def retrieve_response(self, spider, request):
+        fingerprint = self.fingerprinter.fingerprint(request).hex()
+        row = self.db.execute(
+            "SELECT domain, status, response_url, headers, body_hash, stored_at FROM responses WHERE fingerprint = ?", (fingerprint,)
+        ).fetchone()
+        if row is not None and not self.offline and self.is_expired(row[0], row[5]):
+            self.stats.inc_value("httpcache/expired", spider=spider)
+            row = None
+        if row is None:
+            if self.offline:
+                self.stats.inc_value("httpcache/offline_miss", spider=spider)
+                raise IgnoreRequest(f"Not in the HTTP cache, and replaying offline: {request}")
+            return None
+
+        _, status, url, raw_headers, body_hash, _ = row
+        body = self.read_body(body_hash)
+        if body is None:
+            # The body was removed from under the index (e.g. by hand); treat the response as missing so it's downloaded and stored again
+            self.db.execute("DELETE FROM responses WHERE fingerprint = ?", (fingerprint,))
+            self.mark_changed()
+            return None
+        self.db.execute("UPDATE responses SET accessed_at = ? WHERE fingerprint = ?", (time.time(), fingerprint))
+        self.mark_changed()
+
+        headers = Headers(headers_raw_to_dict(raw_headers))
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        if response.status == 304:
+            return
+        fingerprint = self.fingerprinter.fingerprint(request).hex()
+        body_hash = hashlib.sha256(response.body).hexdigest()
+        stored = self.db.execute("SELECT compressed, size FROM objects WHERE hash = ?", (body_hash,)).fetchone()
+        # A body whose file has gone missing is written again
+        if stored is not None and not os.path.exists(self.body_path(body_hash, stored[0])):
+            self.db.execute("DELETE FROM objects WHERE hash = ?", (body_hash,))
+            self.size -= stored[1]
+            stored = None
+        if stored is None:
+            compressed = self.is_compressible(response)
+            size = self.write_body(body_hash, response.body, compressed)
+            self.db.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)", (body_hash, int(compressed), size))
+            self.size += size
+        else:
+            self.stats.inc_value("httpcache/deduplicated", spider=spider)
+
+        # Replacing a response may leave the body it had before unused
+        previous = self.db.execute("SELECT body_hash FROM responses WHERE fingerprint = ?", (fingerprint,)).fetchone()
+        now = time.time()
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (fingerprint, request.url, domain_of(request.url), response.status, response.url, headers_dict_to_raw(response.headers),
+             body_hash, now, now)
+        )
+        if previous is not None and previous[0] != body_hash:
+            self.release_body(previous[0])
+        self.mark_changed()
+
+        if self.max_size and self.size > self.max_size:
+            self.evict()
+
+    # Helper function, checking a cached response's age against its domain's expiration interval (0 for never expiring); a domain without
+    # an interval of its own uses its parent domain's, e.g. an interval for scdhhs.gov covers www1.scdhhs.gov and img1.scdhhs.gov
+    def is_expired(self, domain, stored_at):
+        expiration = self.expiration_secs
+        labels = domain.split(".")
+        for i in range(len(labels)):
+            parent = ".".join(labels[i:])
+            if parent in self.domain_expiration_secs:
+                expiration = int(self.domain_expiration_secs[parent])
+                break
+        return 0 < expiration < time.time() - stored_at
+
+    def is_compressible(self, response):
+        content_type = response.headers.get(b"Content-Type", b"").lower()
+        return content_type.startswith(COMPRESSED_TYPES)
+
+    def body_path(self, body_hash, compressed):
+        return os.path.join(self.cachedir, "objects", body_hash[:2], body_hash + (".gz" if compressed else ""))
+
+    # Helper function, writing a body to its content-addressed file, returning its size on disk; it's written to a temporary file and
+    # moved into place, so another process never reads half a body
+    def write_body(self, body_hash, body, compressed):
+        path = self.body_path(body_hash, compressed)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = gzip.compress(body, compresslevel=COMPRESS_LEVEL, mtime=0) if compressed else body
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    # Helper function, reading a body back, or None if its file is missing
+    def read_body(self, body_hash):
+        row = self.db.execute("SELECT compressed FROM objects WHERE hash = ?", (body_hash,)).fetchone()
+        if row is None:
+            return None
+        try:
+            with open(self.body_path(body_hash, row[0]), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        return gzip.decompress(data) if row[0] else data
+
+    # Helper function, removing a body once no cached response uses it anymore
+    def release_body(self, body_hash):
+        if self.db.execute("SELECT 1 FROM responses WHERE body_hash = ? LIMIT 1", (body_hash,)).fetchone():
+            return
+        row = self.db.execute("SELECT compressed, size FROM objects WHERE hash = ?", (body_hash,)).fetchone()
+        if row is None:
+            return
+        self.db.execute("DELETE FROM objects WHERE hash = ?", (body_hash,))
+        self.size -= row[1]
+        try:
+            os.remove(self.body_path(body_hash, row[0]))
+        except FileNotFoundError:
+            pass
+
+    # Evict the least recently used responses until the cache is back under its size limit; bodies still used by other responses stay
+    def evict(self):
+        if not self.max_size or self.size <= self.max_size:
+            return
+        target = self.max_size * EVICTION_TARGET
+        evicted = 0
+        while self.size > target:
+            rows = self.db.execute("SELECT fingerprint, body_hash FROM responses ORDER BY accessed_at LIMIT 100").fetchall()
+            if not rows:
+                break
+            for fingerprint, body_hash in rows:
+                self.db.execute("DELETE FROM responses WHERE fingerprint = ?", (fingerprint,))
+                self.release_body(body_hash)
+                evicted += 1
+                if self.size <= target:
+                    break
+        self.commit()
+        if self.stats is not None:
+            self.stats.inc_value("httpcache/evicted", evicted)
+        logger.info(f"[HTTP Cache] Evicted {evicted} least recently used responses; now {self.size / 1024 ** 2:.1f} MB")
+
+    # Helper function, committing the index every commit_every changes so an interrupted crawl keeps most of what it cached
+    def mark_changed(self):
+        self.uncommitted += 1
+        if self.uncommitted >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        self.db.commit()
+        self.uncommitted = 0
+
+# Helper function, the host a url points at, in lower case
+def domain_of(url):
+    return (urlparse(url).hostname or "").lower()
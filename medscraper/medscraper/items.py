@@ -2,16 +2,52 @@
 #
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/items.html
-from scrapy.item import Item, Field
-from itemloaders.processors import TakeFirst
+#
+# Packages are plain slotted dataclasses rather than scrapy Items filled through an ItemLoader; the spider yields one for every page it
+# crawls, and building them through a loader (a processor chain per field, and a new timestamp string every time) cost more than the rest
+# of handling a page with no documents. Scrapy and the pipeline handle them through itemadapter like any other item
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+
+TIMESTAMP_FORMAT = "%m/%d/%Y %I:%M:%S %p"
+
+@dataclass(slots=True, eq=False)
+class PolicyManualsPackage:
+    file_urls: list = field(default_factory=list)
+    files: list = field(default_factory=list)
+    package_retrieval_date: str = None
+    package_last_checked: str = None
+    package_site_path: str = None
+    package_file_count: int = None
+    package_state: str = None
+    # Text changes found in the package's new and changed files, keyed by file url, e.g. {url: "pages 3-4 changed"}; only set with text
+    # extraction enabled, and summarized in the master table for each row's own files
+    package_changes: dict = None
+    # How many links the package's page is from a start url; used to prioritize its downloads, not stored in the metadata tables
+    package_depth: int = 0
+
+# The timestamp is only formatted again once the second it shows has passed, since a crawl builds many packages every second
+_timestamp = (None, None)
+
+def current_timestamp():
+    global _timestamp
+    second = int(time.time())
+    if _timestamp[0] != second:
+        _timestamp = (second, datetime.fromtimestamp(second).strftime(TIMESTAMP_FORMAT))
+    return _timestamp[1]
 
-class PolicyManualsPackage(Item):
-    # define the fields for your item here like:
-    file_urls = Field()
-    files = Field()
-    package_retrieval_date = Field(output_processor=TakeFirst())
-    package_last_checked = Field(output_processor=TakeFirst())
-    package_site_path = Field(output_processor=TakeFirst())
-    package_file_count = Field(output_processor=TakeFirst())
-    package_state = Field(output_processor=TakeFirst())
-    pass
+# Function for populating the item for a site's package of files
+def load_package(site_path, state, file_urls, depth=0):
+    # Generate a timestamp for when these files and metadata were retrieved
+    timestamp = current_timestamp()
+    # A package representing a package of files and its metadata downloaded from a particular url, and how deep into the site it is
+    return PolicyManualsPackage(
+        file_urls=list(file_urls),
+        package_retrieval_date=timestamp,
+        package_last_checked=timestamp,
+        package_site_path=site_path,
+        package_file_count=len(file_urls),
+        package_state=state,
+        package_depth=depth
+    )
@@ -0,0 +1,116 @@
+# Write-ahead journal of the pipeline's changes to the metadata tables and manifests, so a crawl that dies partway loses none of them
+#
+# The master table and the manifests are kept in memory for the whole crawl and only written back out every so often (see metadata.py),
+# so a crawl that's killed between writes used to lose every record and hash recorded since the last one, and download and upload those
+# documents all over again on the next run. Every record merged into the master table and every change to a manifest is now appended to
+# the journal first, one JSON line each. Whenever the tables are written out, the journal is checkpointed: the segment being appended to
+# is sealed and a new one started, and once the tables and manifests holding everything in the sealed segments are stored, those segments
+# are deleted. A crawl starting with segments left over from one that died replays them into the freshly loaded tables and manifests, and
+# writes the result straight back out before crawling anything. Replaying is idempotent (records already in the master table only touch
+# the rows they match, and manifest changes set the same values again), so a crawl dying partway through a checkpoint loses nothing either
+#
+# Segments are flushed to the operating system after every entry, so they survive the crawl process being killed, and synced to disk when
+# they're sealed
+import os
+import json
+import logging
+from medscraper.shards import shard_path
+
+logger = logging.getLogger(__name__)
+
+# Helper function, the directory a crawl's journal is kept in: its JOBDIR when it has one, so a resumed job finds it, or else
+# METADATA_JOURNAL_DIR, under the shard's own folder for a shard of a sharded crawl (crawl_sharded gives every shard its own JOBDIR)
+def journal_dir(settings, shard=None):
+    jobdir = settings.get('JOBDIR')
+    if jobdir:
+        return os.path.join(jobdir, "metadata_journal")
+    directory = settings.get('METADATA_JOURNAL_DIR')
+    return shard_path(directory, shard) if shard else directory
+
+class CrawlJournal:
+    def __init__(self, directory):
+        self.directory = directory
+        self.file = None
+        self.segment = 0
+        # Segments left over from an earlier crawl, waiting to be replayed
+        self.recovered = []
+        self.entries = 0
+
+    # Helper function, the path of a numbered segment; segments are replayed in the order of their numbers
+    def segment_path(self, segment):
+        return os.path.join(self.directory, f"{segment:08d}.wal")
+
+    def segments(self):
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(int(name[:-4]) for name in os.listdir(self.directory) if name.endswith(".wal") and name[:-4].isdigit())
+
+    # Open a new segment to append to, after any left over from an earlier crawl
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self.recovered = self.segments()
+        self.segment = self.recovered[-1] + 1 if self.recovered else 1
+        self.file = open(self.segment_path(self.segment), "a", encoding="utf-8")
+        if self.recovered:
+            logger.info(f"[Journal] Found {len(self.recovered)} segments left over from an earlier crawl in {self.directory}")
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def append(self, entry):
+        self.file.write(json.dumps(entry, separators=(",", ":"), default=str) + "\n")
+        self.file.flush()
+        self.entries += 1
+
+    # Journal a metadata record, before it's merged into the master table
+    def record(self, record):
+        self.append({"record": record})
+
+    # Journal a manifest entry's new value, by the manifest's key in the s3 bucket
+    def manifest_set(self, manifest_key, name, value):
+        self.append({"manifest": manifest_key, "name": name, "value": value})
+
+    # Read back every entry in the leftover segments, in the order they were written; a line cut short by the crawl dying mid-write is
+    # the last one written, and is skipped
+    def replay(self):
+        for segment in self.recovered:
+            with open(self.segment_path(segment), "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"[Journal] Skipping a partly written entry at the end of {self.segment_path(segment)}")
+
+    # Seal the segment being appended to and start a new one, returning the number of the last sealed segment; everything journaled up to
+    # now is in that segment or earlier ones
+    def seal(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        sealed = self.segment
+        self.segment += 1
+        self.file = open(self.segment_path(self.segment), "a", encoding="utf-8")
+        return sealed
+
+    # Delete every segment up to and including the given one, once everything journaled in them is stored in the tables and manifests;
+    # leftover segments are kept until they've been replayed in full (see replayed)
+    def discard(self, upto):
+        for segment in self.segments():
+            if segment <= upto and segment not in self.recovered:
+                os.remove(self.segment_path(segment))
+
+    # Mark the leftover segments as replayed, so the next checkpoint removes them along with this crawl's own
+    def replayed(self):
+        self.recovered = []
+
+    # Remove the journal once the crawl has stored everything it recorded, leftover segments included
+    def clear(self):
+        self.close()
+        self.replayed()
+        self.discard(self.segment)
+        try:
+            os.rmdir(self.directory)
+        except OSError:
+            pass
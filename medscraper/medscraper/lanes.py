@@ -0,0 +1,133 @@
+# Scheduling lanes for splitting page crawling from document downloading
+#
+# Pages go through scrapy's scheduler as usual, prioritized by how many links they are from a start url. Documents bypass the scheduler
+# (the files pipeline hands them straight to the downloader), so they get a lane of their own: a bounded number of document downloads
+# in flight at once, with queued documents released in priority order, and a download slot per host separate from the host's pages,
+# so a few huge files can't hold up page discovery and a burst of new pages can't hold up the files
+#
+# Every document is fetched at most once per crawl, however many pages link to it; the packages found after the first attach to its fetch
+# through the document registry, waiting for it if it's still in flight, instead of downloading the same file again
+#
+# In discovery-only mode, documents aren't downloaded at all; each package of files is written to a JSON lines document frontier instead,
+# for the documents spider to download in a separate run
+import os
+import json
+import heapq
+import itertools
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+from w3lib.url import canonicalize_url
+from itemadapter import ItemAdapter
+
+# Download slot used for a host's documents, next to the host's own slot used for its pages
+def document_slot(host):
+    return f"{host}/documents"
+
+class DownloadLane:
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = max(1, concurrency)
+        self.active = 0
+        self.queue = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.queue)
+
+    # Wait for room in the lane, returning a Deferred that fires once the caller may start; queued callers are let through highest
+    # priority first, and in the order they arrived for equal priorities
+    def acquire(self, priority=0):
+        d = Deferred()
+        if self.active < self.concurrency:
+            self.active += 1
+            d.callback(None)
+        else:
+            heapq.heappush(self.queue, (-priority, next(self.counter), d))
+        return d
+
+    # Free up the caller's place in the lane, handing it straight to the next queued caller if there is one
+    def release(self):
+        if self.queue:
+            _, _, d = heapq.heappop(self.queue)
+            d.callback(None)
+        else:
+            self.active = max(0, self.active - 1)
+
+class DocumentRegistry:
+    def __init__(self):
+        # Outcome of every finished fetch (the file's result, or the Failure it ended with), and the callers waiting on every fetch still in
+        # flight, both keyed by canonical url
+        self.completed = {}
+        self.in_flight = {}
+
+    def __len__(self):
+        return len(self.completed) + len(self.in_flight)
+
+    # Claim a document for fetching. Returns None if nobody has fetched it yet, in which case the caller fetches it and passes the outcome
+    # to resolve; otherwise returns a Deferred firing with the outcome of the fetch already made (or failing with its Failure)
+    def claim(self, url):
+        key = canonicalize_url(url)
+        if key in self.completed:
+            d = Deferred()
+            self.fire(d, self.completed[key])
+            return d
+        if key in self.in_flight:
+            d = Deferred()
+            self.in_flight[key].append(d)
+            return d
+        self.in_flight[key] = []
+        return None
+
+    # Record the outcome of a claimed document's fetch and pass it on to everyone waiting on it; later outcomes for the same url are ignored
+    def resolve(self, url, outcome):
+        key = canonicalize_url(url)
+        waiters = self.in_flight.pop(key, None)
+        if waiters is None:
+            return
+        if isinstance(outcome, Failure):
+            outcome.cleanFailure()
+        self.completed[key] = outcome
+        for d in waiters:
+            self.fire(d, outcome)
+
+    def fire(self, d, outcome):
+        if isinstance(outcome, Failure):
+            d.errback(outcome)
+        else:
+            d.callback(outcome)
+
+class DocumentFrontierWriter:
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.packages = 0
+        self.documents = 0
+
+    def open(self):
+        # Write to a temporary file and only move it into place once the crawl is done, so a worker never reads a half-written frontier
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.file = open(self.path + ".tmp", "w", encoding="utf-8")
+
+    # Write one package of files found on a page, keeping what's needed to build its item again in the documents spider
+    def add(self, item):
+        adapter = ItemAdapter(item)
+        record = {
+            "package_site_path": adapter.get("package_site_path"),
+            "package_state": adapter.get("package_state"),
+            "package_depth": adapter.get("package_depth") or 0,
+            "file_urls": list(adapter.get("file_urls") or [])
+        }
+        self.file.write(json.dumps(record) + "\n")
+        self.packages += 1
+        self.documents += len(record["file_urls"])
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            os.replace(self.path + ".tmp", self.path)
+            self.file = None
+
+# Helper function, reading the packages written to a document frontier, with the packages closest to the start urls first
+def read_document_frontier(body):
+    packages = [json.loads(line) for line in body.decode("utf-8").splitlines() if line.strip()]
+    return sorted(packages, key=lambda package: package.get("package_depth", 0))
@@ -0,0 +1,118 @@
+# Persistent JSON manifests used by the pipeline to remember per-document state between crawls
+#
+# Each manifest is a flat dict kept in a compact JSON object in the s3 bucket, and mirrored to a local file under doc-data/
+# so the latest copy is still available when the bucket can't be reached
+import os
+import json
+import logging
+from botocore.exceptions import ClientError
+from medscraper.clients import is_not_found
+
+logger = logging.getLogger(__name__)
+
+class Manifest:
+    def __init__(self, s3_client, s3_bucket, key, local_path, seed_key=None):
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.key = key
+        self.local_path = local_path
+        # Manifest to start from when this one doesn't exist yet, e.g. the shared manifest for a shard's own copy
+        self.seed_key = seed_key
+        self.entries = {}
+        self.dirty = False
+        # Write-ahead journal every change is appended to before the manifest is next saved, if the crawl keeps one (see journal.py)
+        self.journal = None
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, name, default=None):
+        return self.entries.get(name, default)
+
+    def set(self, name, value):
+        # Only mark the manifest as changed if the stored value actually differs, so unchanged crawls never rewrite it
+        if self.entries.get(name) != value:
+            if self.journal is not None:
+                self.journal.manifest_set(self.key, name, value)
+            self.entries[name] = value
+            self.dirty = True
+
+    def load(self):
+        # Fetch the manifest from the s3 bucket if it exists, falling back to the seed manifest and then the local mirror only if it doesn't.
+        # Any other error (access denied, throttling, the bucket failing) is raised, since carrying on with fewer entries than the bucket holds
+        # would overwrite it with them on the next save
+        entries = self.fetch(self.key)
+        if entries is not None:
+            self.entries = entries
+            logger.info(f"[Manifest] Loaded {len(self.entries)} entries from s3://{self.s3_bucket}/{self.key}")
+            return self
+
+        if self.seed_key is not None:
+            entries = self.fetch(self.seed_key)
+            if entries is not None:
+                self.entries = entries
+                logger.info(f"[Manifest] Seeded {len(self.entries)} entries from s3://{self.s3_bucket}/{self.seed_key}")
+                return self
+
+        if os.path.exists(self.local_path):
+            with open(self.local_path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+            # The bucket is missing entries the local mirror has, so make sure they get written back on the next save
+            self.dirty = bool(self.entries)
+            logger.info(f"[Manifest] Loaded {len(self.entries)} entries from {self.local_path}")
+        return self
+
+    # Helper function, reading a manifest's entries from the s3 bucket, or None if there's no manifest at the key
+    def fetch(self, key):
+        try:
+            obj = self.s3_client.get_object(Bucket=self.s3_bucket, Key=key)
+        except ClientError as e:
+            if not is_not_found(e):
+                raise
+            logger.info(f"[Manifest] No manifest at s3://{self.s3_bucket}/{key}")
+            return None
+        return json.loads(obj["Body"].read())
+
+    def save(self, force=False):
+        return self.write(self.checkpoint(force))
+
+    # Take a copy of the entries to save, or None if nothing changed since the last save. The copy is taken on the reactor thread, so the
+    # crawl can keep changing the manifest while the copy is written out on a worker thread; values are always replaced, never changed in place
+    def checkpoint(self, force=False):
+        if not (self.dirty or force):
+            return None
+        self.dirty = False
+        return dict(self.entries)
+
+    # Write a copy of the entries taken by checkpoint to the local mirror and the s3 bucket, returning whether it's stored in the bucket
+    def write(self, entries):
+        # Nothing to write if no entries were changed during this crawl
+        if entries is None:
+            return True
+
+        body = json.dumps(entries, separators=(",", ":"), sort_keys=True)
+
+        # Write the local mirror first, going through a temporary file so an interrupted write never leaves a truncated manifest
+        os.makedirs(os.path.dirname(self.local_path), exist_ok=True)
+        tmp_path = self.local_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(body)
+        os.replace(tmp_path, self.local_path)
+
+        try:
+            self.s3_client.put_object(
+                Bucket=self.s3_bucket,
+                Key=self.key,
+                Body=body,
+                ContentType="application/json"
+            )
+            logger.info(f"[Manifest] Saved {len(entries)} entries to s3://{self.s3_bucket}/{self.key}")
+            return True
+        except ClientError as e:
+            # Save it again next time
+            self.dirty = True
+            logger.warning(f"[Manifest] Failed to save s3://{self.s3_bucket}/{self.key}, keeping it to save again: {e}")
+            return False
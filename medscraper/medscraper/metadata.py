@@ -0,0 +1,420 @@
+# In-memory aggregation and storage of the policy document metadata tables
+#
+# The master table is loaded from the s3 bucket once, every package record is merged into it in memory, and the tables are only
+# written back out every flush_interval seconds or flush_items records, and once more when the spider closes. The tables are stored
+# as CSV by default, or as Parquet with native list and timestamp columns, optionally partitioned by state
+#
+# pandas is only imported by the functions that build or read a table, so crawls that never touch the tables (discovery-only crawls,
+# scrapy commands that don't need them) don't spend the time importing it
+import io
+import os
+import ast
+import time
+import logging
+from collections import defaultdict
+from urllib.parse import quote, unquote, urlparse
+from botocore.exceptions import ClientError
+from medscraper.clients import is_not_found
+from medscraper.items import TIMESTAMP_FORMAT
+
+logger = logging.getLogger(__name__)
+
+# Columns of a brand new master table, and the format the spider writes its timestamps in
+MASTER_TABLE_COLUMNS = ["file_urls", "package_state", "package_site_path", "package_file_count", "package_retrieval_date", "package_last_checked"]
+TIMESTAMP_COLUMNS = ["package_retrieval_date", "package_last_checked"]
+# Column added to the master table with text extraction enabled, summarizing the last text changes found in each row's files
+CHANGES_COLUMN = "package_changes"
+
+# Hive's name for the partition holding rows with no state
+NULL_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+class MetadataAggregator:
+    def __init__(self, load_table, merge_record, write_tables, commit_table=None, flush_interval=60, flush_items=100):
+        # Callables for fetching the master table, merging a record into it, adding any rows the merge buffered to it, and writing every
+        # table derived from it
+        self.load_table = load_table
+        self.merge_record = merge_record
+        self.commit_table = commit_table
+        self.write_tables = write_tables
+
+        self.flush_interval = flush_interval
+        self.flush_items = flush_items
+
+        self.master_table = None
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    # Use a master table that was already loaded, instead of fetching it when the first record comes in
+    def set_table(self, master_table):
+        self.master_table = master_table
+
+    def add(self, record):
+        # Fetch the master table the first time a record comes in, then keep working on the same in-memory copy for the rest of the crawl
+        if self.master_table is None:
+            self.master_table = self.load_table()
+
+        self.master_table = self.merge_record(self.master_table, record)
+        self.pending += 1
+
+        # Write the tables back out once enough records or enough time have built up since the last write
+        if self.pending >= self.flush_items or self.is_due():
+            self.flush()
+
+    def is_due(self):
+        return time.monotonic() - self.last_flush >= self.flush_interval
+
+    # Write the tables back out if the flush interval has passed since the last write, for a timer to call while no new records come in
+    def flush_if_due(self):
+        if self.is_due():
+            self.flush()
+
+    # Write the tables back out; forced, they're written even with no new records, e.g. to store them again after a write that failed
+    def flush(self, force=False):
+        # Nothing to write if no records have been merged since the last write
+        if self.master_table is None or not (self.pending or force):
+            return
+
+        if self.commit_table is not None:
+            self.master_table = self.commit_table(self.master_table)
+
+        logger.info(f"[Metadata] Writing metadata tables with {self.pending} new records ({len(self.master_table)} rows)")
+        self.write_tables(self.master_table)
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+
+# Helper function to sanitize incoming data from dataframes/series, so values loaded from CSVs compare equal to freshly scraped ones
+def normalize_value(value):
+    if isinstance(value, str):
+        # Try to parse list-like strings into real lists
+        try:
+            parsed = ast.literal_eval(value)
+            if isinstance(parsed, list):
+                return tuple(parsed)
+        except (ValueError, SyntaxError):
+            pass
+        return value.strip()
+    if isinstance(value, list):
+        return tuple(value)
+    return value
+
+# Helper function, summarizing the text changes found in a row's files from a record's changes by file url, e.g.
+# "manual.pdf: pages 3-4 changed | forms.docx: section 2 changed", or None if none of the row's files changed
+def describe_changes(changes, file_urls):
+    if not isinstance(file_urls, (list, tuple)):
+        return None
+    described = [f"{unquote(urlparse(url).path.split('/')[-1])}: {changes[url]}" for url in file_urls if url in changes]
+    return " | ".join(described) or None
+
+# Helper function, checking a normalized value the way DataFrame.all() does; missing values are skipped, so they count as true
+def is_truthy(value):
+    if value is None or (isinstance(value, float) and value != value):
+        return True
+    return bool(value)
+
+# Helper function, turning a row's normalized values into a dict key; rows holding unhashable values fall back to their repr
+def signature(values):
+    try:
+        hash(values)
+        return values
+    except TypeError:
+        return repr(values)
+
+class MasterTableIndex:
+    # In-memory index over the master table's compared columns, built once per table and kept up to date as rows are appended,
+    # so a record can be matched against the table in time proportional to the record, not the table
+    def __init__(self, table, compare_cols):
+        self.table = table
+        self.compare_cols = list(compare_cols)
+        self.url_pos = self.compare_cols.index("file_urls")
+
+        # Normalized compared values of every row, the rows each file URL appears in, and the rows holding each exact set of values
+        self.rows = {}
+        self.positions = {}
+        self.by_url = defaultdict(set)
+        self.by_signature = defaultdict(list)
+
+        # New rows that haven't been added to the table yet; enlarging a dataframe copies every row already in it, so appended
+        # records are buffered here and added to the table in one go by commit()
+        self.pending = {}
+
+        for label, values in zip(table.index, table[self.compare_cols].itertuples(index=False, name=None)):
+            self.add_row(label, tuple(normalize_value(value) for value in values))
+
+    # Check that the index was built for this table and that no rows were added to it behind the index's back
+    def is_current(self, table, compare_cols):
+        return self.table is table and len(self.rows) == len(table) + len(self.pending) and self.compare_cols == list(compare_cols)
+
+    def add_row(self, label, values):
+        self.rows[label] = values
+        self.positions[label] = len(self.positions)
+        self.by_signature[signature(values)].append(label)
+        for url in self.row_files(values):
+            self.by_url[url].add(label)
+
+    # Helper function, retrieving the set of file URLs in a row's normalized values
+    def row_files(self, values):
+        try:
+            return set(values[self.url_pos])
+        except TypeError:
+            return set()
+
+    # Retrieve every row sharing at least one file URL with the given normalized record, in table order
+    def rows_with_files(self, values):
+        labels = set()
+        for url in self.row_files(values):
+            labels.update(self.by_url.get(url, ()))
+        return sorted(labels, key=self.positions.get)
+
+    # Retrieve every row whose compared values are exactly equal to the given normalized record
+    def find(self, values):
+        return [
+            label for label in self.by_signature.get(signature(values), ())
+            if all(stored == value for stored, value in zip(self.rows[label], values))
+        ]
+
+    # Buffer a new row for the table, holding its values for every one of the table's columns
+    def add_pending(self, label, record):
+        self.pending[label] = {col: record.get(col, float("nan")) for col in self.table.columns}
+        self.add_row(label, tuple(normalize_value(self.pending[label][col]) for col in self.compare_cols))
+
+    # Set a column's value for the given rows, whether they're already in the table or still buffered
+    def set_value(self, labels, col, value):
+        for label in labels:
+            if label in self.pending:
+                self.pending[label][col] = value
+            else:
+                self.table.at[label, col] = value
+
+    # Add every buffered row to the end of the table, returning the enlarged table
+    def commit(self):
+        if self.pending:
+            import pandas as pd
+            new_rows = pd.DataFrame.from_records(list(self.pending.values()), index=list(self.pending.keys()), columns=self.table.columns)
+            self.table = pd.concat([self.table, new_rows]) if len(self.table) else new_rows
+            self.pending = {}
+        return self.table
+
+
+# Helper function, computing the per-state rollups of the master table; total files per state and site path, and total files per state
+def build_rollups(master_table):
+    state_table = master_table.groupby(by = ['package_state', 'package_site_path']).agg({'package_file_count': 'sum'})
+    file_count_table = master_table.groupby('package_state').agg({'package_file_count': 'sum'})
+    return state_table, file_count_table
+
+# Helper function, checking for the missing values groupby drops from its keys and sum skips
+def is_missing(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+class RollupCounters:
+    # Running totals behind the state and file count tables, built from the master table once and then adjusted by every row added to it,
+    # so the rollups never need a full groupby over the master table after the first write
+    def __init__(self):
+        self.by_site = defaultdict(int)
+        self.by_state = defaultdict(int)
+        self.built = False
+
+    def rebuild(self, master_table):
+        self.by_site.clear()
+        self.by_state.clear()
+        columns = [master_table[col] for col in ['package_state', 'package_site_path', 'package_file_count']]
+        for state, site_path, file_count in zip(*columns):
+            self.count(state, site_path, file_count)
+        self.built = True
+
+    # Adjust the totals for a row added to the master table; rows added before the first rebuild are already counted by it
+    def add(self, record):
+        if self.built:
+            self.count(record.get('package_state'), record.get('package_site_path'), record.get('package_file_count'))
+
+    def count(self, state, site_path, file_count):
+        # Mirror groupby; rows missing a key are left out of that key's table, and missing counts add nothing
+        if is_missing(state):
+            return
+        file_count = 0 if is_missing(file_count) else file_count
+        self.by_state[state] += file_count
+        if not is_missing(site_path):
+            self.by_site[(state, site_path)] += file_count
+
+    # Build the state and file count tables from the running totals, laid out exactly like build_rollups' output
+    def tables(self):
+        import pandas as pd
+        site_keys = sorted(self.by_site)
+        state_keys = sorted(self.by_state)
+        state_table = pd.DataFrame(
+            {'package_file_count': [self.by_site[key] for key in site_keys]},
+            index=pd.MultiIndex.from_tuples(site_keys, names=['package_state', 'package_site_path'])
+        )
+        file_count_table = pd.DataFrame(
+            {'package_file_count': [self.by_state[key] for key in state_keys]},
+            index=pd.Index(state_keys, name='package_state')
+        )
+        return state_table, file_count_table
+
+    # Check the running totals against a full recompute from the master table, returning the recomputed tables if they don't match
+    def verify(self, master_table):
+        state_table, file_count_table = self.tables()
+        full_state_table, full_file_count_table = build_rollups(master_table)
+        for incremental, full in [(state_table, full_state_table), (file_count_table, full_file_count_table)]:
+            if len(full) != len(incremental) or not (full.index.equals(incremental.index) and
+                    (full['package_file_count'].astype(float).values == incremental['package_file_count'].astype(float).values).all()):
+                return full_state_table, full_file_count_table
+        return None
+
+# Helper function, converting a table to the column types stored in Parquet; file URLs become real lists and timestamps become datetimes,
+# whether they come from a CSV table, the spider, or an earlier Parquet load
+def to_parquet_types(table):
+    import pandas as pd
+    table = table.copy()
+    if "file_urls" in table:
+        table["file_urls"] = table["file_urls"].map(as_url_list)
+    for col in TIMESTAMP_COLUMNS:
+        if col in table:
+            table[col] = pd.to_datetime(table[col], format=TIMESTAMP_FORMAT)
+    return table
+
+# Helper function, turning a stored file list of any form into a plain list of URLs
+def as_url_list(value):
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    value = normalize_value(value)
+    if isinstance(value, tuple):
+        return list(value)
+    return None if value is None or value != value else [value]
+
+def parquet_bytes(table):
+    buffer = io.BytesIO()
+    table.to_parquet(buffer, index=False, engine="pyarrow")
+    return buffer.getvalue()
+
+def from_parquet_bytes(body):
+    import pandas as pd
+    table = pd.read_parquet(io.BytesIO(body), engine="pyarrow")
+    # Parquet list columns come back as numpy arrays, so turn them back into the lists the rest of the pipeline works with
+    if "file_urls" in table:
+        table["file_urls"] = table["file_urls"].map(as_url_list)
+    return table
+
+# Helper function, writing a local copy of a table through a temporary file moved into place once it's complete, so a crawl dying mid-write
+# leaves the previous copy rather than half of the new one
+def replace_file(path, write):
+    tmp_path = f"{path}.tmp"
+    write(tmp_path)
+    os.replace(tmp_path, path)
+
+class MetadataStore:
+    # Reads and writes the metadata tables in the s3 bucket, mirroring every write to the local doc-data folder
+    def __init__(self, s3_client, s3_bucket, local_dir, table_format="csv", partition_by_state=False, prefix="doc-data"):
+        if table_format not in ("csv", "parquet"):
+            raise ValueError(f"Unknown metadata table format: {table_format!r}; expected 'csv' or 'parquet'")
+        if table_format == "parquet":
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError("Storing the metadata tables as Parquet requires pyarrow; install it with pip install pyarrow")
+
+        self.s3_client = s3_client
+        self.s3_bucket = s3_bucket
+        self.local_dir = local_dir
+        self.table_format = table_format
+        self.partition_by_state = partition_by_state
+        # Folder the tables are kept under in the s3 bucket; sharded crawls keep each shard's tables in a folder of its own
+        self.prefix = prefix
+
+    def key(self, name):
+        return f"{self.prefix}/{name}.{self.table_format}"
+
+    # Only the master table is partitioned; the rollups are a handful of rows per state already
+    def is_partitioned(self, name):
+        return self.table_format == "parquet" and self.partition_by_state and name == "master_table"
+
+    # Fetch a table from the s3 bucket, returning None if it doesn't exist there yet. Any other error (access denied, throttling, the bucket
+    # failing) is raised, since the crawl would otherwise start from an empty table and write it over the real one
+    def load(self, name, states=None):
+        import pandas as pd
+        if self.is_partitioned(name):
+            return self.load_partitions(name, states)
+        try:
+            obj = self.s3_client.get_object(Bucket=self.s3_bucket, Key=self.key(name))
+        except ClientError as e:
+            if not is_not_found(e):
+                raise
+            logger.info(f"[Metadata] No table at s3://{self.s3_bucket}/{self.key(name)}")
+            return None
+        if self.table_format == "csv":
+            table = pd.read_csv(obj['Body'])
+        else:
+            table = from_parquet_bytes(obj['Body'].read())
+
+        # Unpartitioned tables are read whole, so drop the other states' rows here instead
+        if states is not None and "package_state" in table:
+            table = table[table["package_state"].isin(states)].reset_index(drop=True)
+        return table
+
+    # Fetch a partitioned table, reading only the given states' partitions if any are given, or None if it has no partitions yet; a partition
+    # that can't be read fails the whole load, rather than returning the table without its rows
+    def load_partitions(self, name, states=None):
+        prefix = f"{self.prefix}/{name}/"
+        parts = []
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.s3_bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                # Keys look like doc-data/master_table/package_state=South%20Carolina/part-0.parquet
+                partition = obj["Key"][len(prefix):].split("/")[0]
+                state = unquote(partition.split("=", 1)[1])
+                state = None if state == NULL_PARTITION else state
+                if states is not None and state not in states:
+                    continue
+                body = self.s3_client.get_object(Bucket=self.s3_bucket, Key=obj["Key"])["Body"].read()
+                part = from_parquet_bytes(body)
+                part["package_state"] = state
+                parts.append(part)
+
+        if not parts:
+            return None
+        import pandas as pd
+        table = pd.concat(parts, ignore_index=True)
+        # Put the state column back where it is in an unpartitioned table
+        return table[[c for c in MASTER_TABLE_COLUMNS if c in table] + [c for c in table if c not in MASTER_TABLE_COLUMNS]]
+
+    # Write a table to the local doc-data folder and the s3 bucket
+    def save(self, name, table):
+        os.makedirs(self.local_dir, exist_ok=True)
+
+        if self.table_format == "csv":
+            replace_file(os.path.join(self.local_dir, f"{name}.csv"), table.to_csv)
+            csv_buffer = io.StringIO()
+            table.to_csv(csv_buffer, index=False)
+            self.put(self.key(name), csv_buffer.getvalue(), "text/csv")
+            return
+
+        # Keep the rollups' group keys as regular columns, since Parquet files are written without an index
+        if any(level is not None for level in table.index.names):
+            table = table.reset_index()
+        table = to_parquet_types(table)
+
+        if self.is_partitioned(name):
+            for state, part in table.groupby("package_state", dropna=False, sort=False):
+                state = NULL_PARTITION if state != state else quote(str(state))
+                part_name = f"{name}/package_state={state}/part-0.parquet"
+                self.write_parquet(part_name, part.drop(columns="package_state"))
+        else:
+            self.write_parquet(f"{name}.parquet", table)
+
+    def write_parquet(self, path, table):
+        body = parquet_bytes(table)
+        local_path = os.path.join(self.local_dir, *path.split("/"))
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        def write_body(tmp_path):
+            with open(tmp_path, "wb") as f:
+                f.write(body)
+        replace_file(local_path, write_body)
+        self.put(f"{self.prefix}/{path}", body, "application/vnd.apache.parquet")
+
+    def put(self, key, body, content_type):
+        self.s3_client.put_object(
+            Bucket=self.s3_bucket,
+            Key=key,
+            Body=body,
+            ContentType=content_type
+        )
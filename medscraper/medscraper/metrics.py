@@ -0,0 +1,252 @@
+# Timing and size histograms for the crawl's hot paths: parsing pages, downloading from each site, hashing files, s3 requests, and merging
+# records into the metadata tables
+#
+# Metrics are only collected with METRICS_ENABLED set; otherwise every crawler shares a NullMetrics whose methods do nothing, so the
+# instrumented code costs no more than a method call. When enabled, each histogram's count, sum, percentiles and max are copied into the
+# crawl stats at the end of the crawl, and the full histograms are written to METRICS_EXPORT_PATH as Prometheus text, or as a JSON
+# summary if the path ends in .json
+import io
+import os
+import json
+import time
+import bisect
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+INF = float("inf")
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, INF)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000, INF)
+BYTES_BUCKETS = (1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2, 256 * 1024 ** 2, INF)
+
+# Every histogram collected, with its buckets and description
+HISTOGRAMS = {
+    "parse_seconds": (SECONDS_BUCKETS, "Time spent parsing a page for links, excluding scheduling the pages it links to"),
+    "page_document_links": (COUNT_BUCKETS, "Document links found on a page"),
+    "page_links": (COUNT_BUCKETS, "In-scope page links found on a page"),
+    "download_latency_seconds": (SECONDS_BUCKETS, "Time from sending a request to receiving its response headers, per download slot"),
+    "hash_seconds": (SECONDS_BUCKETS, "Time spent hashing a downloaded file"),
+    "worker_wait_seconds": (SECONDS_BUCKETS, "Time a task waited for a worker, per worker pool"),
+    "worker_busy_seconds": (SECONDS_BUCKETS, "Time a task ran on a worker, per worker pool"),
+    "s3_request_seconds": (SECONDS_BUCKETS, "Duration of each s3 request, per operation"),
+    "s3_bytes": (BYTES_BUCKETS, "Bytes sent to or read from the s3 bucket per request, per operation"),
+    "upload_metadata_seconds": (SECONDS_BUCKETS, "Time spent building and queueing an item's metadata record"),
+    "insert_or_update_seconds": (SECONDS_BUCKETS, "Time spent merging a record into the master table")
+}
+
+# Percentiles reported for each histogram, in the crawl stats and the JSON summary alike
+QUANTILES = (0.5, 0.95)
+
+# Helper function, the name a percentile is reported under, e.g. 0.95 -> p95
+def quantile_name(q):
+    return f"p{round(q * 100)}"
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = INF
+        self.max = -INF
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    # Estimate a percentile from the bucket counts, interpolating linearly within the bucket it falls in
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i else min(0, self.min)
+                upper = self.buckets[i] if self.buckets[i] != INF else self.max
+                lower, upper = max(lower, self.min), min(upper, self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "mean": round(self.sum / self.count, 6) if self.count else None,
+            **{quantile_name(q): self.quantile(q) for q in QUANTILES}
+        }
+
+class Metrics:
+    enabled = True
+
+    def __init__(self, export_path=None):
+        self.export_path = export_path
+        # Histograms by name, then by their labels as a sorted tuple of (label, value) pairs
+        self.histograms = {}
+        # Observations come from the reactor thread and the worker pools alike
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(HISTOGRAMS[name][0])
+            histogram.observe(value)
+
+    # Time the enclosed block, observing its duration in seconds
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # Time every request made by a boto3 client, along with the bytes sent by uploads and read by downloads; a client that hasn't been
+    # created yet (see clients.py) is instrumented once it is
+    def instrument_s3(self, client):
+        if client is None:
+            return
+        if hasattr(client, "when_created"):
+            client.when_created(self.instrument_s3)
+            return
+        client.meta.events.register("before-call.s3", self.s3_request_started)
+        client.meta.events.register("after-call.s3", self.s3_request_finished)
+
+    # By the time a request is sent, botocore has wrapped its body in a file object (or a chunk of the file, for the transfer manager's
+    # multipart uploads), so its size is taken from how far it is from its current position to its end
+    def s3_request_started(self, params, context, **kwargs):
+        context["metrics_start"] = time.perf_counter()
+        body = params.get("body")
+        if hasattr(body, "seek") and hasattr(body, "tell"):
+            position = body.tell()
+            body.seek(0, io.SEEK_END)
+            size = body.tell() - position
+            body.seek(position)
+            if size:
+                context["metrics_bytes"] = size
+
+    # Downloads are timed up to their response headers, since their bodies are streamed afterwards by whoever made the request
+    def s3_request_finished(self, model, context, parsed=None, **kwargs):
+        start = context.pop("metrics_start", None)
+        if start is None:
+            return
+        self.observe("s3_request_seconds", time.perf_counter() - start, operation=model.name)
+        size = context.pop("metrics_bytes", None)
+        if size is None and isinstance(parsed, dict) and model.name == "GetObject":
+            size = parsed.get("ContentLength")
+        if size is not None:
+            self.observe("s3_bytes", size, operation=model.name)
+
+    # Copy each histogram's summary into the crawl stats, e.g. metrics/download_latency_seconds/ahca.myflorida.com/p95
+    def update_stats(self, stats):
+        with self.lock:
+            for name, series in self.histograms.items():
+                for labels, histogram in series.items():
+                    prefix = "/".join(["metrics", name] + [str(value) for _, value in labels])
+                    stats.set_value(f"{prefix}/count", histogram.count)
+                    stats.set_value(f"{prefix}/sum", round(histogram.sum, 6))
+                    stats.set_value(f"{prefix}/max", histogram.max)
+                    for q in QUANTILES:
+                        stats.set_value(f"{prefix}/{quantile_name(q)}", histogram.quantile(q))
+
+    def to_json(self):
+        with self.lock:
+            return {
+                name: [{"labels": dict(labels), **histogram.summary()} for labels, histogram in series.items()]
+                for name, series in self.histograms.items()
+            }
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            for name, series in self.histograms.items():
+                metric = f"medscraper_{name}"
+                lines.append(f"# HELP {metric} {HISTOGRAMS[name][1]}")
+                lines.append(f"# TYPE {metric} histogram")
+                for labels, histogram in series.items():
+                    cumulative = 0
+                    for bucket, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        le = "+Inf" if bucket == INF else repr(float(bucket))
+                        lines.append(f"{metric}_bucket{prometheus_labels(labels + (('le', le),))} {cumulative}")
+                    lines.append(f"{metric}_sum{prometheus_labels(labels)} {histogram.sum}")
+                    lines.append(f"{metric}_count{prometheus_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    # Write the histograms to the export path, if there is one
+    def export(self):
+        if not self.export_path:
+            return
+        os.makedirs(os.path.dirname(self.export_path) or ".", exist_ok=True)
+        if self.export_path.endswith(".json"):
+            body = json.dumps(self.to_json(), indent=2)
+        else:
+            body = self.to_prometheus()
+        tmp_path = self.export_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(body)
+        os.replace(tmp_path, self.export_path)
+        logger.info(f"[Metrics] Exported {sum(len(series) for series in self.histograms.values())} histograms to {self.export_path}")
+
+class NullMetrics:
+    enabled = False
+
+    def observe(self, name, value, **labels):
+        pass
+
+    def timer(self, name, **labels):
+        return NULL_TIMER
+
+    def instrument_s3(self, client):
+        pass
+
+    def update_stats(self, stats):
+        pass
+
+    def export(self):
+        pass
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+NULL_TIMER = NullTimer()
+NULL_METRICS = NullMetrics()
+
+# Helper function, formatting a series' labels for Prometheus, escaping backslashes, quotes and newlines in their values
+def prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+# The metrics shared by everything in a crawl (spider, middleware and pipeline), created the first time any of them asks for them
+def metrics_for(crawler):
+    metrics = getattr(crawler, "medscraper_metrics", None)
+    if metrics is None:
+        if crawler.settings.getbool("METRICS_ENABLED"):
+            # Each shard of a sharded crawl writes its metrics under its own folder
+            export_path = crawler.settings.get("METRICS_EXPORT_PATH")
+            shard = crawler.settings.get("SHARD_NAME")
+            if export_path and shard:
+                from medscraper.shards import shard_path
+                export_path = shard_path(export_path, shard)
+            metrics = Metrics(export_path)
+        else:
+            metrics = NULL_METRICS
+        crawler.medscraper_metrics = metrics
+    return metrics
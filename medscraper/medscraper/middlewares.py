@@ -4,11 +4,14 @@
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
 import scrapy
-import requests
 import os
 import logging
 from scrapy import signals
 from scrapy.http import HtmlResponse
+from scrapy.exceptions import IgnoreRequest
+from urllib.parse import urlparse
+from medscraper.throttle import DomainProfile, parse_retry_after
+from medscraper.metrics import NULL_METRICS, metrics_for
 from dotenv import load_dotenv
 # useful for handling different item types with a single interface
 from itemadapter import ItemAdapter
@@ -72,19 +75,75 @@ class MedscraperDownloaderMiddleware:
     # Not all methods need to be defined. If a method is not defined,
     # scrapy acts as if the downloader middleware does not modify the
     # passed objects.
-    def __init__(self):
+    def __init__(self, crawler=None):
         self.api_key = os.getenv('ZENROWS_API_KEY')
+        self.crawler = crawler
+        # Per-domain politeness profiles, keyed by host; built from the spider's domain_profiles when it opens
+        self.profiles = {}
+        self.host_profiles = {}
+        self.profile_defaults = {}
+        self.document_lane_profile = {}
+        self.profiles_enabled = True
+        self.adaptive = True
+        self.default_timeout = 180
+        self.metrics = NULL_METRICS
+        if crawler is not None:
+            self.metrics = metrics_for(crawler)
+            self.default_timeout = crawler.settings.getfloat('DOWNLOAD_TIMEOUT', 180)
+            self.profiles_enabled = crawler.settings.getbool('DOMAIN_PROFILES_ENABLED', True)
+            self.adaptive = crawler.settings.getbool('DOMAIN_PROFILES_ADAPTIVE', True)
+            self.profile_defaults = crawler.settings.getdict('DOMAIN_PROFILE_DEFAULTS')
+            self.document_lane_profile = crawler.settings.getdict('DOCUMENT_LANE_PROFILE')
 
     @classmethod
     def from_crawler(cls, crawler):
         # This method is used by Scrapy to create your spiders.
-        s = cls()
+        s = cls(crawler)
         crawler.signals.connect(s.spider_opened, signal=signals.spider_opened)
         return s
 
+    # Helper function, finding the profile for a request's download slot; each host has one for its pages, and one for its documents
+    # with the document lane's profile applied on top. Hosts without a configured profile start from the defaults
+    def profile_for(self, request):
+        host = urlparse(request.url).hostname or ""
+        slot = request.meta.get("download_slot", host)
+        if slot not in self.profiles:
+            config = self.host_profiles.get(host, {})
+            if request.meta.get("lane") == "documents":
+                config = {**config, **self.document_lane_profile}
+            self.profiles[slot] = DomainProfile.from_config(slot, config, self.profile_defaults)
+            self.apply_profile(self.profiles[slot])
+        return self.profiles[slot]
+
+    # Helper function, pushing a profile's concurrency and delay to the downloader; the host's download slot is updated if it's already
+    # open, and the downloader's per-slot settings are updated so the slot is recreated with the same values if it's closed while idle
+    def apply_profile(self, profile):
+        if self.crawler is None or self.crawler.engine is None:
+            return
+        downloader = self.crawler.engine.downloader
+        downloader.per_slot_settings[profile.slot] = {"concurrency": profile.concurrency, "delay": profile.delay}
+        slot = downloader.slots.get(profile.slot)
+        if slot is not None:
+            slot.concurrency = profile.concurrency
+            slot.delay = profile.delay
+
+    # Helper function, applying a profile that was just adapted, and recording where it ended up in the crawl stats
+    def update_profile(self, profile):
+        self.apply_profile(profile)
+        self.crawler.stats.set_value(f"domain_profile/{profile.slot}/concurrency", profile.concurrency)
+        self.crawler.stats.set_value(f"domain_profile/{profile.slot}/delay", round(profile.delay, 3))
+
     def process_request(self, request, spider):
         # Called for each request that goes through the downloader
         # middleware. Modifies the request object to send requests through ZenRows' API to handle User Agent rotation at scale
+
+        # Apply the host's timeout and retry limit, unless the request already sets its own; DownloadTimeoutMiddleware runs first and
+        # fills in the global DOWNLOAD_TIMEOUT, so that value is replaced too
+        if self.profiles_enabled:
+            profile = self.profile_for(request)
+            if request.meta.get("download_timeout") in (None, self.default_timeout):
+                request.meta["download_timeout"] = profile.timeout
+            request.meta.setdefault("max_retry_times", profile.max_retries)
         
         # Set the url to the target page being requested
         target_url = request.url
@@ -98,6 +157,24 @@ class MedscraperDownloaderMiddleware:
         request._original_url = request.url  # Optional, if the script needs to recover after failure
         request.replace(url=proxy_url) # Set the request's url to the new proxy url 
         request.headers.pop('User-Agent', None)  # Let ZenRows API set the User-Agent tag
+
+    def process_response(self, request, response, spider):
+        # Called with the response returned from the downloader. Adjusts the host's profile from how the response came back;
+        # 429 Too Many Requests and 5xx errors back off right away, anything else counts towards speeding back up
+        latency = request.meta.get("download_latency")
+        if self.metrics.enabled and latency is not None:
+            host = urlparse(request.url).hostname or ""
+            self.metrics.observe("download_latency_seconds", latency, domain=request.meta.get("download_slot", host))
+        if self.profiles_enabled and self.adaptive:
+            profile = self.profile_for(request)
+            if response.status == 429 or response.status >= 500:
+                profile.on_backoff(parse_retry_after(response.headers.get(b"Retry-After")))
+                logger.info(f"[Domain Profiles] {profile.slot} answered {response.status}; backing off to concurrency {profile.concurrency}, delay {profile.delay:.2f}s")
+                self.crawler.stats.inc_value(f"domain_profile/{profile.slot}/backoffs")
+                self.update_profile(profile)
+            elif profile.on_success(latency):
+                self.update_profile(profile)
+        return response
             
     def process_exception(self, request, exception, spider):
         # Called when a download handler or a process_request()
@@ -107,7 +184,23 @@ class MedscraperDownloaderMiddleware:
         # - return None: continue processing this exception
         # - return a Response object: stops process_exception() chain
         # - return a Request object: stops process_exception() chain
-        pass
+
+        # Timeouts and dropped connections mean the host is struggling, so back off the same as for a 5xx error; requests dropped by
+        # other middlewares never reached the host, so they don't count
+        if self.profiles_enabled and self.adaptive and not isinstance(exception, IgnoreRequest):
+            profile = self.profile_for(request)
+            profile.on_backoff()
+            logger.info(f"[Domain Profiles] {profile.slot} failed with {type(exception).__name__}; backing off to concurrency {profile.concurrency}, delay {profile.delay:.2f}s")
+            self.crawler.stats.inc_value(f"domain_profile/{profile.slot}/backoffs")
+            self.update_profile(profile)
+        return None
 
     def spider_opened(self, spider):
         spider.logger.info("Spider opened: %s" % spider.name)
+
+        # Build the profiles configured for each host on the spider, and set up their download slots before the first request goes out
+        if self.profiles_enabled:
+            self.host_profiles = getattr(spider, "domain_profiles", {})
+            for host, config in self.host_profiles.items():
+                self.profiles[host] = DomainProfile.from_config(host, config, self.profile_defaults)
+                self.apply_profile(self.profiles[host])
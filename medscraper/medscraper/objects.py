@@ -0,0 +1,44 @@
+# Content-addressed storage for the policy documents
+#
+# Every file is stored once in the s3 bucket under objects/<SHA-256 of its contents>, however many pages or states link to it, so identical
+# files are only ever uploaded once and two different files with the same name can never overwrite each other. Which contents each url
+# pointed to is kept in the document manifest, with a namespace of its own for every state and site path, along with a version number
+# counting how many times the url's contents have changed there
+from datetime import datetime, timezone
+from medscraper.manifests import Manifest
+
+def object_key(file_hash):
+    return f"objects/{file_hash}"
+
+# Namespace a package's files are tracked in; the same url found on two pages is tracked separately on each
+def document_namespace(state, site_path):
+    return f"{state}/{site_path}"
+
+class DocumentManifest(Manifest):
+    # Entries are kept per namespace, as {namespace: {url: {"sha256": ..., "version": ..., "updated": ...}}}
+    def document(self, namespace, url):
+        return self.get(namespace, {}).get(url)
+
+    def document_hash(self, namespace, url):
+        document = self.document(namespace, url)
+        return document["sha256"] if document else None
+
+    # The contents most recently recorded for a url in any namespace, or None if it was never recorded in one
+    def latest_hash(self, url):
+        documents = [namespace[url] for namespace in self.entries.values() if url in namespace]
+        return max(documents, key=lambda document: document["updated"])["sha256"] if documents else None
+
+    # Record the contents a url pointed to in a namespace, moving it on to a new version if they've changed since it was last recorded
+    def record(self, namespace, url, file_hash):
+        document = self.document(namespace, url)
+        if document is not None and document["sha256"] == file_hash:
+            return document
+
+        document = {
+            "sha256": file_hash,
+            "version": document["version"] + 1 if document else 1,
+            "updated": datetime.now(timezone.utc).isoformat(timespec="seconds")
+        }
+        # Copy the namespace rather than changing it in place, so the manifest sees the change and saves it
+        self.set(namespace, {**self.get(namespace, {}), url: document})
+        return document
@@ -4,93 +4,875 @@
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
 # useful for handling different item types with a single interface
-import io
-import hashlib
-import boto3
+import os
+import copy
+import json
 import scrapy
 import logging
-import ast
-import pandas as pd
+from typing import TYPE_CHECKING
+from itemadapter import ItemAdapter
+from medscraper.clients import LazyClient, is_not_found, lazy_s3_client
+from medscraper.manifests import Manifest
+from medscraper.journal import CrawlJournal, journal_dir
+from medscraper.metadata import MetadataAggregator, MetadataStore, MasterTableIndex, RollupCounters, normalize_value, is_truthy
+from medscraper.metadata import MASTER_TABLE_COLUMNS, TIMESTAMP_COLUMNS, TIMESTAMP_FORMAT, CHANGES_COLUMN, describe_changes
+from medscraper.streaming import hash_body, hash_s3_object, transfer_config, upload_body
+from medscraper.workers import WorkerPool, ProcessWorkerPool
+from medscraper.lanes import DownloadLane, DocumentFrontierWriter, DocumentRegistry, document_slot
+from medscraper.shards import shard_key, shard_path
+from medscraper.objects import DocumentManifest, document_namespace, object_key
+from medscraper.metrics import NULL_METRICS, metrics_for
+from medscraper.extraction import EXTRACTORS, derivative_key, document_extension, extract_derivative, summarize_page_changes, text_index_entry
 from urllib.parse import urlparse
-from scrapy.pipelines.files import FilesPipeline
-from scrapy.exceptions import DropItem
-from botocore.errorfactory import ClientError
+from scrapy.pipelines.files import FilesPipeline, S3FilesStore
+from botocore.exceptions import ClientError
+from twisted.internet import defer, task
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.python.failure import Failure
+
+# pandas is imported by the methods building records and tables, the first time an item needs one
+if TYPE_CHECKING:
+    import pandas as pd
 
 logger = logging.getLogger(__name__)
 
+# scrapy's s3 files store creates its botocore client as soon as the pipeline is built; this one waits until the first file is checked
+# against the bucket, with the same credentials and endpoint settings
+class LazyS3FilesStore(S3FilesStore):
+    def __init__(self, uri):
+        if not uri.startswith("s3://"):
+            raise ValueError(f"Incorrect URI scheme in {uri}, expected 's3'")
+        self.bucket, self.prefix = uri[5:].split("/", 1)
+        self.s3_client = LazyClient(self.create_client)
+
+    def create_client(self):
+        import botocore.session
+        session = botocore.session.get_session()
+        return session.create_client(
+            "s3",
+            aws_access_key_id=self.AWS_ACCESS_KEY_ID,
+            aws_secret_access_key=self.AWS_SECRET_ACCESS_KEY,
+            aws_session_token=self.AWS_SESSION_TOKEN,
+            endpoint_url=self.AWS_ENDPOINT_URL,
+            region_name=self.AWS_REGION_NAME,
+            use_ssl=self.AWS_USE_SSL,
+            verify=self.AWS_VERIFY
+        )
+
 class MedscraperPipeline(FilesPipeline):
+    STORE_SCHEMES = {**FilesPipeline.STORE_SCHEMES, "s3": LazyS3FilesStore}
+
     def __init__(self, store_uri, download_func=None, settings=None, *args, **kwargs):
         super().__init__(store_uri, download_func, settings, *args, **kwargs)
         self.s3_client = None
         self.s3_bucket = None
+        self.s3_workers = None
+        self.hash_workers = None
+        self.metadata_writer = None
+        self.pending_write = None
+        self.flush_timer = None
+        self.lanes_enabled = True
+        self.document_lane = None
+        self.document_frontier = None
+        self.journal = None
+        self.hash_index = None
+        self.url_validators = None
+        self.documents = None
+        self.text_extraction = False
+        self.text_extractor = None
+        self.text_index = None
+        self.object_uploads = {}
+        # Every document fetched during the crawl, and the files each package is waiting on, keyed by the package item's id
+        self.fetched_documents = DocumentRegistry()
+        self.packages = {}
+        self.conditional_fetch = True
+        self.chunk_size = 8 * 1024 * 1024
+        self.multipart_threshold = 2 * self.chunk_size
+        self.multipart_concurrency = 4
+        self.transfer_config = None
+        # The manifests and master table while they're loading, whatever's waiting on them, and why they failed to load if they did
+        self.loading = None
+        self.waiting = []
+        self.load_failure = None
+        # Whether the last checkpoint with the tables in it failed to store them, and whether the last checkpoint failed to store any manifest
+        self.tables_unstored = False
+        self.manifests_unstored = False
+        self.metadata = None
+        self.metadata_store = None
+        self.metadata_source = None
+        self.shard_states = None
+        self.table_index = None
+        self.rollups = RollupCounters()
+        self.verify_rollups = False
+        self.metadata_dir = "medscraper/doc-data"
+        self.metrics = NULL_METRICS
 
     @classmethod
     def from_crawler(cls, crawler):
         pipeline = super().from_crawler(crawler)
-        pipeline.s3_client = boto3.client('s3')
+        # One s3 client is shared by every worker thread, with enough pooled connections for each of them to keep one open; it's only
+        # created once the bucket is first used, so discovery-only crawls never create it at all
+        pipeline.s3_client = lazy_s3_client(crawler.settings.getint('S3_MAX_POOL_CONNECTIONS', 32))
         pipeline.s3_bucket = crawler.settings.get('S3_BUCKET')
+        # Time every s3 request made by the pipeline and the files store, and count the bytes sent and read, if metrics are enabled
+        pipeline.metrics = metrics_for(crawler)
+        pipeline.metrics.instrument_s3(pipeline.s3_client)
+        pipeline.metrics.instrument_s3(getattr(pipeline.store, "s3_client", None))
+        # Blocking s3 requests run on a bounded pool of worker threads, so downloads keep flowing while files are checked and uploaded;
+        # the metadata tables are written by a single writer thread, so batches always land in the order they were taken
+        pipeline.s3_workers = WorkerPool("s3", crawler.settings.getint('S3_WORKER_THREADS', 16))
+        pipeline.metadata_writer = WorkerPool("metadata-writer", 1)
+        # Downloaded files are hashed on a pool of their own, so hashing a large manual neither stalls the reactor nor queues up behind
+        # s3 requests (hashlib releases the GIL, so threads hash in parallel); with no threads, files are hashed on the reactor thread
+        pipeline.hash_workers = WorkerPool("hash", crawler.settings.getint('HASH_WORKER_THREADS', 4))
+        # Documents are downloaded in a lane of their own, separate from the spider's pages; in discovery-only mode they aren't downloaded
+        # at all, and are written to the document frontier for the documents spider instead
+        pipeline.lanes_enabled = crawler.settings.getbool('LANES_ENABLED', True)
+        pipeline.document_lane = DownloadLane("documents", crawler.settings.getint('DOCUMENT_LANE_CONCURRENCY', 16))
+        # A shard of a sharded crawl keeps its own copies of the manifests and metadata tables under doc-data/shards/<shard>/, starting
+        # from the shared ones and only holding its own states' rows, for the crawl_sharded command to merge back once every shard is done
+        shard = crawler.settings.get('SHARD_NAME')
+        if shard:
+            pipeline.shard_states = crawler.settings.getlist('CRAWL_STATES') or None
+        if crawler.settings.getbool('DISCOVERY_ONLY'):
+            frontier_path = crawler.settings.get('DOCUMENT_FRONTIER_PATH')
+            pipeline.document_frontier = DocumentFrontierWriter(shard_path(frontier_path, shard) if shard else frontier_path)
+        # Every metadata record and manifest change is journaled until the tables and manifests holding it are stored, so a crawl that dies
+        # partway picks up where it left off; the journal is kept in the crawl's JOBDIR when it has one, so a resumed job finds it
+        elif crawler.settings.getbool('METADATA_JOURNAL_ENABLED', True):
+            pipeline.journal = CrawlJournal(journal_dir(crawler.settings, shard))
+        # Index of the SHA-256 hash of every file stored in the s3 bucket, keyed by its file path
+        pipeline.hash_index = pipeline.shard_manifest(shard, crawler.settings.get('HASH_INDEX_KEY'), crawler.settings.get('HASH_INDEX_PATH'))
+        # HTTP validators (ETag, Last-Modified, Content-Length) last sent by the server for every file, keyed by its url
+        pipeline.url_validators = pipeline.shard_manifest(shard, crawler.settings.get('URL_VALIDATORS_KEY'), crawler.settings.get('URL_VALIDATORS_PATH'))
+        # Contents and version of every url's file in each state and site path, pointing into the content-addressed objects in the s3 bucket
+        pipeline.documents = pipeline.shard_manifest(
+            shard,
+            crawler.settings.get('DOCUMENT_MANIFEST_KEY'),
+            crawler.settings.get('DOCUMENT_MANIFEST_PATH'),
+            manifest_class=DocumentManifest
+        )
+        # Optionally compare documents by their text rather than their bytes, extracting it in a pool of worker processes
+        pipeline.text_extraction = crawler.settings.getbool('TEXT_EXTRACTION_ENABLED')
+        if pipeline.text_extraction:
+            try:
+                import pypdf, docx  # noqa: F401
+            except ImportError:
+                raise ImportError("Text extraction requires pypdf and python-docx; install them with pip install pypdf python-docx")
+            pipeline.text_extractor = ProcessWorkerPool("text-extraction", crawler.settings.getint('TEXT_EXTRACTION_PROCESSES', 2))
+        # Text hash and page hashes of every object whose text has been extracted, keyed by the object's hash
+        pipeline.text_index = pipeline.shard_manifest(shard, crawler.settings.get('TEXT_INDEX_KEY'), crawler.settings.get('TEXT_INDEX_PATH'))
+        pipeline.conditional_fetch = crawler.settings.getbool('CONDITIONAL_FETCH_ENABLED', True)
+        # Large files are sent to the s3 bucket as parallel multipart uploads in parts of this size, and stored copies are read back from it
+        # in chunks of this size
+        pipeline.chunk_size = crawler.settings.getint('FILES_CHUNK_SIZE', pipeline.chunk_size)
+        pipeline.multipart_threshold = crawler.settings.getint('FILES_MULTIPART_THRESHOLD', 2 * pipeline.chunk_size)
+        pipeline.multipart_concurrency = crawler.settings.getint('FILES_MULTIPART_CONCURRENCY', pipeline.multipart_concurrency)
+        # Keeps the master table in memory for the whole crawl, writing the metadata tables back out in batches
+        pipeline.metadata_dir = crawler.settings.get('METADATA_LOCAL_DIR', pipeline.metadata_dir)
+        pipeline.metadata_source = MetadataStore(
+            pipeline.s3_client,
+            pipeline.s3_bucket,
+            pipeline.metadata_dir,
+            table_format=crawler.settings.get('METADATA_FORMAT', 'csv'),
+            partition_by_state=crawler.settings.getbool('METADATA_PARTITION_BY_STATE')
+        )
+        # A shard writes its states' rows to its own copies of the tables, starting from the shared ones the first time it runs
+        pipeline.metadata_store = pipeline.metadata_source
+        if shard:
+            pipeline.metadata_store = MetadataStore(
+                pipeline.s3_client,
+                pipeline.s3_bucket,
+                os.path.join(pipeline.metadata_dir, "shards", shard),
+                table_format=pipeline.metadata_source.table_format,
+                partition_by_state=pipeline.metadata_source.partition_by_state,
+                prefix=f"doc-data/shards/{shard}"
+            )
+        # Optionally check the incrementally maintained rollups against a full recompute on every write
+        pipeline.verify_rollups = crawler.settings.getbool('METADATA_VERIFY_ROLLUPS')
+        pipeline.metadata = MetadataAggregator(
+            lambda: pipeline.fetch_doc_data("master_table"),
+            pipeline.merge_record,
+            pipeline.write_metadata,
+            commit_table=pipeline.commit_rows,
+            flush_interval=crawler.settings.getfloat('METADATA_FLUSH_INTERVAL', 60),
+            flush_items=crawler.settings.getint('METADATA_FLUSH_ITEMS', 100)
+        )
+        # Count every pool's tasks, queue depth and time spent waiting and working in the crawl stats
+        for workers in (pipeline.s3_workers, pipeline.hash_workers, pipeline.metadata_writer, pipeline.text_extractor):
+            if workers is not None:
+                workers.instrument(crawler.stats, pipeline.metrics)
         return pipeline
 
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        # Discovery-only crawls never touch the s3 bucket, so there's nothing to load
+        if self.document_frontier is not None:
+            self.document_frontier.open()
+            return None
+
+        if self.journal is not None:
+            self.journal.open()
+
+        # Records are otherwise only written out when a new one comes in, so check the flush interval on a timer too; during a long tail of
+        # document downloads with no new packages finishing, the last records merged would sit unwritten until the spider closes
+        if self.metadata.flush_interval > 0:
+            self.flush_timer = task.LoopingCall(self.metadata.flush_if_due)
+            self.flush_timer.start(max(self.metadata.flush_interval / 4, 1), now=False).addErrback(
+                lambda failure: logger.error(f"[Metadata] Stopped writing metadata on the flush interval: {failure.getErrorMessage()}"))
+
+        # Load the manifests and the master table on the worker pool while the spider starts crawling; items wait in process_item until
+        # they're all in memory, so the first pages are requested without waiting on the bucket (or on importing boto3 and pandas)
+        loads = [self.s3_workers.run(self.hash_index.load), self.s3_workers.run(self.documents.load)]
+        if self.conditional_fetch:
+            loads.append(self.s3_workers.run(self.url_validators.load))
+        if self.text_extraction:
+            loads.append(self.s3_workers.run(self.text_index.load))
+        loads.append(self.s3_workers.run(self.fetch_doc_data, "master_table").addCallback(self.metadata.set_table))
+        self.loading = defer.gatherResults(loads, consumeErrors=True)
+        self.loading.addBoth(self.tables_loaded, spider)
+        return None
+
+    # Once everything has loaded, pass on whatever was waiting for it. If anything failed to load, the crawl can't compare files against
+    # the bucket or merge records into the master table, so the items fail and the spider closes
+    def tables_loaded(self, result, spider):
+        self.loading = None
+        if isinstance(result, Failure):
+            # Report the load that failed, rather than the list of loads it was gathered into
+            if isinstance(result.value, defer.FirstError):
+                result = result.value.subFailure
+            logger.error(f"[S3 File Pipeline] Failed to load the manifests and metadata tables: {result.getErrorMessage()}")
+            self.load_failure = result
+            self.crawler.engine.close_spider(spider, "metadata_load_failed")
+        elif self.journal is not None:
+            self.recover_journal()
+        waiting, self.waiting = self.waiting, []
+        for d in waiting:
+            d.callback(None)
+
+    # Helper function, replaying whatever an earlier crawl journaled but never stored into the freshly loaded tables and manifests, and
+    # storing the result straight away; from then on, every change to the manifests is journaled as it's made
+    def recover_journal(self):
+        manifests = {manifest.key: manifest for manifest in self.manifests()}
+        records, changes = 0, 0
+        for entry in self.journal.replay():
+            if "record" in entry:
+                self.add_record(entry["record"])
+                records += 1
+            elif entry.get("manifest") in manifests:
+                manifests[entry["manifest"]].set(entry["name"], entry["value"])
+                changes += 1
+        for manifest in manifests.values():
+            manifest.journal = self.journal
+
+        if not self.journal.recovered:
+            return
+        self.journal.replayed()
+        logger.info(f"[Journal] Recovered {records} metadata records and {changes} manifest changes from an earlier crawl")
+        self.crawler.stats.set_value("journal/recovered_records", records)
+        self.crawler.stats.set_value("journal/recovered_manifest_changes", changes)
+        # Writing the tables checkpoints the journal along with them, storing the manifests too; without any records left to write, store
+        # just the manifests
+        previous_write = self.pending_write
+        self.metadata.flush()
+        if self.pending_write is previous_write:
+            self.pending_write = self.checkpoint()
+            self.pending_write.addErrback(lambda failure: logger.error(f"[Journal] Failed to store the recovered changes: {failure.getErrorMessage()}"))
+
+    # Helper function, calling back once the manifests and master table have loaded, straight away if they already have
+    def when_loaded(self, f, *args):
+        if self.loading is None:
+            return f(*args)
+        d = Deferred()
+        d.addCallback(lambda _: f(*args))
+        self.waiting.append(d)
+        return d
+
+    def process_item(self, item, spider):
+        # Packages from pages without any documents have nothing to download or record, so they skip the media pipeline altogether
+        adapter = ItemAdapter(item)
+        if not adapter.get("file_urls"):
+            adapter["files"] = []
+            return item
+        return self.when_loaded(self.process_loaded_item, item, spider)
+
+    def process_loaded_item(self, item, spider):
+        if self.load_failure is not None:
+            return defer.fail(self.load_failure)
+        return super().process_item(item, spider)
+
+    def close_spider(self, spider):
+        if self.document_frontier is not None:
+            self.document_frontier.close()
+            logger.info(f"[Document Frontier] Wrote {self.document_frontier.documents} documents from {self.document_frontier.packages} pages to {self.document_frontier.path}")
+            self.export_metrics()
+            return self.stop_workers(None)
+        if self.flush_timer is not None and self.flush_timer.running:
+            self.flush_timer.stop()
+        return self.when_loaded(self.flush_metadata)
+
+    # Helper function, writing out the last batch of metadata records and the manifests, then shutting the worker pools down
+    def flush_metadata(self):
+        # Nothing was merged if the manifests and tables never loaded, and writing them back out would replace them with empty ones
+        if self.load_failure is not None:
+            # Keep the journal for the next crawl to replay
+            if self.journal is not None:
+                self.journal.close()
+            self.export_metrics()
+            return self.stop_workers(None)
+
+        # Write out any metadata records merged since the last flush, and the tables again if the last write of them failed
+        self.metadata.flush(force=self.tables_unstored)
+
+        # Once the last batch of tables has been written, persist any hashes and validators recorded since so the next run can compare
+        # against them without reading files back; with everything stored, the journal has nothing left to replay and is removed
+        d = self.pending_write if self.pending_write is not None else defer.succeed(None)
+        d.addCallback(lambda _: self.checkpoint())
+        d.addCallback(self.close_journal)
+        d.addBoth(self.export_metrics)
+        d.addBoth(self.stop_workers)
+        return d
+
+    # Helper function, building one of the pipeline's manifests, kept under the shard's folder and seeded from the shared one for a shard
+    def shard_manifest(self, shard, key, local_path, manifest_class=Manifest):
+        if not shard:
+            return manifest_class(self.s3_client, self.s3_bucket, key, local_path)
+        return manifest_class(self.s3_client, self.s3_bucket, shard_key(key, shard), shard_path(local_path, shard), seed_key=key)
+
+    # Helper function, the manifests kept by this crawl
+    def manifests(self):
+        manifests = [self.hash_index, self.documents]
+        if self.conditional_fetch:
+            manifests.append(self.url_validators)
+        if self.text_extraction:
+            manifests.append(self.text_index)
+        return manifests
+
+    # Checkpoint the journal: seal its current segment, and store the given tables along with copies of every changed manifest on the
+    # metadata writer thread, so checkpoints land in the order they were taken. Once they're all stored, every sealed segment is removed.
+    # After a checkpoint that failed, every manifest is stored in full again, since which of its changes were lost isn't known. Returns a
+    # Deferred firing with whether everything was stored
+    def checkpoint(self, tables=()):
+        sealed = self.journal.seal() if self.journal is not None else None
+        manifests = [(manifest, manifest.checkpoint(force=self.manifests_unstored)) for manifest in self.manifests()]
+        d = self.metadata_writer.run(self.save_checkpoint, tables, manifests)
+        d.addBoth(self.checkpoint_saved, sealed, bool(tables))
+        return d
+
+    # Helper function, run on the metadata writer thread; saves each table through the metadata store, then each manifest's copy to the
+    # s3 bucket and the local doc-data folder, returning whether everything was stored
+    def save_checkpoint(self, tables, manifests):
+        stored = self.save_tables(tables)
+        for manifest, entries in manifests:
+            stored = manifest.write(entries) and stored
+        return stored
+
+    # Only a checkpoint with the tables in it stores the whole master table, so once one fails to, checkpoints of the manifests alone don't
+    # store everything the journal holds either, and the journal is kept until the tables are stored again
+    def checkpoint_saved(self, result, sealed, with_tables):
+        stored = result is True
+        if with_tables:
+            self.tables_unstored = not stored
+        self.manifests_unstored = not stored
+        stored = stored and not self.tables_unstored
+
+        if sealed is not None:
+            if stored:
+                self.journal.discard(sealed)
+                self.crawler.stats.inc_value("journal/checkpoints")
+            else:
+                logger.warning(f"[Journal] Not everything could be stored; keeping the journal up to segment {sealed} to replay on the next crawl")
+        return result if isinstance(result, Failure) else stored
+
+    # Helper function, removing the journal once the crawl's last checkpoint stored everything, and otherwise leaving it for the next crawl
+    def close_journal(self, stored):
+        if self.journal is None:
+            return
+        self.crawler.stats.set_value("journal/entries", self.journal.entries)
+        if stored:
+            self.journal.clear()
+        else:
+            self.journal.close()
+
+    # Helper function, copying the crawl's timing histograms into the stats and writing them out once everything else is done, passing
+    # through whatever result it's chained on
+    def export_metrics(self, result=None):
+        if self.metrics.enabled:
+            self.metrics.update_stats(self.crawler.stats)
+            try:
+                self.metrics.export()
+            except OSError as e:
+                logger.error(f"[Metrics] Failed to export metrics: {e}")
+        return result
+
+    # Helper function, stopping the worker pools once the pipeline is done with them, passing through whatever result it's chained on
+    def stop_workers(self, result):
+        self.s3_workers.stop()
+        self.hash_workers.stop()
+        self.metadata_writer.stop()
+        if self.text_extractor is not None:
+            self.text_extractor.stop()
+        return result
+
     def get_media_requests(self, item, info):
-        for file_url in item.get("file_urls", []):
-            yield scrapy.Request(file_url, meta={"item": item})
+        # In discovery-only mode, record the package's files in the document frontier instead of downloading them
+        if self.document_frontier is not None:
+            self.document_frontier.add(item)
+            return
 
+        # Documents on pages closer to the start urls are downloaded first, each host's documents going through a download slot of their own.
+        # Documents already fetched (or being fetched) for another package aren't requested again; the package waits on that fetch instead
+        adapter = ItemAdapter(item)
+        depth = adapter.get("package_depth") or 0
+        package = self.packages[id(item)] = {"requested": [], "attached": []}
+        for file_url in adapter.get("file_urls") or []:
+            fetch = self.fetched_documents.claim(file_url)
+            if fetch is not None:
+                self.crawler.stats.inc_value("file_status_count/attached", spider=info.spider)
+                package["attached"].append((file_url, fetch))
+                continue
+
+            package["requested"].append(file_url)
+            meta = {"item": item}
+            if self.lanes_enabled:
+                meta.update({"lane": "documents", "download_slot": document_slot(urlparse(file_url).hostname or "")})
+            yield scrapy.Request(file_url, headers=self.conditional_headers(file_url, item), meta=meta, priority=-depth)
+
+    def media_to_download(self, request, info, *, item=None):
+        # Wait for room in the document lane before the file is checked and downloaded
+        check_store = self.check_store
+        if not self.lanes_enabled:
+            d = check_store(request, info, item=item)
+            d.addCallback(self.release_if_skipped, request)
+            return d
+
+        request.meta["lane_permit"] = True
+        d = self.document_lane.acquire(request.priority)
+        d.addCallback(lambda _: check_store(request, info, item=item))
+        d.addBoth(self.release_if_skipped, request)
+        return d
+
+    # Helper function, checking whether a file's stored copy is recent enough to skip downloading it again. With FILES_EXPIRES at 0, a stored
+    # copy never is, so the file goes straight to its conditional download rather than asking the s3 bucket for the copy's age first; whether
+    # it changed is then settled by the server's 304 or the file's hash
+    def check_store(self, request, info, *, item=None):
+        if self.expires <= 0:
+            return defer.succeed(None)
+        return super().media_to_download(request, info, item=item)
+
+    # Helper function, giving up a file's place in the document lane if it won't be downloaded after all (e.g. it's already up to date),
+    # in which case the store's result is the outcome of the document's fetch
+    def release_if_skipped(self, result, request):
+        if result is not None:
+            self.release_lane(request)
+            self.fetched_documents.resolve(request.url, result)
+        return result
+
+    # Helper function, giving up a file's place in the document lane once its download is finished, whether it succeeded or not
+    def release_lane(self, request):
+        if request.meta.pop("lane_permit", False):
+            self.document_lane.release()
+
+    # Helper function, building the conditional request headers for a file from the validators the server sent for it on an earlier crawl,
+    # so the server can answer with a bodiless 304 Not Modified if the file hasn't changed since. Only files whose contents are known can be
+    # fetched conditionally, since a 304 has to be recorded in the package's namespace with the contents the validators stand for
+    def conditional_headers(self, file_url, item=None):
+        headers = {}
+        validators = self.url_validators.get(file_url) if self.conditional_fetch else None
+        if validators and self.known_hash(file_url, item) is not None:
+            if validators.get("etag"):
+                headers["If-None-Match"] = validators["etag"]
+            if validators.get("last_modified"):
+                headers["If-Modified-Since"] = validators["last_modified"]
+        return headers
+
+    # Helper function, pulling the validators out of a file's response headers
+    def response_validators(self, response):
+        validators = {}
+        for name, header in [("etag", b"ETag"), ("last_modified", b"Last-Modified"), ("content_length", b"Content-Length")]:
+            value = response.headers.get(header)
+            if value:
+                validators[name] = value.decode("latin-1")
+        return validators
+
+    # Helper function, recording a file's validators once its contents have been checked against the s3 bucket, along with the hash of the
+    # contents they stand for
+    def record_validators(self, file_url, response, file_hash=None):
+        if not self.conditional_fetch:
+            return
+        validators = self.response_validators(response)
+        if validators.get("etag") or validators.get("last_modified"):
+            if file_hash is not None:
+                validators["sha256"] = file_hash
+            self.url_validators.set(file_url, validators)
+
+    # Helper function, the hash of the contents a file's stored validators stand for: recorded with the validators themselves, or for
+    # validators recorded before that, the contents on record for the url in the package's namespace, or failing that the ones most recently
+    # recorded for it in any namespace (the same url found under another state or site path), or where it was stored before objects were
+    # content-addressed. None if the file's contents aren't known at all
+    def known_hash(self, file_url, item=None):
+        validators = self.url_validators.get(file_url) or {}
+        if validators.get("sha256"):
+            return validators["sha256"]
+        file_hash = self.documents.document_hash(self.item_namespace(item), file_url) if item is not None else None
+        if file_hash is None:
+            file_hash = self.documents.latest_hash(file_url)
+        if file_hash is None:
+            file_hash = self.hash_index.get(self.legacy_file_path(file_url))
+        return file_hash
+
+    # Helper function, checking whether a file is known to be unchanged since the last crawl without looking at its contents; either the server
+    # answered the conditional request with 304 Not Modified, or it ignored the conditional headers but sent back the same validators as last time
+    def is_unmodified(self, response, request):
+        if not self.conditional_fetch:
+            return False
+        if response.status == 304:
+            return True
+
+        stored = self.url_validators.get(request.url)
+        if response.status != 200 or not stored:
+            return False
+        current = self.response_validators(response)
+
+        # A matching entity tag is enough on its own, otherwise both the modification date and the length have to match
+        if stored.get("etag") and current.get("etag"):
+            return stored["etag"] == current["etag"]
+        return bool(stored.get("last_modified")) and stored.get("last_modified") == current.get("last_modified") \
+            and stored.get("content_length") == current.get("content_length")
+
+    # Files are stored under the hash of their contents, which isn't known until they've been downloaded and hashed; until then, a file's path
+    # is the object holding the version recorded for its url on the last crawl, or where it was stored before objects were content-addressed
     def file_path(self, request, response=None, info=None, *, item=None):
-        return "policy-docs/full/" + urlparse(request.url).path.split("/")[-1]
+        file_hash = self.documents.document_hash(self.item_namespace(item), request.url) if item is not None else None
+        if file_hash is not None:
+            return object_key(file_hash)
+        return self.legacy_file_path(request.url)
+
+    # Helper function, the key files were stored under before objects were content-addressed, named after the last part of their url
+    def legacy_file_path(self, file_url):
+        return "policy-docs/full/" + urlparse(file_url).path.split("/")[-1]
+
+    # Helper function, the document manifest namespace a package's files are tracked in
+    def item_namespace(self, item):
+        adapter = ItemAdapter(item)
+        return document_namespace(adapter.get("package_state"), adapter.get("package_site_path"))
 
     def media_downloaded(self, response, request, info, *, item=None):
-        item['package_file_count'] = len(item['file_urls'])
-        self.upload_metadata(item)
+        self.release_lane(request)
+
+        # If the file hasn't changed since the last crawl, skip hashing and comparing it against the s3 bucket entirely; its contents are the
+        # ones its validators were recorded for, which file_stored then records in the package's namespace. A full response whose contents
+        # aren't known after all is processed like any other download
+        file_hash = self.known_hash(request.url, item) if self.is_unmodified(response, request) else None
+        if file_hash is not None or response.status == 304:
+            if file_hash is None:
+                logger.warning(f"[S3 File Pipeline] Not modified since last crawl, but no contents are on record for {request.url}")
+            file_key = object_key(file_hash) if file_hash is not None else self.legacy_file_path(request.url)
+            logger.info(f"[S3 File Pipeline] Not modified since last crawl: {request.url} (status {response.status})")
+            self.crawler.stats.inc_value("file_status_count/notmodified", spider=info.spider)
+            result = {"url": request.url, "path": file_key, "checksum": file_hash, "status": "uptodate"}
+            self.fetched_documents.resolve(request.url, result)
+            return result
+
+        # file_downloaded hands the file off to the worker pool and returns a Deferred in place of its hash, so fill the hash in once it's done,
+        # along with the path of the object it was stored as
         result = super().media_downloaded(response, request, info, item=item)
-        return result
+        d = result["checksum"].addCallback(lambda checksum: {**result, "path": object_key(checksum), "checksum": checksum})
+        d.addCallback(self.document_fetched, response, request)
+        return d
 
     def file_downloaded(self, response, request, info, *, item=None):
-        # Compares the new hash to the existing one from S3
-        # logger.info("HITTING FILE DOWNLOADED:")
         logger.info(f"[S3 File Pipeline] Downloaded {request.url} with status {response.status}")
-        
-        # Get the path of the key in the s3 bucket, and hash the newly scraped file's contents
-        file_key = self.file_path(request, response=response, info=info, item=item)
-        new_hash = hashlib.sha256(response.body).hexdigest()
 
-        try:
-            # Retrieve the local version of the file from the s3 bucket, and hash its contents
-            s3_file = self.s3_client.get_object(Bucket=self.s3_bucket, Key=file_key)
-            existing_hash = hashlib.sha256(s3_file["Body"].read()).hexdigest()
-            logger.info(f"[S3 File Pipeline] File Hashes for {file_key}:\n Existing - {existing_hash}\n New - {new_hash}")
-
-            # If the hashes match, the file contents have not changed, so drop the file from the package
-            if new_hash == existing_hash:
-                logger.info(f"[S3 File Pipeline] Skipping unchanged file: {file_key}")
-                item["file_urls"].remove(request.url)
-                raise DropItem(f"[S3 File Pipeline] File unchanged: {file_key}")
+        # Hash the newly scraped file's contents on the hashing pool, and store them as an object named after the hash unless it's already in
+        # the s3 bucket; what the new contents mean for each package linking to the file is worked out once the package is complete. With text
+        # extraction enabled, a file whose text hasn't changed keeps the object already stored for it instead
+        d = self.hash_workers.run(self.hash_file, response.body)
+        # A file with nothing on record for it may still be in the s3 bucket under the name it was stored as before objects were
+        # content-addressed, so look that object up once before comparing the file against it
+        if self.is_unindexed(request.url):
+            d.addCallback(lambda file_hash: self.index_legacy_object(request.url).addCallback(lambda _: file_hash))
+        if self.text_extraction:
+            d.addCallback(self.compare_text, response.body, request, item)
+        d.addCallback(self.store_object, response.body, request)
+        return d
+
+    # Helper function, checking whether nothing is on record for a file: no contents recorded for its url in any namespace, and no hash
+    # indexed for the key it was stored under before objects were content-addressed
+    def is_unindexed(self, file_url):
+        return self.documents.latest_hash(file_url) is None and self.legacy_file_path(file_url) not in self.hash_index
+
+    # Helper function, reading the hash of the object a file was stored as before objects were content-addressed from the s3 bucket (hashing
+    # it there this one time if it was stored before hashes were recorded), and indexing it, so the file is compared against it rather than
+    # reported as new. Objects that were never stored aren't indexed, and are looked up again until their url has contents on record
+    def index_legacy_object(self, file_url):
+        file_key = self.legacy_file_path(file_url)
+        d = self.s3_workers.run(self.fetch_existing_hash, file_key)
+        d.addCallback(self.legacy_object_found, file_key)
+        return d
+
+    def legacy_object_found(self, existing_hash, file_key):
+        if existing_hash is not None:
+            logger.info(f"[S3 File Pipeline] Found {file_key} stored before objects were content-addressed; comparing against it")
+            self.hash_index.set(file_key, existing_hash)
+        return existing_hash
+
+    # Helper function, recording a file's validators once its contents are stored in the s3 bucket, and handing its result to every package
+    # waiting on it, along with a summary of its text changes if they were compared
+    def document_fetched(self, result, response, request):
+        self.record_validators(request.url, response, result["checksum"])
+        if "text_changes" in request.meta:
+            result["changes"] = request.meta["text_changes"]
+        self.fetched_documents.resolve(request.url, result)
+        return result
+
+    # Helper function, run on a worker thread; hashes a downloaded file's contents
+    def hash_file(self, body):
+        with self.metrics.timer("hash_seconds"):
+            return hash_body(body)
+
+    # Helper function, comparing a downloaded file's text against the version last recorded for it, returning the hash of the object the
+    # file should be stored as: the previous version's, if only the file's bytes changed and not its text, otherwise its own. Files with no
+    # text to compare (unsupported types, scans, files that fail to parse) are compared by their bytes as usual
+    def compare_text(self, new_hash, body, request, item):
+        extension = document_extension(request.url)
+        previous_hash = self.previous_hash(request.url, item)
+        if extension not in EXTRACTORS or previous_hash == new_hash:
+            return new_hash
+
+        # New files are extracted straight away, so their text is on record for comparing against their next version
+        d = self.text_derivative(new_hash, extension, body=body)
+        if previous_hash is None:
+            d.addCallback(self.text_compared, None, new_hash, previous_hash, request)
+            return d
+
+        # The previous version's text is usually in the text index already; if not (e.g. it was stored before text extraction was turned
+        # on), it's read back from the s3 bucket and extracted once
+        d.addCallback(lambda entry: self.text_derivative(previous_hash, extension).addCallback(
+            lambda previous: self.text_compared(entry, previous, new_hash, previous_hash, request)))
+        return d
+
+    # Helper function, the text index entry for an object, extracting its text in the process pool and storing it next to the object if it
+    # hasn't been extracted before; the object is read back from the s3 bucket if its body isn't given. Fires with None if the object
+    # can't be read or its text can't be extracted
+    def text_derivative(self, file_hash, extension, body=None):
+        entry = self.text_index.get(file_hash)
+        if entry is not None:
+            return defer.succeed(entry)
+
+        if body is not None:
+            d = self.text_extractor.run(extract_derivative, body, extension)
+        elif object_key(file_hash) in self.hash_index:
+            d = self.s3_workers.run(self.read_object, object_key(file_hash))
+            d.addCallback(lambda stored: self.text_extractor.run(extract_derivative, stored, extension))
+        else:
+            return defer.succeed(None)
+
+        d.addCallback(self.text_extracted, file_hash)
+        d.addErrback(self.text_failed, file_hash)
+        return d
+
+    # Helper function, storing an object's extracted text next to it in the s3 bucket, then recording it in the text index
+    def text_extracted(self, derivative, file_hash):
+        self.crawler.stats.inc_value("text_extraction/extracted")
+        entry = text_index_entry(derivative)
+        d = self.s3_workers.run(self.store_derivative, file_hash, derivative)
+        d.addCallback(lambda _: self.text_index.set(file_hash, entry))
+        return d.addCallback(lambda _: entry)
+
+    def text_failed(self, failure, file_hash):
+        self.crawler.stats.inc_value("text_extraction/failed")
+        logger.warning(f"[Text Extraction] Couldn't extract the text of {object_key(file_hash)}: {failure.getErrorMessage()}")
+        return None
+
+    # Helper function, deciding which object a downloaded file is stored as from its text and the previous version's, and noting a summary
+    # of the pages that changed on the request, for the packages the file belongs to
+    def text_compared(self, entry, previous, new_hash, previous_hash, request):
+        if entry is None or entry["text_sha256"] is None or previous_hash == new_hash:
+            return new_hash
+        unit_count = f"{len(entry['page_hashes'])} {entry['unit']}{'s' if len(entry['page_hashes']) != 1 else ''}"
+        if previous_hash is None:
+            request.meta["text_changes"] = f"new, {unit_count}"
+            return new_hash
+        if previous is None or previous["text_sha256"] is None:
+            return new_hash
+
+        if previous["text_sha256"] == entry["text_sha256"] and object_key(previous_hash) in self.hash_index:
+            logger.info(f"[Text Extraction] Only the non-text content of {request.url} changed; keeping {object_key(previous_hash)}")
+            self.crawler.stats.inc_value("text_extraction/text_unchanged")
+            return previous_hash
+
+        request.meta["text_changes"] = summarize_page_changes(previous["page_hashes"], entry["page_hashes"], entry["unit"])
+        return new_hash
+
+    # Helper function, run on a worker thread; writes an object's extracted text and page hashes next to it in the s3 bucket
+    def store_derivative(self, file_hash, derivative):
+        self.s3_client.put_object(
+            Bucket=self.s3_bucket,
+            Key=derivative_key(file_hash),
+            Body=json.dumps({"sha256": file_hash, **derivative}).encode("utf-8"),
+            ContentType="application/json"
+        )
+
+    # Helper function, run on a worker thread; reads an object back from the s3 bucket
+    def read_object(self, file_key):
+        return self.s3_client.get_object(Bucket=self.s3_bucket, Key=file_key)["Body"].read()
+
+    # Helper function, the hash of the version last recorded for a file in a package's namespace, or for files last crawled before objects
+    # were content-addressed, the hash of the file stored under its old name
+    def previous_hash(self, file_url, item):
+        file_hash = self.documents.document_hash(self.item_namespace(item), file_url)
+        if file_hash is None:
+            file_hash = self.hash_index.get(self.legacy_file_path(file_url))
+        return file_hash
+
+    # Helper function, storing a file's contents as a content-addressed object, returning a Deferred that fires with its hash once it's in
+    # the s3 bucket. Objects already known to the hash index aren't uploaded again, and a file whose contents are already being uploaded
+    # (e.g. the same manual linked from several pages) waits for that upload instead of starting another
+    def store_object(self, file_hash, body, request):
+        file_key = object_key(file_hash)
+        if file_key in self.hash_index:
+            return file_hash
+
+        d = defer.Deferred()
+        if file_hash in self.object_uploads:
+            self.object_uploads[file_hash].append(d)
+            return d
+
+        self.object_uploads[file_hash] = [d]
+        upload = self.s3_workers.run(self.store_file, file_key, body, file_hash, self._get_content_type(request.url))
+        upload.addBoth(self.object_stored, file_key, file_hash)
+        return d
+
+    # Helper function, run on a worker thread; uploads an object to the s3 bucket unless it's already stored there from an earlier crawl
+    def store_file(self, file_key, body, file_hash, content_type):
+        if self.fetch_existing_hash(file_key) != file_hash:
+            self.upload_file(file_key, body, file_hash, content_type)
+            logger.info(f"[S3 File Pipeline] Stored new object {file_key}")
+
+    # Helper function, recording an object in the hash index once it's in the s3 bucket, and letting every file waiting on it carry on
+    def object_stored(self, result, file_key, file_hash):
+        if not isinstance(result, Failure):
+            self.hash_index.set(file_key, file_hash)
+        for d in self.object_uploads.pop(file_hash):
+            if isinstance(result, Failure):
+                d.errback(result)
             else:
-                # Otherwise, the file contents have changed, so re-download the file
-                logger.info(f"[S3 File Pipeline] Changed file {file_key}; Downloading...")
-                item["file_urls"].append(request.url)
-                content_type = self._get_content_type(file_key)            
-                self.s3_client.put_object(
+                d.callback(file_hash)
+
+    # Once every file in a package has been fetched, whether by this package or an earlier one linking to the same files, work out what
+    # each file's contents mean for the package, then record the package's metadata once
+    def item_completed(self, results, item, info):
+        package = self.packages.pop(id(item), None)
+        if package is None:
+            return super().item_completed(results, item, info)
+
+        # Pass on this package's own fetches to anyone waiting on them, in case they finished without going through the hooks above
+        outcomes = dict(zip(package["requested"], results))
+        for file_url, (_, result) in outcomes.items():
+            self.fetched_documents.resolve(file_url, result)
+
+        attached_urls = [file_url for file_url, _ in package["attached"]]
+        d = DeferredList([fetch for _, fetch in package["attached"]], consumeErrors=True)
+        d.addCallback(lambda attached: self.package_completed({**outcomes, **dict(zip(attached_urls, attached))}, item))
+        return d
+
+    # Helper function, filling in the package's files from each one's fetch, in the order they were found on the page, and recording its
+    # metadata if any of them could be fetched; files that failed were already logged by media_failed
+    def package_completed(self, outcomes, item):
+        adapter = ItemAdapter(item)
+        files = []
+        for file_url in adapter.get("file_urls") or []:
+            ok, result = outcomes.get(file_url, (False, None))
+            if ok and result is not None:
+                files.append(self.file_stored(result, file_url, item))
+
+        adapter["files"] = files
+
+        # Collect the text changes in the package's new and changed files, for the master table
+        changes = {f["url"]: f["changes"] for f in files if f.get("changes")}
+        if changes:
+            adapter[CHANGES_COLUMN] = changes
+
+        if files:
+            self.upload_metadata(item)
+        return item
+
+    # Helper function, comparing a file's contents against the version recorded for its url in the package's namespace, recording the new
+    # version if they changed, and returning the file's result for the package
+    def file_stored(self, result, file_url, item):
+        new_hash = result["checksum"]
+        # Files the server reported as not modified, with no contents on record for them, have nothing to compare
+        if new_hash is None:
+            return {**result, "url": file_url}
+
+        # Compare against the version recorded for the url in the package's namespace
+        file_key = object_key(new_hash)
+        existing_hash = self.previous_hash(file_url, item)
+        document = self.documents.record(self.item_namespace(item), file_url, new_hash)
+
+        # Files not modified since the last crawl were already logged when their response came in
+        if result["status"] == "uptodate":
+            status = "uptodate"
+        elif existing_hash is None:
+            logger.info(f"[S3 File Pipeline] New file {file_url}; stored as {file_key}")
+            status = "downloaded"
+        elif new_hash == existing_hash:
+            # If the hashes match, the file contents have not changed since it was last recorded for this package
+            logger.info(f"[S3 File Pipeline] Skipping unchanged file: {file_url} ({file_key})")
+            status = "uptodate"
+        else:
+            # Otherwise, the file contents have changed, and the new version has been stored
+            logger.info(f"[S3 File Pipeline] Changed file {file_url}; now version {document['version']} ({file_key})")
+            status = "downloaded"
+
+        file_result = {"url": file_url, "path": file_key, "checksum": new_hash, "status": status}
+        if status == "downloaded" and result.get("changes"):
+            file_result["changes"] = result["changes"]
+        return file_result
+
+    # Helper function, uploading a file's contents to the s3 bucket with its hash stored in the object's metadata; the transfer configuration
+    # is only built for the first upload, since it needs boto3
+    def upload_file(self, file_key, body, file_hash, content_type=None):
+        content_type = content_type or self._get_content_type(file_key)
+        if self.transfer_config is None:
+            self.transfer_config = transfer_config(self.chunk_size, self.multipart_threshold, self.multipart_concurrency)
+        upload_body(self.s3_client, self.s3_bucket, file_key, body, self.transfer_config, content_type, {"sha256": file_hash})
+
+    # Helper function, retrieving the hash of a file stored in the s3 bucket, or None if the file doesn't exist there yet
+    def fetch_existing_hash(self, file_key):
+        # The file may have been uploaded by an earlier crawl, so check the hash stored in its metadata with a head request
+        try:
+            head = self.s3_client.head_object(Bucket=self.s3_bucket, Key=file_key)
+        except ClientError as e:
+            if is_not_found(e):
+                return None
+            raise
+        existing_hash = head.get("Metadata", {}).get("sha256")
+
+        # Files uploaded before hashes were recorded have no hash in their metadata, so hash them from the bucket this one time
+        # and copy the hash into their metadata, so later crawls never have to read them back
+        if existing_hash is None:
+            logger.info(f"[S3 File Pipeline] No stored hash for {file_key}; Rebuilding from the s3 bucket...")
+            existing_hash = hash_s3_object(self.s3_client, self.s3_bucket, file_key, self.chunk_size)
+            try:
+                self.s3_client.copy_object(
                     Bucket=self.s3_bucket,
                     Key=file_key,
-                    Body=response.body,
-                    ContentType=content_type
+                    CopySource={"Bucket": self.s3_bucket, "Key": file_key},
+                    ContentType=head.get("ContentType", self._get_content_type(file_key)),
+                    Metadata={**head.get("Metadata", {}), "sha256": existing_hash},
+                    MetadataDirective="REPLACE"
                 )
-        except self.s3_client.exceptions.NoSuchKey:
-            # Otherwise, if the file is not found in the s3 bucket, it's new, so upload to AWS
-            logger.info(f"[S3 File Pipeline] New file {file_key}; Downloading...")
-            item["file_urls"].append(request.url)
-            content_type = self._get_content_type(file_key)            
-            self.s3_client.put_object(
-                Bucket=self.s3_bucket,
-                Key=file_key,
-                Body=response.body,
-                ContentType=content_type
-            )
+            except ClientError as e:
+                print(e.response)
+
+        return existing_hash
 
-        return new_hash
-    
     def media_failed(self, failure, request, info, *, item=None):
+        self.release_lane(request)
         logger.error(f"Media failed for {request.url}: {failure}")
+        self.fetched_documents.resolve(request.url, failure)
     
     def _get_content_type(self, file_key):
         """Determine content type based on file extension."""
@@ -99,6 +881,8 @@ class MedscraperPipeline(FilesPipeline):
             'pdf': 'application/pdf',
             'doc': 'application/msword',
             'docx': 'application/vnd.openxmlformats-officedocument.wordprocessingml.document',
+            'xls': 'application/vnd.ms-excel',
+            'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
             'txt': 'text/plain',
             'csv': 'text/csv',
             'html': 'text/html',
@@ -109,60 +893,52 @@ class MedscraperPipeline(FilesPipeline):
         return content_types.get(extension, 'application/octet-stream')
     
     # Helper function, fetching the main metadata dataframe if it exists in the s3 bucket, and creating a new one if not
-    def fetch_doc_data(self, file_path):
-        try:
-            # Fetch the requested file's dataframe from the s3 bucket if it exists
-            obj = self.s3_client.get_object(Bucket=self.s3_bucket, Key=file_path)
-            table = pd.read_csv(obj['Body'])
-            return table
-        except ClientError as e:
-            print(e.response)
+    def fetch_doc_data(self, name):
+        import pandas as pd
+        # A shard picks up its own copy of the table first, so one run again after failing or pausing keeps every row it already wrote
+        # (and discarded the journal for); only a shard without a copy yet starts from its states' rows in the shared table
+        table = None
+        if self.metadata_store is not self.metadata_source:
+            table = self.metadata_store.load(name)
+        if table is None:
+            table = self.metadata_source.load(name, states=self.shard_states)
 
-            # Otherwise, form new dataframes in the correct configuration
-            return pd.DataFrame(columns=["file_urls", "package_state", "package_site_path", "package_file_count", "package_retrieval_date", "package_last_checked"])
+        # Otherwise, form new dataframes in the correct configuration
+        if table is None:
+            table = pd.DataFrame(columns=MASTER_TABLE_COLUMNS)
+
+        # With text extraction enabled, the master table has a column summarizing each package's text changes
+        if self.text_extraction and name == "master_table" and CHANGES_COLUMN not in table:
+            table[CHANGES_COLUMN] = None
+        return table
         
+    # Helper function, merging a record into the master table for the metadata aggregator, timing how long it takes
+    def merge_record(self, df, new_record):
+        with self.metrics.timer("insert_or_update_seconds"):
+            return self.insert_or_update(df, new_record)
+
     # Function for inserting new records, or updating previous records after sanitization, and prevention of duplicate records to the dataframe 
-    def insert_or_update(self, df: pd.DataFrame, new_record: pd.Series) -> pd.DataFrame:    
-        # Helper function to sanitize incoming data from dataframes/series
-        def normalize(value):
-            if isinstance(value, str):
-                # Try to parse list-like strings into real lists
-                try:
-                    parsed = ast.literal_eval(value)
-                    if isinstance(parsed, list):
-                        return tuple(parsed)
-                except (ValueError, SyntaxError):
-                    pass
-                return value.strip()
-            if isinstance(value, list):
-                return tuple(value)
-            return value
-        
+    def insert_or_update(self, df: "pd.DataFrame", new_record: dict) -> "pd.DataFrame":    
         # Create a set of which columns to ignore and which to consider when making comparisons;
         # ignore timestamps, and create a list of every other column to compare between main table and new record
-        ignore_cols = {"package_retrieval_date", "package_last_checked"}
+        ignore_cols = {"package_retrieval_date", "package_last_checked", CHANGES_COLUMN}
         compare_cols = [col for col in df.columns if col not in ignore_cols]
 
-        # Take only the considered columns from the table and new record, and normalize them
-        normalized_df = df[compare_cols].map(normalize)
-        normalized_record = pd.Series({k: normalize(new_record[k]) for k in compare_cols})
+        # Reuse the index over the table's normalized values across calls, only rebuilding it when a different table comes in
+        if self.table_index is None or not self.table_index.is_current(df, compare_cols):
+            self.table_index = MasterTableIndex(df, compare_cols)
+        index = self.table_index
+
+        # Normalize only the new record's considered columns; the table's rows were normalized once when they were indexed
+        normalized_record = tuple(normalize_value(new_record[k]) for k in compare_cols)
 
         # Get only the rows from the table containing any of the file URLs present in the new record
-        file_mask = normalized_df[normalized_df['file_urls'].apply(lambda x: bool(set(x).intersection(set(normalized_record['file_urls']))))]
-        
-        # for idx, row in df[compare_cols].iterrows():
-        #     print(f"\n--- Row {idx} ---")
-        #     for col in compare_cols:
-        #         df_val = row[col]
-        #         record_val = new_record[col]
-        #         print(f"Column: {col}")
-        #         print(f"  DataFrame value: {df_val!r} (type: {type(df_val)})")
-        #         print(f"  New record value: {record_val!r} (type: {type(record_val)})")
+        file_rows = index.rows_with_files(normalized_record)
 
         # If there exist any rows from the table which contain a file URL matching one in the new record,
-        if not file_mask.empty:
+        if file_rows:
             # Create a new set containing every file URL from every row that was retrieved
-            matched_rows = set().union(*file_mask['file_urls'])
+            matched_rows = set().union(*(index.row_files(index.rows[label]) for label in file_rows))
             # Make a set out of the new record's file URLs
             nr_files = set(new_record['file_urls'])
             # Subtract the matched files from the new record's set of file URLs, and whatever is left is new
@@ -170,83 +946,141 @@ class MedscraperPipeline(FilesPipeline):
                     
             # If there are any unique files left,
             if unique_files:
-                # Set the normalized record's list of files to the list of unique files, for comparison
-                normalized_record['file_urls'] = tuple(unique_files)
+                # Set the normalized record's list of files to the list of unique files, for comparison, keeping them in the order they were scraped
+                unique_list = [f for f in dict.fromkeys(new_record['file_urls']) if f in unique_files]
+                normalized_record = normalized_record[:index.url_pos] + (tuple(unique_list),) + normalized_record[index.url_pos + 1:]
                 
-                # Retrieve the row from the table for which everything is exactly the same as the new, normalized, file-duplicate sanitized record
-                time_mask = (normalized_df == normalized_record).all(axis=1)
+                # Retrieve the rows from the table for which everything is exactly the same as the new, normalized, file-duplicate sanitized record
+                time_rows = index.find(normalized_record)
                 
                 # If the sanitized record already exists, simply update its timestamp
-                if time_mask.any():
-                    df.loc[time_mask, "package_last_checked"] = new_record["package_last_checked"]
+                if time_rows:
+                    self.touch_rows(index, time_rows, new_record)
                 else:
                 # Otherwise, the record is brand new, so set the new record's file list to the list of unique files, and add it to the table
-                    new_record['file_urls'] = list(unique_files)
-                    new_record['package_file_count'] = len(list(unique_files))
-                    df.loc[len(df)] = new_record
+                    new_record['file_urls'] = unique_list
+                    new_record['package_file_count'] = len(unique_list)
+                    df = self.append_record(df, new_record)
             else:
                 # As this record has no unique files, check if this exact record already exists
-                time_mask = (normalized_df == normalized_record).all(axis=1)
+                time_rows = index.find(normalized_record)
                 
                 # If so, simply update its timestamp
-                if time_mask.any():
-                    df.loc[time_mask, "package_last_checked"] = new_record["package_last_checked"]
+                if time_rows:
+                    self.touch_rows(index, time_rows, new_record)
                 else:
                 # Otherwise, if the new record contains all duplicate files, but does not already exist in the table, 
                 # this record contains no new information, so simply update every record's timestamp which contains a file in this record
-                    file_mask = file_mask.all(axis=1)
-                    # Convert the file mask's contents to native python booleans as opposed to numpy.bool_
-                    file_mask = file_mask.astype(bool)
-                    # Retrieve only the matching indices from the file mask
-                    matching_indices = file_mask[file_mask].index
+                # (skipping, as before, any matching rows with an empty or zero compared value)
+                    matching_indices = [label for label in file_rows if all(is_truthy(value) for value in index.rows[label])]
                     # Update the time stamp of the appropriate records
-                    df.loc[matching_indices, "package_last_checked"] = new_record["package_last_checked"]
+                    self.touch_rows(index, matching_indices, new_record)
         else:
             # Otherwise, only check if the record already exists
-            time_mask = (normalized_df == normalized_record).all(axis=1)
+            time_rows = index.find(normalized_record)
             
             # If so, update its timestamp
-            if time_mask.any():
-                df.loc[time_mask, "package_last_checked"] = new_record["package_last_checked"]
+            if time_rows:
+                self.touch_rows(index, time_rows, new_record)
             else:
             # If the new record neither contains duplicate files, nor already exists in the table, simply add it to the table
-                df.loc[len(df)] = new_record
+                df = self.append_record(df, new_record)
         
         # Return the newly updated table
         return df
+
+    # Helper function, refreshing the last checked timestamp of the rows matching a new record, along with a summary of the text changes the
+    # record found in each row's own files, if any
+    def touch_rows(self, index, labels, new_record):
+        index.set_value(labels, "package_last_checked", new_record["package_last_checked"])
+        changes = new_record.get(CHANGES_COLUMN)
+        if CHANGES_COLUMN in index.table.columns and isinstance(changes, dict):
+            for label in labels:
+                summary = describe_changes(changes, index.rows[label][index.url_pos])
+                if summary is not None:
+                    index.set_value([label], CHANGES_COLUMN, summary)
+
+    # Helper function, adding a new record to the end of the table; the row is buffered in the table's index until commit_rows is called
+    def append_record(self, df, new_record):
+        index = self.table_index
+        # Only the text changes in the row's own files are kept in it
+        if isinstance(new_record.get(CHANGES_COLUMN), dict):
+            new_record[CHANGES_COLUMN] = describe_changes(new_record[CHANGES_COLUMN], new_record["file_urls"])
+        label = len(df) + len(index.pending)
+
+        # Writing to an existing label replaces that row rather than adding one, so write it straight into the table as before
+        # and rebuild the index on the next call
+        if label in df.index or label in index.pending:
+            df = index.commit()
+            df.loc[len(df)] = new_record
+            self.table_index = None
+            # The replaced row's counts can't be taken back out of the rollups, so rebuild them on the next write
+            self.rollups.built = False
+            return df
+
+        index.add_pending(label, new_record)
+        self.rollups.add(new_record)
+        return df
+
+    # Helper function, adding every row buffered by insert_or_update to the table, returning the full table
+    def commit_rows(self, df):
+        if self.table_index is None or self.table_index.table is not df:
+            return df
+        return self.table_index.commit()
     
     def upload_metadata(self, item):
-        # Fetch current policy document metadata from s3 bucket, or create new dataframes for them if they dont exist
+        # Create new dataframe records from currently collected metadata in the item, and merge it into the in-memory master table;
+        # the tables are written back to the s3 bucket in batches by the aggregator. The item is copied, since the table now outlives
+        # this call and the item carries on through any later pipelines. The per-file results and depth aren't stored in the tables, and
+        # neither are text changes unless there are any. Records are plain dicts; everything merging them only needs to look values up
         # logger.info("HITTING UPLOAD METADATA IN PIPELINE:")
-        master_table = self.fetch_doc_data("doc-data/master_table.csv")
-        
-        # Create new dataframe records from currently collected metadata in the item
-        new_record = pd.Series(dict(item))
+        with self.metrics.timer("upload_metadata_seconds"):
+            new_record = {k: copy.copy(v) for k, v in ItemAdapter(item).items() if k not in ("package_depth", "files")}
+            if new_record.get(CHANGES_COLUMN) is None:
+                new_record.pop(CHANGES_COLUMN, None)
 
-        # Insert new file package metadata records into appropriate tables, and print the resulting tables to the console for confirmation
-        master_table = self.insert_or_update(master_table, new_record)
+            # Journal the record before merging it, so it's never lost between writes of the tables
+            if self.journal is not None:
+                self.journal.record(new_record)
+            self.add_record(new_record)
 
-        state_table = master_table.groupby(by = ['package_state', 'package_site_path']).agg({'package_file_count': 'sum'})
-        file_count_table = master_table.groupby('package_state').agg({'package_file_count': 'sum'})
+    # Helper function, merging a record into the master table
+    def add_record(self, new_record):
+        # Parquet tables hold real timestamps, so parse the spider's timestamp strings once here rather than on every write
+        if self.metadata_store.table_format == "parquet":
+            import pandas as pd
+            for col in TIMESTAMP_COLUMNS:
+                if col in new_record:
+                    new_record[col] = pd.to_datetime(new_record[col], format=TIMESTAMP_FORMAT)
 
-        master_table.to_csv("medscraper/doc-data/master_table.csv")
-        state_table.to_csv("medscraper/doc-data/state_table.csv")
-        file_count_table.to_csv("medscraper/doc-data/file_count_table.csv")
-        
-        # Finally, upload new file package metadata dataframes to s3 bucket
-        try:
-            for file, key in zip([master_table, state_table, file_count_table], ["doc-data/master_table.csv", "doc-data/state_table.csv", "doc-data/file_count_table.csv"]):
-                csv_buffer = io.StringIO()
-                file.to_csv(csv_buffer, index=False)
+        self.metadata.add(new_record)
 
-                self.s3_client.put_object(
-                    Bucket=self.s3_bucket,
-                    Key=key,
-                    Body=csv_buffer.getvalue(),
-                    ContentType="text/csv"
-                )
-        except ClientError as e:
-            print(e.response) 
+    def write_metadata(self, master_table):
+        # Build the per-state rollups from their running totals, which only have to be counted from the whole master table once per crawl
+        if not self.rollups.built:
+            self.rollups.rebuild(master_table)
+        state_table, file_count_table = self.rollups.tables()
 
-    
+        if self.verify_rollups:
+            mismatch = self.rollups.verify(master_table)
+            if mismatch is not None:
+                logger.error("[Metadata] Incremental rollups don't match a full recompute of the master table; rebuilding them")
+                state_table, file_count_table = mismatch
+                self.rollups.rebuild(master_table)
 
+        # Finally, write the new file package metadata dataframes to the local doc-data folder and upload them to the s3 bucket on the
+        # writer thread, checkpointing the journal along with them; it writes a snapshot of the master table, so the crawl can keep merging
+        # records into the live one in the meantime
+        tables = [("master_table", master_table.copy()), ("state_table", state_table), ("file_count_table", file_count_table)]
+        self.pending_write = self.checkpoint(tables)
+        self.pending_write.addErrback(lambda failure: logger.error(f"[Metadata] Failed to write metadata tables: {failure.getErrorMessage()}"))
+
+    # Helper function, run on the metadata writer thread; saves each table through the metadata store, returning whether they were stored
+    def save_tables(self, tables):
+        try:
+            for name, table in tables:
+                self.metadata_store.save(name, table)
+        except ClientError as e:
+            logger.warning(f"[Metadata] Failed to save the metadata tables: {e}")
+            return False
+        return True
@@ -1,8 +1,4 @@
 import os
-import logging
-
-logging.getLogger('botocore').setLevel(logging.DEBUG)
-logging.getLogger('boto3').setLevel(logging.DEBUG)
 
 # Scrapy settings for medscraper project
 #
@@ -29,8 +25,8 @@ USER_AGENT = 'Googlebot'
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
 
-# Configure maximum concurrent requests performed by Scrapy (default: 16)
-#CONCURRENT_REQUESTS = 32
+# Configure maximum concurrent requests performed by Scrapy (default: 16); per-host limits come from the domain profiles below
+CONCURRENT_REQUESTS = 32
 
 # Configure a delay for requests for the same website (default: 0)
 # See https://docs.scrapy.org/en/latest/topics/settings.html#download-delay
@@ -40,6 +36,13 @@ ROBOTSTXT_OBEY = True
 #CONCURRENT_REQUESTS_PER_DOMAIN = 16
 #CONCURRENT_REQUESTS_PER_IP = 16
 
+# Per-host concurrency, delay, timeout and retry limits are set by the domain_profiles on the spider, enforced by
+# MedscraperDownloaderMiddleware, which adapts them during the crawl from each host's latency and 429/5xx responses. Hosts without a
+# profile start from DOMAIN_PROFILE_DEFAULTS (see medscraper/throttle.py for every value); leave AutoThrottle off while these are enabled
+DOMAIN_PROFILES_ENABLED = True
+DOMAIN_PROFILES_ADAPTIVE = True
+DOMAIN_PROFILE_DEFAULTS = {}
+
 # Disable cookies (enabled by default)
 COOKIES_ENABLED = False
 
@@ -60,8 +63,10 @@ COOKIES_ENABLED = False
 
 # Enable or disable downloader middlewares
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html
+# MedscraperDownloaderMiddleware sits just outside RetryMiddleware (550), so it sees 429/5xx responses and failed downloads before
+# they're retried
 DOWNLOADER_MIDDLEWARES = {
-   "medscraper.middlewares.MedscraperDownloaderMiddleware": 543,
+   "medscraper.middlewares.MedscraperDownloaderMiddleware": 560,
 }
 
 # Enable or disable extensions
@@ -80,13 +85,133 @@ FILES_STORE = "s3://webscraped-docs-test/"
 # S3 Bucket setting
 S3_BUCKET = 'webscraped-docs-test'
 
+# S3 requests are run on a pool of S3_WORKER_THREADS threads rather than on the reactor thread, sharing one client with up to
+# S3_MAX_POOL_CONNECTIONS pooled connections; keep the pool at least as large as the number of threads
+S3_WORKER_THREADS = 16
+S3_MAX_POOL_CONNECTIONS = 32
+
+# Downloaded files are hashed on a pool of HASH_WORKER_THREADS threads, and pages are parsed for links on a pool of PARSE_WORKER_THREADS
+# threads, so one large manual or listing page doesn't hold up every other response on the reactor thread. Hashing releases the GIL, so
+# hashing threads run in parallel; link extraction mostly doesn't, so a parse pool only helps crawls with very large pages. 0 runs the work
+# on the reactor thread. Every pool's tasks, deepest queue and time spent waiting and working are in the stats as workers/<pool>/...
+HASH_WORKER_THREADS = 4
+PARSE_WORKER_THREADS = 0
+
+# Index of the SHA-256 hash of every stored policy document, kept in the s3 bucket and mirrored locally, so changed files can be
+# found without reading the stored copies back from the bucket
+HASH_INDEX_KEY = "doc-data/hash_index.json"
+HASH_INDEX_PATH = os.path.join(BASE_DIR, "doc-data", "hash_index.json")
+
+# Policy documents are stored once each under objects/<SHA-256>; the document manifest records which contents (and which version of them)
+# every url pointed to, with a namespace for every state and site path
+DOCUMENT_MANIFEST_KEY = "doc-data/document_manifest.json"
+DOCUMENT_MANIFEST_PATH = os.path.join(BASE_DIR, "doc-data", "document_manifest.json")
+
+# Journal every metadata record and manifest change made by the pipeline until the tables and manifests holding it are written out, so a
+# crawl that dies partway loses none of them; the next crawl replays what's left of the journal before crawling anything. The journal is
+# kept in METADATA_JOURNAL_DIR, or in the job's directory for a crawl run with a JOBDIR (scrapy crawl manuals -s JOBDIR=crawls/manuals-1),
+# which also keeps the scheduler's pending requests and the pages already scheduled, so a paused crawl (one Ctrl-C) resumes where it stopped
+METADATA_JOURNAL_ENABLED = True
+METADATA_JOURNAL_DIR = os.path.join(BASE_DIR, "doc-data", "journal")
+
+# Extract the text of PDF and .docx documents in TEXT_EXTRACTION_PROCESSES worker processes, and only treat a document as changed when its
+# text changes; a re-export that only changes its embedded metadata keeps the version already stored. Each object's text is stored next to
+# it as objects/<SHA-256>.text.json, the text index keeps its page hashes, and the master table's package_changes column summarizes which
+# pages changed. Requires pypdf and python-docx
+TEXT_EXTRACTION_ENABLED = False
+TEXT_EXTRACTION_PROCESSES = 2
+TEXT_INDEX_KEY = "doc-data/text_index.json"
+TEXT_INDEX_PATH = os.path.join(BASE_DIR, "doc-data", "text_index.json")
+
+# Send conditional requests (If-None-Match/If-Modified-Since) for policy documents using the validators the server sent on the last crawl,
+# skipping the hash check and upload for files it reports as unchanged
+CONDITIONAL_FETCH_ENABLED = True
+URL_VALIDATORS_KEY = "doc-data/url_validators.json"
+URL_VALIDATORS_PATH = os.path.join(BASE_DIR, "doc-data", "url_validators.json")
+
+# Policy documents larger than the threshold are uploaded to the s3 bucket as multipart uploads in parts of FILES_CHUNK_SIZE bytes,
+# sending up to FILES_MULTIPART_CONCURRENCY parts at a time; a downloaded document is held in memory in full either way, and an upload
+# buffers up to FILES_MULTIPART_CONCURRENCY x FILES_CHUNK_SIZE bytes of parts on top of it. Copies stored before hashes were recorded are
+# read back from the bucket in chunks of FILES_CHUNK_SIZE bytes to hash them
+FILES_CHUNK_SIZE = 8 * 1024 * 1024
+FILES_MULTIPART_THRESHOLD = 16 * 1024 * 1024
+FILES_MULTIPART_CONCURRENCY = 4
+
+# The metadata tables are kept in memory during a crawl and written to the s3 bucket and the local doc-data folder every
+# METADATA_FLUSH_INTERVAL seconds or METADATA_FLUSH_ITEMS records, whichever comes first, and when the spider closes
+METADATA_LOCAL_DIR = os.path.join(BASE_DIR, "doc-data")
+METADATA_FLUSH_INTERVAL = 60
+METADATA_FLUSH_ITEMS = 100
+
+# The state and file count tables are kept as running totals updated by every new master table row; set this to check them
+# against a full recompute from the master table on every write
+METADATA_VERIFY_ROLLUPS = False
+
+# Format the metadata tables are stored in; "csv", or "parquet" (requires pyarrow) for native list and timestamp columns.
+# Parquet master tables can also be partitioned by state, so single states can be read without pulling the whole table.
+# Existing CSV tables can be converted with: scrapy migrate_metadata
+METADATA_FORMAT = "csv"
+METADATA_PARTITION_BY_STATE = False
+
+# Crawl frontier limits for the spider; pages more than FRONTIER_MAX_DEPTH links away from a start url aren't crawled, and no more
+# than FRONTIER_MAX_PAGES pages are scheduled per state (0 for no limit). Either can be overridden per state, e.g. {"Florida": 500}
+FRONTIER_MAX_DEPTH = 0
+FRONTIER_MAX_PAGES = 0
+FRONTIER_STATE_MAX_DEPTH = {}
+FRONTIER_STATE_MAX_PAGES = {}
+
+# Pages and documents are downloaded in separate lanes; pages through the scheduler, closest to the start urls first, and documents
+# through a lane of at most DOCUMENT_LANE_CONCURRENCY downloads at once, those found closest to the start urls first. Each host's
+# documents get a download slot of their own, profiled like the host's pages with DOCUMENT_LANE_PROFILE applied on top
+LANES_ENABLED = True
+DOCUMENT_LANE_CONCURRENCY = 16
+DOCUMENT_LANE_PROFILE = {"concurrency": 2, "max_concurrency": 4, "delay": 0.0, "timeout": 600}
+
+# Discovery-only crawls find documents without downloading them, writing them to the document frontier instead; the documents spider
+# then downloads them in a separate run: scrapy crawl manuals -s DISCOVERY_ONLY=1, then scrapy crawl documents
+# They double as a dry run of the crawl, since they never create an s3 client or import pandas
+DISCOVERY_ONLY = False
+DOCUMENT_FRONTIER_PATH = os.path.join(BASE_DIR, "doc-data", "document_frontier.jsonl")
+
+# Opt in to skipping the packages of pages without any document links; they have nothing to download or record in the metadata tables,
+# so this only changes what's counted and exported as scraped items. Left off, every page crawled yields one item, as it always has
+SKIP_EMPTY_PACKAGES = False
+
+# Crawl state kept between runs for every listing page (validators, content hash and extracted links), so unchanged pages aren't parsed
+# again. Pages fetched less than CRAWLSTATE_REVISIT_HOURS ago aren't fetched at all, reusing their stored links instead (0 to always
+# revisit); the interval can be overridden per state, e.g. {"Florida": 24}. Set CRAWLSTATE_PATH to "" to start from scratch every run
+CRAWLSTATE_PATH = os.path.join(BASE_DIR, "doc-data", "crawl_state.sqlite3")
+CRAWLSTATE_REVISIT_HOURS = 0
+CRAWLSTATE_STATE_REVISIT_HOURS = {}
+
+# Discovery strategies by state, added to or overriding the spider's discovery_strategies: a state with one is discovered from its
+# sitemap or listing of pages and documents (see medscraper/discovery.py) instead of crawling its whole site from the start urls, and
+# pages whose last modified date in it hasn't changed since the last crawl aren't fetched at all. Set a state to None to crawl it from
+# its start urls, e.g. {"Florida": None}
+DISCOVERY_STRATEGIES = {}
+
+# States to crawl, e.g. ["Florida", "Alabama"], or every state with start urls on the spider if empty. Sharded crawls split the states
+# between several processes: scrapy crawl_sharded --shards 4. Each process is one shard, named by SHARD_NAME, which keeps its own copies of
+# the metadata tables and manifests under doc-data/shards/<shard>/ until they're merged back into the shared ones
+CRAWL_STATES = []
+SHARD_NAME = ""
+
+# Project-specific scrapy commands
+COMMANDS_MODULE = "medscraper.commands"
+
 MEDIA_ALLOW_REDIRECTS = True
 MEDIA_PIPELINES_ENABLED = True
 
 # 0 days of delay for file expiration, since we're always checking files contents before re-downloading
 FILES_EXPIRES = 0
 
-LOG_LEVEL = 'DEBUG'
+LOG_LEVEL = 'INFO'
+
+# Collect timing histograms for parsing pages, downloads from each site, hashing files, s3 requests and merging metadata records. At the
+# end of the crawl they're summarized in the crawl stats (metrics/<name>/count, sum, p50, p95 and max) and written to METRICS_EXPORT_PATH,
+# as Prometheus text, or as a JSON summary if the path ends in .json. Disabled, the instrumentation does nothing
+METRICS_ENABLED = False
+METRICS_EXPORT_PATH = os.path.join(BASE_DIR, "doc-data", "metrics.prom")
 
 # Enable and configure the AutoThrottle extension (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/autothrottle.html
@@ -103,11 +228,19 @@ LOG_LEVEL = 'DEBUG'
 
 # Enable and configure HTTP caching (disabled by default)
 # See https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
-#HTTPCACHE_ENABLED = True
-#HTTPCACHE_EXPIRATION_SECS = 0
-#HTTPCACHE_DIR = "httpcache"
-#HTTPCACHE_IGNORE_HTTP_CODES = []
-#HTTPCACHE_STORAGE = "scrapy.extensions.httpcache.FilesystemCacheStorage"
+#
+# For development and replay runs: scrapy crawl manuals -s HTTPCACHE_ENABLED=1 caches every page and document under .scrapy/httpcache/,
+# and -s HTTPCACHE_OFFLINE=1 replays a crawl from the cache alone, ignoring anything that isn't in it. HTML is stored gzipped and documents
+# as they are, each distinct body once; the cache is kept under HTTPCACHE_MAX_SIZE bytes (0 for no limit) by evicting the least recently
+# used responses. Cached responses expire after HTTPCACHE_EXPIRATION_SECS (0 for never), or a per-domain interval, e.g. {"www.tn.gov": 86400}
+HTTPCACHE_ENABLED = False
+HTTPCACHE_EXPIRATION_SECS = 0
+HTTPCACHE_DOMAIN_EXPIRATION_SECS = {}
+HTTPCACHE_DIR = "httpcache"
+HTTPCACHE_IGNORE_HTTP_CODES = [429, 500, 502, 503, 504]
+HTTPCACHE_STORAGE = "medscraper.httpcache.ContentCacheStorage"
+HTTPCACHE_MAX_SIZE = 4 * 1024 ** 3
+HTTPCACHE_OFFLINE = False
 
 # Set settings whose default value is deprecated to a future-proof value
 FEED_EXPORT_ENCODING = "utf-8"
@@ -0,0 +1,140 @@
+# Sharded crawls, splitting the states across several scrapy processes and merging their results back together
+#
+# Each shard crawls its own set of states and keeps its own copy of the metadata tables, hash index and validators under
+# doc-data/shards/<shard>/, starting from the shared ones, so the processes never write over each other. Once every shard has finished,
+# their tables and manifests are merged back into the shared ones, in the same layout a single-process crawl writes
+import os
+import shutil
+import logging
+from botocore.exceptions import ClientError
+from medscraper.manifests import Manifest
+from medscraper.metadata import MetadataStore, build_rollups
+
+logger = logging.getLogger(__name__)
+
+# Helper function, splitting the states into at most shard_count groups, dealing them out in turn so neighbouring states end up apart
+def split_states(states, shard_count):
+    shard_count = max(1, min(shard_count, len(states)))
+    return [states[i::shard_count] for i in range(shard_count)]
+
+# Helper function, moving a key in the s3 bucket under a shard's folder, e.g. doc-data/hash_index.json -> doc-data/shards/shard-0/hash_index.json
+def shard_key(key, shard):
+    prefix, _, name = key.rpartition("/")
+    return f"{prefix}/shards/{shard}/{name}" if prefix else f"shards/{shard}/{name}"
+
+# Helper function, moving a local path under a shard's folder next to it
+def shard_path(path, shard):
+    return os.path.join(os.path.dirname(path), "shards", shard, os.path.basename(path))
+
+# Helper function, merging the shards' master tables into the shared one; shards only ever crawl their own states, so each shard's copy
+# holds that state's rows from the shared table in their original order, followed by any rows the shard added. The original rows are
+# replaced in place, and the new rows appended shard by shard, the same as a single-process crawl would have left them
+def merge_master_tables(master_table, shard_tables):
+    import pandas as pd
+    if master_table is None:
+        master_table = pd.DataFrame()
+    positions = pd.Series(range(len(master_table)), index=master_table.index)
+    parts = []
+    replaced = pd.Series(False, index=master_table.index)
+    next_position = len(master_table)
+
+    for states, shard_table in shard_tables:
+        if shard_table is None:
+            continue
+        in_shard = master_table["package_state"].isin(states) if len(master_table) else replaced
+        original = positions[in_shard].tolist()
+        if len(shard_table) < len(original):
+            raise ValueError(f"Shard table for {', '.join(states)} has {len(shard_table)} rows, fewer than the {len(original)} it started from")
+
+        shard_table = shard_table.reset_index(drop=True)
+        added = len(shard_table) - len(original)
+        order = original + list(range(next_position, next_position + added))
+        next_position += added
+        parts.append(shard_table.assign(_merge_position=order))
+        replaced |= in_shard
+
+    parts.insert(0, master_table[~replaced].assign(_merge_position=positions[~replaced]))
+    merged = pd.concat(parts, ignore_index=True)
+    return merged.sort_values("_merge_position", kind="stable").drop(columns="_merge_position").reset_index(drop=True)
+
+# Merge every finished shard back into the shared metadata tables and manifests, then clear the shards' copies away. Returns whether
+# everything merged was stored; if anything couldn't be, the shards are kept as they are, to merge again once the bucket can be written
+def merge_shards(settings, s3_client, shards):
+    try:
+        stored = store_merged_shards(settings, s3_client, shards)
+    except ClientError as e:
+        logger.error(f"[Shards] Failed to store the merged shards: {e}")
+        stored = False
+    if not stored:
+        logger.error(f"[Shards] Keeping the {len(shards)} shards, since the merged tables and manifests weren't all stored")
+        return False
+
+    local_dir = settings.get("METADATA_LOCAL_DIR")
+    frontier_path = settings.get("DOCUMENT_FRONTIER_PATH")
+    for shard, _ in shards:
+        remove_shard(s3_client, settings.get("S3_BUCKET"), local_dir, shard)
+        if os.path.exists(shard_path(frontier_path, shard)):
+            os.remove(shard_path(frontier_path, shard))
+    return True
+
+# Helper function, merging the shards' tables, manifests and document frontiers and storing them in place of the shared ones, returning
+# whether every manifest was stored; errors storing the tables are raised
+def store_merged_shards(settings, s3_client, shards):
+    s3_bucket = settings.get("S3_BUCKET")
+    local_dir = settings.get("METADATA_LOCAL_DIR")
+    table_format = settings.get("METADATA_FORMAT", "csv")
+    partition_by_state = settings.getbool("METADATA_PARTITION_BY_STATE")
+
+    # Metadata tables; the rollups are recomputed from the merged master table rather than added up across shards
+    store = MetadataStore(s3_client, s3_bucket, local_dir, table_format=table_format, partition_by_state=partition_by_state)
+    shard_tables = []
+    for shard, states in shards:
+        shard_store = MetadataStore(s3_client, s3_bucket, os.path.join(local_dir, "shards", shard), table_format=table_format,
+                                    partition_by_state=partition_by_state, prefix=f"doc-data/shards/{shard}")
+        shard_table = shard_store.load("master_table")
+        if shard_table is None and not settings.getbool("DISCOVERY_ONLY"):
+            logger.warning(f"[Shards] {shard} ({', '.join(states)}) wrote no master table; keeping the shared rows for its states")
+        shard_tables.append((states, shard_table))
+
+    if any(table is not None for _, table in shard_tables):
+        master_table = merge_master_tables(store.load("master_table"), shard_tables)
+        state_table, file_count_table = build_rollups(master_table)
+        for name, table in zip(["master_table", "state_table", "file_count_table"], [master_table, state_table, file_count_table]):
+            store.save(name, table)
+        logger.info(f"[Shards] Merged {len(shards)} shards into a master table of {len(master_table)} rows")
+
+    # Hash index, validators, document manifest and text index; a shard's copy started from the shared one, so it holds every entry it
+    # knew about plus whatever it changed
+    stored = True
+    for key_setting, path_setting in [("HASH_INDEX_KEY", "HASH_INDEX_PATH"), ("URL_VALIDATORS_KEY", "URL_VALIDATORS_PATH"),
+                                      ("DOCUMENT_MANIFEST_KEY", "DOCUMENT_MANIFEST_PATH"), ("TEXT_INDEX_KEY", "TEXT_INDEX_PATH")]:
+        manifest = Manifest(s3_client, s3_bucket, settings.get(key_setting), settings.get(path_setting)).load()
+        for shard, _ in shards:
+            shard_manifest = Manifest(s3_client, s3_bucket, shard_key(settings.get(key_setting), shard),
+                                      shard_path(settings.get(path_setting), shard)).load()
+            for name, value in shard_manifest.entries.items():
+                manifest.set(name, value)
+        stored = manifest.save() and stored
+
+    # Document frontiers written by discovery-only shards, joined into the one the documents spider reads
+    frontier_path = settings.get("DOCUMENT_FRONTIER_PATH")
+    shard_frontiers = [shard_path(frontier_path, shard) for shard, _ in shards if os.path.exists(shard_path(frontier_path, shard))]
+    if shard_frontiers:
+        with open(frontier_path + ".tmp", "wb") as out:
+            for path in shard_frontiers:
+                with open(path, "rb") as f:
+                    shutil.copyfileobj(f, out)
+        os.replace(frontier_path + ".tmp", frontier_path)
+        logger.info(f"[Shards] Merged {len(shard_frontiers)} document frontiers into {frontier_path}")
+    return stored
+
+# Helper function, deleting a shard's copies of the tables and manifests from the s3 bucket and the local doc-data folder
+def remove_shard(s3_client, s3_bucket, local_dir, shard):
+    paginator = s3_client.get_paginator("list_objects_v2")
+    try:
+        for page in paginator.paginate(Bucket=s3_bucket, Prefix=f"doc-data/shards/{shard}/"):
+            for obj in page.get("Contents", []):
+                s3_client.delete_object(Bucket=s3_bucket, Key=obj["Key"])
+    except ClientError as e:
+        logger.warning(f"[Shards] Failed to remove {shard}'s copies from the s3 bucket: {e}")
+    shutil.rmtree(os.path.join(local_dir, "shards", shard), ignore_errors=True)
@@ -0,0 +1,37 @@
+import scrapy
+from pathlib import Path
+from medscraper.items import load_package
+from medscraper.lanes import read_document_frontier
+from medscraper.spiders.manual_spider import ManualSpider
+
+# Custom scrapy spider class DocumentSpider; downloads the policy documents found by a discovery-only run of ManualSpider, reading every
+# package of files from the document frontier it wrote and passing them through the same pipeline as a full crawl
+#
+# Usage: scrapy crawl documents [-a frontier=path/to/document_frontier.jsonl]
+class DocumentSpider(scrapy.Spider):
+    name = "documents"
+
+    # Documents are only downloaded from the same sites the discovery crawl was allowed to visit
+    allowed_domains = ManualSpider.allowed_domains
+
+    def __init__(self, frontier=None, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.frontier_path = frontier
+
+    async def start(self):
+        # Read the frontier through scrapy itself, so the packages are produced from a response callback like any other crawl's items
+        path = self.frontier_path or self.settings.get("DOCUMENT_FRONTIER_PATH")
+        yield scrapy.Request(Path(path).resolve().as_uri(), callback=self.parse, dont_filter=True)
+
+    def parse(self, response):
+        packages = read_document_frontier(response.body)
+        self.logger.info(f"Loaded {len(packages)} packages from the document frontier at {response.url}")
+
+        # Rebuild each package's item, closest to the start urls first, so the pipeline downloads their files in the same order as a full crawl
+        for package in packages:
+            yield load_package(
+                package["package_site_path"],
+                package["package_state"],
+                package["file_urls"],
+                package.get("package_depth", 0)
+            )
@@ -1,9 +1,16 @@
+import json
 import scrapy
-import re
-import us.states
-from medscraper.items import PolicyManualsPackage
-from scrapy.loader import ItemLoader
-from datetime import datetime
+import hashlib
+from medscraper.items import load_package
+from medscraper.urls import UrlClassifier, Frontier
+from medscraper.crawlstate import CrawlState
+from medscraper.metrics import metrics_for
+from medscraper.discovery import parse_strategy, iter_sitemap, iter_listing
+from functools import cached_property
+from scrapy.utils.defer import maybe_deferred_to_future
+from scrapy.utils.gz import gunzip, gzip_magic_number
+from scrapy.utils._compression import _DecompressionMaxSizeExceeded
+from w3lib.url import canonicalize_url
 
 # Custom scrapy spider class ManualSpider; extracts the most recent Billing Provider Policy Manual document files from state healthcare
 # sites, uploads the relevant/updated files, and collects and uploads metadata about the sites it visits and the files downloaded from
@@ -50,36 +57,352 @@ class ManualSpider(scrapy.Spider):
         "https://www.nctracks.nc.gov/": "North Carolina",
         "https://www.dmas.virginia.gov/": "Virginia"
     }
+
+    # State healthcare sites which the spider will begin crawling from, extracting policy documents as it goes; CRAWL_STATES limits a crawl
+    # to some of the states, which is how the crawl_sharded command splits them between processes
+    start_urls_by_state = {
+        # "Test": ["https://aaaaspider.com"],
+        "Florida": ["https://ahca.myflorida.com/medicaid/rules/adopted-rules-general-policies"],
+        # "Georgia": ["https://pamms.dhs.ga.gov/dfcs/medicaid/"],
+        # "Kentucky": ["https://www.kymmis.com/kymmis/Provider%20Relations/billingInst.aspx"],
+        # "Tennessee": ["https://www.tn.gov/tenncare/policy-guidelines/eligibility-policy.html"],
+        "Alabama": ["https://medicaid.alabama.gov/content/Gated/7.6.1G_Provider_Manuals/7.6.1.2G_Apr2025.aspx"],
+        # "Mississippi": ["https://medicaid.ms.gov/eligibility-policy-and-procedures-manual/"],
+        # "South Carolina": ["http://www1.scdhhs.gov/mppm/"],
+        # "North Carolina": ["https://www.nctracks.nc.gov/content/public/providers/provider-manuals.html"],
+        # "Virginia": ["https://www.dmas.virginia.gov/for-applicants/eligibility-guidance/eligibility-manual/"]
+    }
+
+    # Politeness profiles for each state site's host, applied by the downloader middleware: how many requests it's sent at once, the delay
+    # between them, the download timeout in seconds and how many times failed requests are retried. Concurrency and delay are starting
+    # points, adjusted during the crawl from the site's latency and 429/5xx responses, within min/max_concurrency and min/max_delay;
+    # anything left out comes from DOMAIN_PROFILE_DEFAULTS
+    domain_profiles = {
+        "ahca.myflorida.com": {"concurrency": 4, "delay": 0.5},
+        "flrules.org": {"concurrency": 2, "delay": 1.0},
+        "pamms.dhs.ga.gov": {"concurrency": 4, "delay": 0.5},
+        # Slow ASP.NET portal; keep it to one request at a time and give it longer to answer
+        "www.kymmis.com": {"concurrency": 1, "max_concurrency": 2, "delay": 2.0, "timeout": 300, "max_retries": 4, "target_latency": 5.0},
+        "www.tn.gov": {"concurrency": 4, "delay": 0.25},
+        "medicaid.alabama.gov": {"concurrency": 2, "delay": 1.0},
+        "medicaid.ms.gov": {"concurrency": 2, "delay": 1.0},
+        "www1.scdhhs.gov": {"concurrency": 2, "delay": 1.0},
+        # Static file host for South Carolina's documents; handles far more load than the site itself
+        "img1.scdhhs.gov": {"concurrency": 8, "max_concurrency": 16, "delay": 0.0, "timeout": 600, "target_latency": 10.0},
+        "www.nctracks.nc.gov": {"concurrency": 2, "delay": 1.0, "timeout": 300},
+        "www.dmas.virginia.gov": {"concurrency": 4, "delay": 0.5}
+    }
+
+    # States whose pages and documents are discovered from a sitemap or a listing of them, rather than by crawling their sites from the
+    # start urls; see discovery.py for the strategy formats. DISCOVERY_STRATEGIES adds to or overrides these (None to crawl a state from
+    # its start urls after all), and a state whose strategy fails falls back to its start urls
+    discovery_strategies = {
+        # "Test": {"type": "sitemap", "url": "https://aaaaspider.com/sitemap.xml"},
+    }
     
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Compile the link checks against the base paths and state prefixes once, rather than scanning them for every link
+        self.url_classifier = UrlClassifier(self.valid_base_urls, self.state_dict)
+
+    # Frontier tracking every page scheduled during the crawl, applying the depth and page budgets from the settings; built on first use,
+    # since the crawler's stats collector doesn't exist yet when the spider is created
+    @cached_property
+    def frontier(self):
+        return Frontier(
+            self.url_classifier,
+            max_depth=self.settings.getint("FRONTIER_MAX_DEPTH", 0),
+            max_pages=self.settings.getint("FRONTIER_MAX_PAGES", 0),
+            state_max_depth=self.settings.getdict("FRONTIER_STATE_MAX_DEPTH"),
+            state_max_pages=self.settings.getdict("FRONTIER_STATE_MAX_PAGES"),
+            stats=self.crawler.stats
+        )
+
+    # Crawl state carried over from earlier runs, holding every page's validators, content hash and extracted links
+    @cached_property
+    def crawl_state(self):
+        return CrawlState(
+            self.settings.get("CRAWLSTATE_PATH"),
+            revisit_hours=self.settings.getfloat("CRAWLSTATE_REVISIT_HOURS", 0),
+            state_revisit_hours=self.settings.getdict("CRAWLSTATE_STATE_REVISIT_HOURS")
+        )
+
+    # Whether pages without any document links still yield a package; they have nothing to download or record either way
+    @cached_property
+    def skip_empty_packages(self):
+        return self.settings.getbool("SKIP_EMPTY_PACKAGES", False)
+
+    # Pages are parsed for links on a pool of PARSE_WORKER_THREADS threads if set, or on the reactor thread (None) otherwise. The pool is
+    # imported here rather than at the top, since it imports the reactor, which the spider module mustn't do before scrapy installs one
+    @cached_property
+    def parse_workers(self):
+        threads = self.settings.getint("PARSE_WORKER_THREADS", 0)
+        if threads <= 0:
+            return None
+        from medscraper.workers import WorkerPool
+        workers = WorkerPool("parse", threads)
+        workers.instrument(self.crawler.stats, self.metrics)
+        return workers
+
+    # Discovery strategy for each state that has one, checked once on first use
+    @cached_property
+    def strategies(self):
+        specs = {**self.discovery_strategies, **self.settings.getdict("DISCOVERY_STRATEGIES")}
+        return {state: parse_strategy(state, spec) for state, spec in specs.items() if spec}
+
+    # Timing histograms shared with the middleware and pipeline; a no-op unless METRICS_ENABLED is set
+    @cached_property
+    def metrics(self):
+        return metrics_for(self.crawler)
+
+    def closed(self, reason):
+        # Save the crawl state if it was used during the crawl
+        if "crawl_state" in self.__dict__:
+            self.crawl_state.close()
+        # With a JOBDIR, keep the pages scheduled so far in the job's state when the crawl is paused, so the resumed crawl doesn't schedule
+        # them again; scrapy saves the state once every spider_closed handler (this one included) has run. A finished job starts over
+        if hasattr(self, "state") and "frontier" in self.__dict__:
+            if reason == "finished":
+                self.state.pop("frontier", None)
+            else:
+                self.state["frontier"] = self.frontier.snapshot()
+        if self.__dict__.get("parse_workers") is not None:
+            self.parse_workers.stop()
+
     # Function for checking if the url being requested begins with one of the desired base paths
     def is_allowed_url(self, url):
-        return any(url.startswith(prefix) for prefix in self.valid_base_urls)
+        return self.url_classifier.is_allowed(url)
     
     async def start(self):
-        # State healthcare sites which the spider will begin crawling from, extracting policy documents as it goes
-        urls = [
-            # "https://aaaaspider.com",
-            "https://ahca.myflorida.com/medicaid/rules/adopted-rules-general-policies",
-            # "https://pamms.dhs.ga.gov/dfcs/medicaid/",
-            # "https://www.kymmis.com/kymmis/Provider%20Relations/billingInst.aspx",
-            # "https://www.tn.gov/tenncare/policy-guidelines/eligibility-policy.html",
-            "https://medicaid.alabama.gov/content/Gated/7.6.1G_Provider_Manuals/7.6.1.2G_Apr2025.aspx",
-            # "https://medicaid.ms.gov/eligibility-policy-and-procedures-manual/",
-            # "http://www1.scdhhs.gov/mppm/",
-            # "https://www.nctracks.nc.gov/content/public/providers/provider-manuals.html",
-            # "https://www.dmas.virginia.gov/for-applicants/eligibility-guidance/eligibility-manual/"
-        ]
-        
-        for url in urls:
-            yield scrapy.Request(url=url, callback=self.parse)
+        # Only start from the states this crawl is limited to, if it's limited to any
+        states = self.settings.getlist("CRAWL_STATES") or list({**self.start_urls_by_state, **self.strategies})
+        unknown = [state for state in states if state not in self.start_urls_by_state and state not in self.strategies]
+        if unknown:
+            self.logger.warning(f"No start urls for {', '.join(unknown)}")
+
+        # A crawl resumed from a JOBDIR carries on with the requests its scheduler kept, so start pages it already scheduled aren't
+        # requested again
+        if "frontier" in getattr(self, "state", {}):
+            self.frontier.restore(self.state["frontier"])
+            self.logger.info(f"Resuming with {len(self.frontier)} pages already scheduled")
+
+        # States with a discovery strategy start from their sitemap or listing, and the rest from their start urls
+        for state in states:
+            if state in self.strategies:
+                yield self.discovery_request(state, self.strategies[state])
+            else:
+                for request in self.crawl_requests(state):
+                    yield request
+
+    # Helper function, requesting a state's start urls to crawl its site recursively. The frontier already filters out pages that were
+    # scheduled before, so requests skip scrapy's own duplicate filter. Start pages are always requested (conditionally, if they were
+    # crawled before), so everything replayed from the crawl state comes from a callback
+    def crawl_requests(self, state):
+        for url in self.start_urls_by_state.get(state, []):
+            if url not in self.frontier:
+                url = self.frontier.seed(url)
+                yield self.page_request(url, 0, self.crawl_state.get(url))
+
+    # Helper function, requesting a state's sitemap or listing; an HTML listing is crawled as a start page whose links are followed one
+    # level deep, and sitemaps and JSON listings are read for their entries
+    def discovery_request(self, state, strategy):
+        meta = {"discovery_state": state, "discovery_root": True}
+        if strategy["type"] == "listing" and strategy["format"] == "html":
+            url = self.frontier.seed(strategy["url"])
+            return self.page_request(url, 0, self.crawl_state.get(url), follow=1, errback=self.discovery_failed, **meta)
+        callback = self.parse_sitemap if strategy["type"] == "sitemap" else self.parse_listing
+        return scrapy.Request(strategy["url"], callback, errback=self.discovery_failed, meta=meta, dont_filter=True)
+
+    # A state whose sitemap or listing can't be fetched is crawled from its start urls instead
+    def discovery_failed(self, failure):
+        state = failure.request.meta["discovery_state"]
+        self.logger.warning(f"Discovery failed for {state} ({failure.getErrorMessage()}), crawling from its start urls instead")
+        yield from self.discovery_fallback(state)
+
+    def discovery_fallback(self, state):
+        self.crawler.stats.inc_value("discovery/fallback")
+        yield from self.crawl_requests(state)
+
+    # Helper function, building the request for a page; if the server sent validators for it on an earlier crawl, the request is conditional
+    # and a 304 Not Modified response is passed to parse. Links are followed follow levels deep from the page, or as deep as the frontier
+    # allows if None
+    def page_request(self, url, depth, page, follow=None, errback=None, **meta):
+        return scrapy.Request(
+            url,
+            self.parse if self.parse_workers is None else self.parse_offloaded,
+            headers=self.crawl_state.conditional_headers(page),
+            meta={"page_key": url, "page_depth": depth, "follow_links": follow, "handle_httpstatus_list": [304], **meta},
+            errback=errback,
+            # Pages closer to the start urls are crawled first
+            priority=-depth,
+            dont_filter=True
+        )
+
+    # Schedule a page admitted by the frontier. Pages that are due for a revisit are requested, and pages that aren't due yet are replayed
+    # from the crawl state without being fetched, following their stored links
+    def schedule(self, url, depth, follow=None):
+        pending = [(url, depth, follow)]
+        while pending:
+            url, depth, follow = pending.pop()
+            page = self.crawl_state.get(url)
+            if self.crawl_state.is_due(page):
+                yield self.page_request(url, depth, page, follow)
+                continue
+
+            self.crawler.stats.inc_value("crawlstate/pages_replayed")
+            item = self.replay_package(page, depth)
+            if item is not None:
+                yield item
+            if follow == 0:
+                continue
+            for link in page["page_links"]:
+                next_url = self.frontier.admit(link, depth + 1)
+                if next_url is not None:
+                    pending.append((next_url, depth + 1, None if follow is None else follow - 1))
+
+    # Helper function, the package for a page replayed from the crawl state without being fetched, or None if it has no documents
+    def replay_package(self, page, depth):
+        if page["doc_links"] or not self.skip_empty_packages:
+            return self.build_item(page["site_path"], page["state"], page["doc_links"], depth)
+        self.crawler.stats.inc_value("packages/skipped_empty")
+        return None
+
+    # Read a sitemap, or a sitemap index, requesting the sitemaps it lists and the pages and documents it lists within the state's scope
+    def parse_sitemap(self, response):
+        discovery = {"state": response.meta["discovery_state"], "docs": {}, "found": 0}
+        body = self.sitemap_body(response)
+        if body is None:
+            yield from self.discovery_done(response, discovery)
+            return
+        for kind, loc, lastmod in iter_sitemap(body):
+            self.crawler.stats.inc_value("discovery/sitemap/entries")
+            if kind == "sitemap":
+                discovery["found"] += 1
+                yield scrapy.Request(
+                    response.urljoin(loc), self.parse_sitemap, meta={"discovery_state": discovery["state"]}, dont_filter=True
+                )
+            else:
+                yield from self.discovered(discovery, response.urljoin(loc), lastmod)
+        yield from self.discovery_done(response, discovery)
+
+    # Helper function, a sitemap's XML, gunzipped if it was fetched as a .xml.gz file, or None if it decompresses past the download size
+    # limit. Mirrors scrapy's SitemapSpider: the limit only applies to the response as downloaded, so a small gzipped sitemap could
+    # otherwise grow into gigabytes of XML once decompressed
+    def sitemap_body(self, response):
+        if not gzip_magic_number(response):
+            return response.body
+        max_size = response.meta.get("download_maxsize", getattr(self, "download_maxsize", self.settings.getint("DOWNLOAD_MAXSIZE")))
+        warn_size = response.meta.get("download_warnsize", getattr(self, "download_warnsize", self.settings.getint("DOWNLOAD_WARNSIZE")))
+        try:
+            body = gunzip(response.body, max_size=max_size)
+        except _DecompressionMaxSizeExceeded:
+            self.logger.warning(
+                f"Sitemap for {response.meta['discovery_state']} is larger than {max_size} bytes once decompressed, skipping it: {response.url}"
+            )
+            self.crawler.stats.inc_value("discovery/sitemap/too_large")
+            return None
+        if len(response.body) < warn_size <= len(body):
+            self.logger.warning(
+                f"Sitemap for {response.meta['discovery_state']} is {len(body)} bytes once decompressed, larger than the download warning "
+                f"size ({warn_size} bytes): {response.url}"
+            )
+        return body
+
+    # Read a JSON listing, requesting the pages and documents it lists within the state's scope
+    def parse_listing(self, response):
+        discovery = {"state": response.meta["discovery_state"], "docs": {}, "found": 0}
+        try:
+            data = json.loads(response.body)
+        except ValueError:
+            self.logger.warning(f"Listing for {discovery['state']} isn't valid JSON: {response.url}")
+            data = None
+        for _, url, lastmod in iter_listing(data, self.strategies[discovery["state"]]):
+            self.crawler.stats.inc_value("discovery/listing/entries")
+            yield from self.discovered(discovery, response.urljoin(url), lastmod)
+        yield from self.discovery_done(response, discovery)
+
+    # Helper function, handling a page or document listed by a sitemap or listing. Documents are collected into the sitemap's package, and
+    # pages are fetched without following their links, since the sitemap lists those too. A page whose last modified date is the same as
+    # when it was last fetched isn't fetched again; its documents are replayed from the crawl state instead
+    def discovered(self, discovery, url, lastmod):
+        if self.url_classifier.is_document(url):
+            if self.url_classifier.is_allowed(url) or self.url_classifier.state_for(url) == discovery["state"]:
+                discovery["docs"][url] = None
+            return
+
+        url = self.frontier.admit(url, 1)
+        if url is None:
+            return
+        discovery["found"] += 1
+        page = self.crawl_state.get(url)
+        if lastmod is not None and page is not None and self.crawl_state.lastmod(url) == lastmod:
+            self.crawler.stats.inc_value("discovery/unchanged")
+            item = self.replay_package(page, 1)
+            if item is not None:
+                yield item
+            return
+        yield self.page_request(url, 1, page, follow=0, lastmod=lastmod)
+
+    # Helper function, yielding the package of documents a sitemap or listing listed directly, and falling back to the recursive crawl if
+    # the state's sitemap or listing had nothing in scope at all
+    def discovery_done(self, response, discovery):
+        if discovery["docs"]:
+            yield self.build_item(response.url, discovery["state"], list(discovery["docs"]))
+        elif response.meta.get("discovery_root") and not discovery["found"]:
+            self.logger.warning(f"Nothing in scope for {discovery['state']} in {response.url}, crawling from its start urls instead")
+            yield from self.discovery_fallback(discovery["state"])
 
     def parse(self, response):
-        # Load in the custom scrapy item class PolicyManualsPackage, representing a package of files and its metadata downloaded from a particular url
-        # and the response passed in from the spider
-        loader = ItemLoader(item=PolicyManualsPackage(), response=response)
+        # Time the page's own work (checking it against the crawl state and extracting its links), but not scheduling the pages it links to
+        with self.metrics.timer("parse_seconds"):
+            page = self.read_page(response)
+            if page is None:
+                return
+            if page["doc_links"] is None:
+                self.links_extracted(page, self.extract_links(response))
+        yield from self.follow_page(page)
+
+    # The same as parse, with the page's links extracted on the parse worker pool, so a large page doesn't hold up every other response
+    # while its selectors run; the time spent extracting links is counted in the pool's stats rather than in parse_seconds
+    async def parse_offloaded(self, response):
+        with self.metrics.timer("parse_seconds"):
+            page = self.read_page(response)
+        if page is None:
+            return
+        if page["doc_links"] is None:
+            links = await maybe_deferred_to_future(self.parse_workers.run(self.extract_links, response))
+            self.links_extracted(page, links)
+        for result in self.follow_page(page):
+            yield result
+
+    # Helper function, checking a page against the crawl state; returns the page's site path, state and links, with the links left as None
+    # if the page is new or changed and has to be parsed for them, or None if the page can't be followed at all
+    def read_page(self, response):
+        # Pages are stored in the crawl state under the url they were requested with, which stays the same even if the page redirects
+        page_key = response.meta.get("page_key") or canonicalize_url(response.url)
+        page_depth = response.meta.get("page_depth", response.meta.get("depth", 0))
+        stored = self.crawl_state.get(page_key)
+        # Pages discovered from a sitemap or listing keep the last modified date it gave for them, so they aren't fetched again until it changes
+        if response.meta.get("lastmod") is not None:
+            self.crawl_state.record_lastmod(page_key, response.meta["lastmod"])
+
+        if response.status == 304:
+            # The server reports the page hasn't changed since the last fetch, so reuse the links stored for it
+            if stored is None:
+                self.logger.warning(f"Not Modified response for a page with no stored crawl state: {response.url}")
+                return None
+            self.crawler.stats.inc_value("crawlstate/pages_not_modified")
+            self.crawl_state.touch(page_key)
+            return {
+                "key": page_key, "depth": page_depth, "site_path": stored["site_path"], "state": stored["state"], "response": None,
+                "doc_links": stored["doc_links"], "page_links": stored["page_links"], "follow": response.meta.get("follow_links"),
+                "discovery_state": response.meta.get("discovery_state")
+            }
 
-        # Get every link on the site
-        all_links = response.css('a::attr(href)').getall()
+        # Pages that redirected to a document file can't be parsed for links; the file itself is picked up from the pages linking to it
+        if not isinstance(response, scrapy.http.TextResponse):
+            self.logger.info(f"Skipping non-HTML response: {response.url}")
+            return None
 
         # Parse the entire site's text, search for which state the package is associated with, and load it into the item
         # site_text = response.text
@@ -87,41 +410,70 @@ class ManualSpider(scrapy.Spider):
         # for state in us.states.STATES:
         #     if state.name in site_text:
         #         loader.replace_value("package_state", state.name)
-        
+
         # Check the current link's prefix against the stored dict to find its matching associated state
-        loader.add_value("package_state", "Invalid")
-        for state_url in self.state_dict.keys():
-            if response.url.startswith(state_url):
-                loader.replace_value("package_state", self.state_dict[state_url])
-
-        # Collect every link on the site leading to either a .pdf or a .docx file, and retrieve/store the full url
-        file_urls = []
-        for link in all_links:
-            full_link = response.urljoin(link)
-            if re.search(r'\.pdf$', link, re.IGNORECASE) or re.search(r'\.docx$', link, re.IGNORECASE):
-                file_urls.append(full_link)
-            
-            if self.is_allowed_url(full_link): 
-                yield scrapy.Request(full_link, self.parse)
-                
-        # Convert the list of links to a dict to filter out duplicates, convert back to a list to preserve the lexicographic order,
-        # then load all the links and the link count into the item
-        file_urls = list(dict.fromkeys(file_urls))
-        loader.add_value("file_urls", file_urls)
-        loader.add_value("package_file_count", len(file_urls))
-
-        # Generate a timestamp for when these files and metadata were retrieved, and load them into the item
-        timestamp = datetime.now().strftime("%m/%d/%Y %I:%M:%S %p")
-        loader.add_value("package_retrieval_date", timestamp)
-        loader.add_value("package_last_checked", timestamp)
-
-        # Load the current site path the spider is on into the item
-        loader.add_value("package_site_path", response.url)
-
-        # Log success for downloading the item, print the timestamp, and populate the item with all collected data
-        self.logger.info(f"Package downloaded. Timestamp: {timestamp}")
-        file_package_item = loader.load_item()
+        page = {
+            "key": page_key, "depth": page_depth, "site_path": response.url, "state": self.url_classifier.state_for(response.url),
+            "response": response, "content_hash": hashlib.sha256(response.body).hexdigest(), "doc_links": None, "page_links": None,
+            "follow": response.meta.get("follow_links"), "discovery_state": response.meta.get("discovery_state")
+        }
+
+        # Only parse the page for links if its HTML changed since the last crawl, otherwise reuse the links stored for it
+        if stored is not None and stored["content_hash"] == page["content_hash"]:
+            self.crawler.stats.inc_value("crawlstate/pages_unchanged")
+            self.links_extracted(page, (stored["doc_links"], stored["page_links"]))
+        return page
+
+    # Helper function, filling in a fetched page's links and recording them in the crawl state
+    def links_extracted(self, page, links):
+        page["doc_links"], page["page_links"] = links
+        self.crawl_state.record(
+            page["key"], page["site_path"], page["state"], page["response"], page["content_hash"], page["doc_links"], page["page_links"]
+        )
+
+    # Helper function, scheduling the pages a page links to and yielding its package
+    def follow_page(self, page):
+        doc_links, page_links, depth = page["doc_links"], page["page_links"], page["depth"] + 1
+        self.metrics.observe("page_document_links", len(doc_links))
+        self.metrics.observe("page_links", len(page_links))
+
+        # Pass every in-scope page link through the frontier, which only schedules pages that haven't been seen yet and are within the
+        # state's depth and page budgets; pages found through a sitemap or listing only follow their links as far as it says
+        follow = page["follow"]
+        if follow != 0:
+            for link in page_links:
+                next_url = self.frontier.admit(link, depth)
+                if next_url is not None:
+                    yield from self.schedule(next_url, depth, None if follow is None else follow - 1)
+
+        # An HTML listing without any documents or pages in scope falls back to crawling its state from the start urls
+        if page["discovery_state"] and page["depth"] == 0 and not doc_links and not page_links:
+            self.logger.warning(f"Nothing in scope for {page['discovery_state']} in {page['site_path']}, crawling from its start urls instead")
+            yield from self.discovery_fallback(page["discovery_state"])
 
         # Return the fully populated file package item, which uploads all collected policy documents to s3 bucket
-        yield file_package_item
+        if doc_links or not self.skip_empty_packages:
+            yield self.build_item(page["site_path"], page["state"], doc_links, page["depth"])
+        else:
+            self.crawler.stats.inc_value("packages/skipped_empty")
+
+    # Helper function, extracting the full urls of every policy document file (.pdf, .doc/.docx or .xls/.xlsx, with or without a query string)
+    # and every in-scope page linked from a site
+    def extract_links(self, response):
+        # Links are collected as dict keys to filter out duplicates as they're found, keeping the order they appear in on the page
+        doc_links, page_links = {}, {}
+        for link in response.css('a::attr(href)').getall():
+            full_link = response.urljoin(link)
+            if self.url_classifier.is_document(link):
+                doc_links[full_link] = None
+            elif self.url_classifier.is_allowed(full_link):
+                page_links[full_link] = None
+        return list(doc_links), list(page_links)
+
+    # Helper function, populating the item for a site's package of files
+    def build_item(self, site_path, state, file_urls, depth=0):
+        item = load_package(site_path, state, file_urls, depth)
 
+        # Log success for downloading the item, and print the timestamp
+        self.logger.info(f"Package downloaded. Timestamp: {item.package_retrieval_date}")
+        return item
@@ -0,0 +1,46 @@
+# Helpers for hashing and uploading policy documents
+#
+# A downloaded document's body is already held in memory in full by the time the pipeline sees it (scrapy downloads it into one buffer),
+# so it's hashed in one pass and uploaded without being copied. Uploads go through boto3's managed transfer, which splits anything above
+# the multipart threshold into parts uploaded in parallel, holding up to max_concurrency parts of chunk_size bytes on top of the body.
+# Stored copies are read back from the s3 bucket as a stream, one chunk at a time
+import io
+import hashlib
+
+# Helper function, computing the SHA-256 hash of a sequence of chunks incrementally as they arrive
+def hash_chunks(chunks):
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk)
+    return digest.hexdigest()
+
+# Helper function, hashing a downloaded file's body; it's in memory already, so hashing it in chunks wouldn't hold any less of it
+def hash_body(body):
+    return hashlib.sha256(body).hexdigest()
+
+# Helper function, hashing a file stored in the s3 bucket while streaming it back, so only one chunk of it is ever held in memory
+def hash_s3_object(s3_client, s3_bucket, file_key, chunk_size):
+    s3_file = s3_client.get_object(Bucket=s3_bucket, Key=file_key)
+    return hash_chunks(s3_file["Body"].iter_chunks(chunk_size))
+
+# Helper function, building the transfer configuration for uploads; bodies above the threshold are sent as a multipart upload
+# with parts of chunk_size bytes, up to max_concurrency of them at a time. boto3 is only imported here, once the first upload needs it
+def transfer_config(chunk_size, multipart_threshold, max_concurrency):
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=multipart_threshold,
+        multipart_chunksize=chunk_size,
+        max_concurrency=max_concurrency,
+        io_chunksize=min(chunk_size, 256 * 1024)
+    )
+
+# Helper function, uploading a file's body to the s3 bucket through the managed transfer; the body is wrapped without being copied,
+# and each part is read from it only when it's about to be sent, so at most max_concurrency parts are buffered alongside it
+def upload_body(s3_client, s3_bucket, file_key, body, config, content_type, metadata):
+    s3_client.upload_fileobj(
+        io.BytesIO(body),
+        s3_bucket,
+        file_key,
+        ExtraArgs={"ContentType": content_type, "Metadata": metadata},
+        Config=config
+    )
@@ -0,0 +1,94 @@
+# Per-domain politeness profiles for the state sites, adjusted while the crawl runs from how each site is responding
+#
+# Every host gets its own concurrency, download delay, timeout and retry limit, starting from the profile configured for it on the spider
+# (or the defaults, for hosts without one). Each profile then adapts: it slowly speeds up while the site answers quickly and successfully,
+# and backs off sharply (halving its concurrency and doubling its delay) as soon as the site answers with 429 Too Many Requests or a 5xx
+# error, or stops answering at all
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Profile values used for any host without a profile of its own, and for any values a host's profile leaves out
+DEFAULT_PROFILE = {
+    "concurrency": 4,
+    "min_concurrency": 1,
+    "max_concurrency": 8,
+    "delay": 0.25,
+    "min_delay": 0.0,
+    "max_delay": 60.0,
+    "timeout": 180,
+    "max_retries": 2,
+    "target_latency": 2.0
+}
+
+# Number of successful responses needed per concurrent request before a profile speeds up again
+SUCCESS_WINDOW = 5
+# Weight given to the newest latency in the moving average
+LATENCY_SMOOTHING = 0.3
+
+class DomainProfile:
+    def __init__(self, slot, concurrency, delay, timeout, max_retries, min_concurrency=1, max_concurrency=8, min_delay=0.0,
+                 max_delay=60.0, target_latency=2.0):
+        # Download slot the profile applies to; a host's name for its pages, or the host's document slot
+        self.slot = slot
+        self.concurrency = concurrency
+        self.delay = delay
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max(max_concurrency, concurrency)
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.target_latency = target_latency
+
+        self.latency = None
+        self.successes = 0
+
+    # Build a profile for a download slot from its configured values, filling in anything left out from the defaults
+    @classmethod
+    def from_config(cls, slot, config=None, defaults=None):
+        values = {**DEFAULT_PROFILE, **(defaults or {}), **(config or {})}
+        return cls(slot, **{name: values[name] for name in DEFAULT_PROFILE})
+
+    # Record a successful response's latency, speeding the profile up once a full window of responses has come back within the target
+    # latency, or slowing it down if responses are taking far longer than that. Returns whether the profile changed
+    def on_success(self, latency=None):
+        if latency is not None:
+            self.latency = latency if self.latency is None else LATENCY_SMOOTHING * latency + (1 - LATENCY_SMOOTHING) * self.latency
+        self.successes += 1
+
+        # The site is slowing down under the current load, so ease off by one request
+        if self.latency is not None and self.latency > 2 * self.target_latency and self.concurrency > self.min_concurrency:
+            self.concurrency -= 1
+            self.successes = 0
+            return True
+
+        if self.successes < SUCCESS_WINDOW * self.concurrency or (self.latency is not None and self.latency > self.target_latency):
+            return False
+
+        # Shorten the delay first, and only add concurrency once the delay is down to its minimum
+        self.successes = 0
+        if self.delay > self.min_delay:
+            self.delay = max(self.min_delay, self.delay * 0.75)
+            if self.delay < 0.05:
+                self.delay = self.min_delay
+            return True
+        if self.concurrency < self.max_concurrency:
+            self.concurrency += 1
+            return True
+        return False
+
+    # Back off after a 429/5xx response or a failed download, honoring the server's Retry-After if it sent one
+    def on_backoff(self, retry_after=None):
+        self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+        self.delay = min(self.max_delay, max(self.delay * 2, 1.0, retry_after or 0))
+        self.successes = 0
+
+# Helper function, reading a Retry-After header given in seconds; dates are ignored, since the doubled delay covers those well enough
+def parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return float(value.decode("latin-1") if isinstance(value, bytes) else value)
+    except ValueError:
+        return None
@@ -0,0 +1,129 @@
+# URL classification for the spider's link extraction, built once per spider
+#
+# Every link on a page gets checked for whether it points at a policy document, whether it's inside one of the allowed base paths,
+# and which state a page belongs to. Prefixes are grouped by origin (scheme and host), so each check only looks at the handful of
+# prefixes on the link's own host instead of scanning every one of them
+import re
+from collections import defaultdict
+from w3lib.url import canonicalize_url
+
+# Links ending in a document extension, optionally followed by a query string or fragment (e.g. manual.pdf?ver=3)
+DOCUMENT_LINK_RE = re.compile(r"\.(?:pdf|docx?|xlsx?)(?:[?#].*)?$", re.IGNORECASE)
+
+# Helper function, cutting a url down to its scheme and host, e.g. https://www.tn.gov/tenncare/ -> https://www.tn.gov
+def url_origin(url):
+    host_start = url.find("//") + 2
+    path_start = url.find("/", host_start)
+    return url if path_start == -1 else url[:path_start]
+
+class UrlClassifier:
+    def __init__(self, valid_base_urls, state_dict):
+        # Allowed base paths, grouped by origin into tuples so each lookup is a single startswith call
+        grouped = defaultdict(list)
+        for prefix in valid_base_urls:
+            grouped[url_origin(prefix)].append(prefix)
+        self.prefixes = {origin: tuple(prefixes) for origin, prefixes in grouped.items()}
+
+        # State prefixes, grouped by origin, keeping the order of state_dict so the last matching prefix still wins
+        self.states = defaultdict(list)
+        for prefix, state in state_dict.items():
+            self.states[url_origin(prefix)].append((prefix, state))
+
+    # Check if a link leads to a policy document file
+    def is_document(self, link):
+        return DOCUMENT_LINK_RE.search(link) is not None
+
+    # Check if the url being requested begins with one of the allowed base paths
+    def is_allowed(self, url):
+        prefixes = self.prefixes.get(url_origin(url))
+        return prefixes is not None and url.startswith(prefixes)
+
+    # Find the state a url belongs to from its prefix, or the default if it matches none of them
+    def state_for(self, url, default="Invalid"):
+        found = default
+        for prefix, state in self.states.get(url_origin(url), ()):
+            if url.startswith(prefix):
+                found = state
+        return found
+
+# Spider-side crawl frontier; decides which links found on a page get scheduled as new pages
+#
+# Links are canonicalized (fragment dropped, query arguments sorted, percent-encoding normalized, scheme and host lowercased) and checked against the set of pages already scheduled, so each page is only requested once without
+# building a Request for every duplicate link. Document links are never scheduled as pages (they're handled by the files pipeline),
+# and each state can be limited to a maximum link depth and number of pages. Limits of 0 mean unlimited
+class Frontier:
+    def __init__(self, classifier, max_depth=0, max_pages=0, state_max_depth=None, state_max_pages=None, stats=None):
+        self.classifier = classifier
+        self.max_depth = max_depth
+        self.max_pages = max_pages
+        self.state_max_depth = state_max_depth or {}
+        self.state_max_pages = state_max_pages or {}
+        self.stats = stats
+        self.seen = set()
+        self.pages = defaultdict(int)
+
+    def __contains__(self, url):
+        return canonicalize_url(url) in self.seen
+
+    def __len__(self):
+        return len(self.seen)
+
+    # Helper function, incrementing one of the frontier's crawl stats
+    def inc_stat(self, name):
+        if self.stats is not None:
+            self.stats.inc_value(f"frontier/{name}")
+
+    # Mark a start url as scheduled, so links back to it aren't requested again
+    def seed(self, url):
+        url = canonicalize_url(url)
+        if url not in self.seen:
+            self.seen.add(url)
+            self.pages[self.classifier.state_for(url)] += 1
+            if self.stats is not None:
+                self.stats.set_value("frontier/size", len(self.seen))
+        return url
+
+    # Check a link found at the given depth, returning the canonical url to request if it should be scheduled, or None if not
+    def admit(self, url, depth=0):
+        url = canonicalize_url(url)
+
+        if url in self.seen:
+            self.inc_stat("duplicates_rejected")
+            return None
+
+        # Documents are downloaded by the files pipeline from the page's item, never parsed as pages
+        if self.classifier.is_document(url):
+            self.inc_stat("documents_rejected")
+            return None
+
+        if not self.classifier.is_allowed(url):
+            return None
+
+        # Check the state's depth and page budgets; links past the depth limit aren't marked as seen, since the same page might
+        # still be reached through a shorter path
+        state = self.classifier.state_for(url)
+        depth_limit = self.state_max_depth.get(state, self.max_depth)
+        if depth_limit and depth > depth_limit:
+            self.inc_stat("depth_rejected")
+            return None
+
+        page_limit = self.state_max_pages.get(state, self.max_pages)
+        if page_limit and self.pages[state] >= page_limit:
+            self.inc_stat("budget_rejected")
+            return None
+
+        self.seen.add(url)
+        self.pages[state] += 1
+        if self.stats is not None:
+            self.stats.set_value("frontier/size", len(self.seen))
+        return url
+
+    # The pages scheduled so far, for a crawl that's paused with a JOBDIR to pick up again on resume
+    def snapshot(self):
+        return {"seen": self.seen, "pages": dict(self.pages)}
+
+    def restore(self, snapshot):
+        self.seen = set(snapshot["seen"])
+        self.pages = defaultdict(int, snapshot["pages"])
+        if self.stats is not None:
+            self.stats.set_value("frontier/size", len(self.seen))
@@ -0,0 +1,152 @@
+# Bounded thread pools for running blocking work (s3 requests, hashing, table serialization) off the Twisted reactor thread, and process
+# pools for CPU-bound work (text extraction) that would hold the GIL on any thread
+#
+# Everything scrapy does (downloading, parsing, running pipeline callbacks) happens on the reactor thread, so a blocking boto3 call made
+# from a pipeline callback stalls the whole crawl until it returns. Work handed to a WorkerPool runs on one of its threads instead, and
+# the Deferred it returns fires back on the reactor thread with the result, where it's safe to touch items and shared state again
+#
+# Once instrumented with the crawl's stats (and metrics, if enabled), every pool counts the tasks it ran, the deepest its queue got, and the
+# seconds its tasks spent waiting for a worker and running on one, as workers/<pool>/tasks, max_queue_depth, wait_seconds and busy_seconds
+import time
+import logging
+import multiprocessing
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from twisted.internet import reactor, threads
+from twisted.internet.defer import Deferred, maybeDeferred
+from twisted.python.failure import Failure
+from twisted.python.threadpool import ThreadPool
+from medscraper.metrics import NULL_METRICS
+
+logger = logging.getLogger(__name__)
+
+# Usage accounting shared by the thread and process pools; only ever touched on the reactor thread
+class PoolUsage:
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max_workers
+        self.stats = None
+        self.metrics = NULL_METRICS
+        # Tasks handed to the pool that haven't finished yet, whether running or still waiting for a worker
+        self.in_flight = 0
+
+    def instrument(self, stats, metrics=NULL_METRICS):
+        self.stats = stats
+        self.metrics = metrics
+
+    def submitted(self):
+        self.in_flight += 1
+        if self.stats is not None:
+            self.stats.max_value(f"workers/{self.name}/max_queue_depth", max(0, self.in_flight - self.max_workers))
+        return time.perf_counter()
+
+    # Record a finished task, given when it was submitted and how long it ran on a worker (None if unknown, counting it all as running)
+    def finished(self, submitted, busy):
+        self.in_flight -= 1
+        elapsed = time.perf_counter() - submitted
+        busy = elapsed if busy is None else min(busy, elapsed)
+        if self.stats is not None:
+            self.stats.inc_value(f"workers/{self.name}/tasks")
+            self.stats.inc_value(f"workers/{self.name}/busy_seconds", busy)
+            self.stats.inc_value(f"workers/{self.name}/wait_seconds", elapsed - busy)
+        self.metrics.observe("worker_busy_seconds", busy, pool=self.name)
+        self.metrics.observe("worker_wait_seconds", elapsed - busy, pool=self.name)
+
+# Runs on a worker; calls the function, recording how long it ran for in timing. Module-level so process pools can pickle it
+def timed_call(timing, func, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    finally:
+        timing["busy"] = time.perf_counter() - start
+
+# Runs in a worker process; calls the function, returning its result along with how long it ran for
+def timed_process_call(func, *args):
+    timing = {}
+    result = timed_call(timing, func, *args)
+    return result, timing["busy"]
+
+# A pool of no threads runs its work inline on the reactor thread instead, returning an already fired Deferred
+class WorkerPool:
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max(0, max_workers)
+        self.pool = None
+        # Work run inline goes one task at a time, like a pool of one
+        self.usage = PoolUsage(name, max(1, self.max_workers))
+
+    # Count this pool's tasks, queue depth and time spent in the crawl's stats, and in its metrics if enabled
+    def instrument(self, stats, metrics=NULL_METRICS):
+        self.usage.instrument(stats, metrics)
+
+    def start(self):
+        if self.pool is None and self.max_workers:
+            self.pool = ThreadPool(minthreads=0, maxthreads=self.max_workers, name=self.name)
+            self.pool.start()
+            # Make sure the threads are shut down with the reactor, even if the crawl ends without the pool being stopped
+            reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+            logger.info(f"[Workers] Started {self.name} pool with up to {self.max_workers} threads")
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.stop()
+            self.pool = None
+
+    # Run a blocking function on one of the pool's threads, returning a Deferred that fires on the reactor thread with its result;
+    # once every thread is busy, further calls wait in the pool's queue
+    def run(self, func, *args, **kwargs):
+        self.start()
+        submitted = self.usage.submitted()
+        timing = {}
+        if self.pool is None:
+            d = maybeDeferred(timed_call, timing, func, *args, **kwargs)
+        else:
+            d = threads.deferToThreadPool(reactor, self.pool, timed_call, timing, func, *args, **kwargs)
+        return d.addBoth(self.finished, submitted, timing)
+
+    def finished(self, result, submitted, timing):
+        self.usage.finished(submitted, timing.get("busy"))
+        return result
+
+class ProcessWorkerPool:
+    def __init__(self, name, max_workers):
+        self.name = name
+        self.max_workers = max(1, max_workers)
+        self.executor = None
+        self.usage = PoolUsage(name, self.max_workers)
+
+    def instrument(self, stats, metrics=NULL_METRICS):
+        self.usage.instrument(stats, metrics)
+
+    def start(self):
+        if self.executor is None:
+            # Worker processes are started fresh rather than forked, since forking copies the reactor and every running thread's state
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+            reactor.addSystemEventTrigger("during", "shutdown", self.stop)
+            logger.info(f"[Workers] Started {self.name} pool with up to {self.max_workers} processes")
+
+    def stop(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
+
+    # Run a function in one of the pool's processes, returning a Deferred that fires on the reactor thread with its result; the function
+    # and its arguments are pickled over to the process, so it has to be a module-level function
+    def run(self, func, *args):
+        self.start()
+        submitted = self.usage.submitted()
+        d = Deferred()
+        future = self.executor.submit(timed_process_call, func, *args)
+        future.add_done_callback(lambda f: reactor.callFromThread(self.fire, d, f, submitted))
+        return d
+
+    def fire(self, d, future, submitted):
+        if future.cancelled():
+            self.usage.finished(submitted, 0)
+            d.errback(Failure(CancelledError(f"{self.name} pool stopped before the work was done")))
+        elif future.exception() is not None:
+            self.usage.finished(submitted, None)
+            d.errback(Failure(future.exception()))
+        else:
+            result, busy = future.result()
+            self.usage.finished(submitted, busy)
+            d.callback(result)
@@ -0,0 +1,70 @@
+# Shared setup for the test suite, run from the project directory containing scrapy.cfg with: python -m pytest -q
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+# The pipeline's worker pools import the reactor, so scrapy's default one has to be installed before anything imports them
+from scrapy.utils.reactor import install_reactor
+
+install_reactor("twisted.internet.asyncioreactor.AsyncioSelectorReactor")
+
+import boto3
+import pytest
+from moto import mock_aws
+from scrapy import Spider
+from scrapy.settings import Settings
+from scrapy.utils.test import get_crawler
+
+BUCKET = "webscraped-docs-test"
+
+# An s3 bucket held in memory by moto, with the bucket the project's settings point at already created
+@pytest.fixture
+def s3(monkeypatch):
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET)
+        yield client
+
+# The project's settings, with everything it keeps locally (tables, manifests, journal, frontier, crawl state) moved under tmp_path
+@pytest.fixture
+def project_settings(tmp_path):
+    settings = Settings()
+    settings.setmodule("medscraper.settings")
+    doc_data = tmp_path / "doc-data"
+    settings.set("METADATA_LOCAL_DIR", str(doc_data))
+    for name in ("HASH_INDEX", "URL_VALIDATORS", "DOCUMENT_MANIFEST", "TEXT_INDEX"):
+        settings.set(f"{name}_PATH", str(doc_data / f"{name.lower()}.json"))
+    settings.set("METADATA_JOURNAL_DIR", str(doc_data / "journal"))
+    settings.set("DOCUMENT_FRONTIER_PATH", str(doc_data / "document_frontier.jsonl"))
+    settings.set("CRAWLSTATE_PATH", "")
+    settings.set("METRICS_EXPORT_PATH", str(doc_data / "metrics.prom"))
+    return settings
+
+# Helper function, building the pipeline the way a crawl with the given settings does
+def crawl_pipeline(settings, **overrides):
+    from medscraper.pipelines import MedscraperPipeline
+    settings = settings.copy()
+    settings.update(overrides)
+    return MedscraperPipeline.from_crawler(get_crawler(Spider, settings.copy_to_dict()))
+
+# Helper function, building the pipeline with its worker pools running inline and opening it, so everything it hands to a pool is done by
+# the time the call returns; the manifests and master table are loaded (and any journal replayed) before this returns too. The flush timer
+# is only scheduled, since the reactor isn't running, so tables are written when a test flushes them or recovery does
+def open_pipeline(settings, **overrides):
+    from medscraper.workers import WorkerPool
+    overrides = {"S3_WORKER_THREADS": 0, "HASH_WORKER_THREADS": 0, "METADATA_FLUSH_INTERVAL": 3600, **overrides}
+    pipeline = crawl_pipeline(settings, **overrides)
+    pipeline.metadata_writer = WorkerPool("metadata-writer", 0)
+    pipeline.open_spider(Spider.from_crawler(pipeline.crawler, name="manuals"))
+    return pipeline
+
+# Helper function, the result a Deferred has already fired with, raising its failure if it failed
+def result_of(d):
+    results = []
+    d.addBoth(results.append)
+    assert results, "the Deferred hasn't fired"
+    if hasattr(results[0], "raiseException"):
+        results[0].raiseException()
+    return results[0]
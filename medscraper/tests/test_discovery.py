@@ -0,0 +1,87 @@
+# Tests for sitemap discovery: reading sitemap indexes and the sitemaps they list as they're parsed, and skipping gzipped sitemaps that
+# decompress past the download size limit instead of decompressing them whole
+import gzip
+import pytest
+from scrapy import Request
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from medscraper.discovery import iter_sitemap
+from medscraper.spiders.manual_spider import ManualSpider
+
+SITE = "https://ahca.myflorida.com"
+SITEMAP_INDEX = f"""<?xml version="1.0" encoding="UTF-8"?>
+<sitemapindex xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">
+  <sitemap><loc>{SITE}/sitemap-rules.xml.gz</loc><lastmod>2025-04-01</lastmod></sitemap>
+  <!-- Sitemaps are listed one per entry -->
+  <sitemap><loc> {SITE}/sitemap-news.xml </loc></sitemap>
+</sitemapindex>""".encode()
+SITEMAP = f"""<?xml version="1.0" encoding="UTF-8"?>
+<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9" xmlns:image="http://www.google.com/schemas/sitemap-image/1.1">
+  <url><loc>{SITE}/medicaid/rules/provider-manuals</loc><lastmod>2025-03-15</lastmod><image:image><image:loc>{SITE}/logo.png</image:loc></image:image></url>
+  <url><loc>{SITE}/medicaid/rules/docs/manual.pdf</loc><lastmod></lastmod></url>
+  <url><lastmod>2025-03-15</lastmod></url>
+  <url><loc>{SITE}/about-us</loc></url>
+</urlset>""".encode()
+
+@pytest.fixture
+def spider():
+    crawler = get_crawler(ManualSpider, {"CRAWLSTATE_PATH": ""})
+    return ManualSpider.from_crawler(crawler)
+
+# Helper function, a response for a sitemap fetched for Florida's discovery; the root one is the state's configured sitemap
+def sitemap_response(url, body, root=False, **meta):
+    meta = {"discovery_state": "Florida", **({"discovery_root": True} if root else {}), **meta}
+    return Response(url, body=body, request=Request(url, meta=meta))
+
+def test_sitemap_index_lists_its_sitemaps():
+    assert list(iter_sitemap(SITEMAP_INDEX)) == [
+        ("sitemap", f"{SITE}/sitemap-rules.xml.gz", "2025-04-01"),
+        ("sitemap", f"{SITE}/sitemap-news.xml", None),
+    ]
+
+def test_sitemap_lists_its_pages_and_documents():
+    # Entries without a loc are skipped, and nested elements from other namespaces aren't taken for entries
+    assert list(iter_sitemap(SITEMAP)) == [
+        ("url", f"{SITE}/medicaid/rules/provider-manuals", "2025-03-15"),
+        ("url", f"{SITE}/medicaid/rules/docs/manual.pdf", None),
+        ("url", f"{SITE}/about-us", None),
+    ]
+
+def test_sitemap_without_a_namespace_is_read():
+    body = b"<urlset><url><loc>https://www.tn.gov/tenncare/policy.html</loc></url></urlset>"
+    assert list(iter_sitemap(body)) == [("url", "https://www.tn.gov/tenncare/policy.html", None)]
+
+def test_sitemap_index_requests_the_sitemaps_it_lists(spider):
+    requests = list(spider.parse_sitemap(sitemap_response(f"{SITE}/sitemap.xml", SITEMAP_INDEX, root=True)))
+
+    assert [request.url for request in requests] == [f"{SITE}/sitemap-rules.xml.gz", f"{SITE}/sitemap-news.xml"]
+    assert all(request.callback == spider.parse_sitemap for request in requests)
+    assert all(request.meta["discovery_state"] == "Florida" for request in requests)
+    assert spider.crawler.stats.get_value("discovery/fallback") is None
+
+def test_gzipped_sitemap_is_read_once_decompressed(spider):
+    response = sitemap_response(f"{SITE}/sitemap-rules.xml.gz", gzip.compress(SITEMAP))
+
+    assert spider.sitemap_body(response) == SITEMAP
+    results = list(spider.parse_sitemap(response))
+    requests = [result for result in results if isinstance(result, Request)]
+    packages = [result for result in results if not isinstance(result, Request)]
+
+    # Only the in-scope page is fetched, and the document goes straight into the sitemap's package
+    assert [request.url for request in requests] == [f"{SITE}/medicaid/rules/provider-manuals"]
+    assert len(packages) == 1 and packages[0].file_urls == [f"{SITE}/medicaid/rules/docs/manual.pdf"]
+
+def test_sitemap_decompressing_past_the_size_limit_is_skipped(spider):
+    response = sitemap_response(f"{SITE}/sitemap-rules.xml.gz", gzip.compress(SITEMAP), download_maxsize=len(SITEMAP) // 2)
+
+    assert spider.sitemap_body(response) is None
+    assert spider.crawler.stats.get_value("discovery/sitemap/too_large") == 1
+
+def test_oversized_root_sitemap_falls_back_to_the_start_urls(spider):
+    response = sitemap_response(f"{SITE}/sitemap.xml.gz", gzip.compress(SITEMAP_INDEX), root=True, download_maxsize=64)
+
+    requests = list(spider.parse_sitemap(response))
+
+    assert [request.url for request in requests] == spider.start_urls_by_state["Florida"]
+    assert spider.crawler.stats.get_value("discovery/sitemap/too_large") == 1
+    assert spider.crawler.stats.get_value("discovery/fallback") == 1
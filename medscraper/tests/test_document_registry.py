@@ -0,0 +1,68 @@
+# Tests for the document registry: every document is fetched once per crawl, however many packages link to it (by any spelling of its
+# url), and the packages after the first get the outcome of that fetch
+import pytest
+from twisted.python.failure import Failure
+from medscraper.lanes import DocumentRegistry
+
+MANUAL = "https://ahca.myflorida.com/medicaid/rules/docs/manual.pdf?ver=3&lang=en"
+# The same document, linked with its query arguments in another order and a fragment
+SAME_MANUAL = "https://ahca.myflorida.com/medicaid/rules/docs/manual.pdf?lang=en&ver=3#page=2"
+RESULT = {"url": MANUAL, "path": "objects/abc", "checksum": "abc", "status": "downloaded"}
+
+# Helper function, collecting what a Deferred fires with, successes and failures alike
+def outcomes(d):
+    fired = []
+    d.addBoth(fired.append)
+    return fired
+
+def test_first_claim_fetches_the_document():
+    registry = DocumentRegistry()
+
+    assert registry.claim(MANUAL) is None
+    assert len(registry) == 1
+
+def test_claims_of_the_same_canonical_url_wait_for_the_first_fetch():
+    registry = DocumentRegistry()
+    registry.claim(MANUAL)
+    waiting = [outcomes(registry.claim(SAME_MANUAL)), outcomes(registry.claim(MANUAL))]
+    assert waiting == [[], []]
+
+    registry.resolve(SAME_MANUAL, RESULT)
+
+    assert waiting == [[RESULT], [RESULT]]
+    assert len(registry) == 1
+
+def test_claims_after_the_fetch_get_its_outcome_straight_away():
+    registry = DocumentRegistry()
+    registry.claim(MANUAL)
+    registry.resolve(MANUAL, RESULT)
+
+    assert outcomes(registry.claim(SAME_MANUAL)) == [RESULT]
+
+def test_failed_fetch_fails_every_claim_on_it():
+    registry = DocumentRegistry()
+    registry.claim(MANUAL)
+    waiting = outcomes(registry.claim(SAME_MANUAL))
+
+    registry.resolve(MANUAL, Failure(ConnectionError("connection lost")))
+    later = outcomes(registry.claim(MANUAL))
+
+    for fired in (waiting, later):
+        assert len(fired) == 1 and fired[0].check(ConnectionError)
+        fired[0].trap(ConnectionError)
+
+def test_only_the_first_outcome_counts():
+    registry = DocumentRegistry()
+    registry.claim(MANUAL)
+    registry.resolve(MANUAL, RESULT)
+    registry.resolve(SAME_MANUAL, {**RESULT, "checksum": "other"})
+
+    assert outcomes(registry.claim(MANUAL)) == [RESULT]
+
+@pytest.mark.parametrize("outcome", [RESULT, None])
+def test_outcomes_for_unclaimed_documents_are_ignored(outcome):
+    registry = DocumentRegistry()
+    registry.resolve(MANUAL, outcome)
+
+    assert len(registry) == 0
+    assert registry.claim(MANUAL) is None
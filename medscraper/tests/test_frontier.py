@@ -0,0 +1,81 @@
+# Tests for the spider-side crawl frontier: which links found on a page get scheduled as new pages, under each state's depth and page
+# budgets, and carrying what was scheduled over a paused crawl
+import pickle
+import pytest
+from scrapy import Spider
+from scrapy.utils.test import get_crawler
+from medscraper.urls import Frontier, UrlClassifier
+
+FLORIDA = "https://ahca.myflorida.com/medicaid/rules"
+ALABAMA = "https://medicaid.alabama.gov/content"
+
+@pytest.fixture
+def stats():
+    return get_crawler(Spider).stats
+
+def frontier(stats=None, **limits):
+    classifier = UrlClassifier([FLORIDA, ALABAMA], {FLORIDA: "Florida", ALABAMA: "Alabama"})
+    return Frontier(classifier, stats=stats, **limits)
+
+def test_admits_each_page_once_in_canonical_form(stats):
+    pages = frontier(stats)
+
+    assert pages.admit(f"{FLORIDA}/index.html?b=2&a=1#top") == f"{FLORIDA}/index.html?a=1&b=2"
+    assert pages.admit(f"{FLORIDA}/index.html?a=1&b=2") is None
+    assert stats.get_value("frontier/duplicates_rejected") == 1
+    assert stats.get_value("frontier/size") == 1
+
+def test_rejects_documents_and_links_out_of_scope(stats):
+    pages = frontier(stats)
+
+    assert pages.admit(f"{FLORIDA}/docs/manual.pdf?ver=3") is None
+    assert pages.admit("https://ahca.myflorida.com/elsewhere.html") is None
+    assert pages.admit("https://example.com/medicaid/rules/page.html") is None
+    assert stats.get_value("frontier/documents_rejected") == 1
+    assert len(pages) == 0
+
+def test_rejects_links_past_the_depth_limit_without_marking_them_seen(stats):
+    pages = frontier(stats, max_depth=2)
+
+    assert pages.admit(f"{FLORIDA}/deep.html", depth=3) is None
+    assert stats.get_value("frontier/depth_rejected") == 1
+    # The same page reached through a shorter path is still scheduled
+    assert pages.admit(f"{FLORIDA}/deep.html", depth=2) == f"{FLORIDA}/deep.html"
+
+def test_state_depth_limit_overrides_the_default():
+    pages = frontier(max_depth=1, state_max_depth={"Alabama": 3})
+
+    assert pages.admit(f"{FLORIDA}/a.html", depth=2) is None
+    assert pages.admit(f"{ALABAMA}/a.html", depth=3) == f"{ALABAMA}/a.html"
+
+def test_rejects_pages_past_each_states_budget(stats):
+    pages = frontier(stats, max_pages=2, state_max_pages={"Alabama": 1})
+    pages.seed(f"{FLORIDA}/index.html")
+
+    assert pages.admit(f"{FLORIDA}/a.html") == f"{FLORIDA}/a.html"
+    assert pages.admit(f"{FLORIDA}/b.html") is None
+    assert pages.admit(f"{ALABAMA}/a.html") == f"{ALABAMA}/a.html"
+    assert pages.admit(f"{ALABAMA}/b.html") is None
+    assert stats.get_value("frontier/budget_rejected") == 2
+
+def test_limits_of_zero_are_unlimited():
+    pages = frontier()
+
+    assert all(pages.admit(f"{FLORIDA}/{i}.html", depth=i) for i in range(50))
+
+def test_restored_snapshot_carries_on_where_the_crawl_paused(stats):
+    paused = frontier(max_pages=3)
+    paused.seed(f"{FLORIDA}/index.html")
+    paused.admit(f"{FLORIDA}/a.html")
+    # Kept in the spider's state, which scrapy pickles into the JOBDIR
+    snapshot = pickle.loads(pickle.dumps(paused.snapshot()))
+
+    resumed = frontier(stats, max_pages=3)
+    resumed.restore(snapshot)
+
+    assert f"{FLORIDA}/a.html" in resumed
+    assert stats.get_value("frontier/size") == 2
+    assert resumed.admit(f"{FLORIDA}/a.html") is None
+    # The state's budget counts the pages scheduled before the pause
+    assert resumed.admit(f"{FLORIDA}/b.html") == f"{FLORIDA}/b.html"
+    assert resumed.admit(f"{FLORIDA}/c.html") is None
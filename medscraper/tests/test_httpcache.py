@@ -0,0 +1,103 @@
+# Tests for the content-addressed HTTP cache: responses are replayed as they were stored, the least recently used ones are evicted once the
+# cache is over its size limit, and 304 Not Modified responses never replace the full response cached for a request
+import os
+import itertools
+import pytest
+from scrapy import Request, Spider
+from scrapy.http import Response
+from scrapy.utils.test import get_crawler
+from medscraper import httpcache
+from medscraper.httpcache import ContentCacheStorage
+
+SITE = "https://ahca.myflorida.com/medicaid/rules"
+PAGE = b"<html><body>" + b"<a href='docs/manual.pdf'>Provider manual</a>" * 20 + b"</body></html>"
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Every store and retrieve happens a second after the last one, so the least recently used response is always clear
+    ticks = itertools.count(1_700_000_000)
+    monkeypatch.setattr(httpcache.time, "time", lambda: next(ticks))
+
+# Helper function, opening a cache in tmp_path for a spider, with any settings overridden
+def open_cache(tmp_path, **overrides):
+    settings = {"HTTPCACHE_DIR": str(tmp_path / "httpcache"), "HTTPCACHE_EXPIRATION_SECS": 0, **overrides}
+    spider = Spider.from_crawler(get_crawler(Spider, settings), name="manuals")
+    storage = ContentCacheStorage(spider.settings)
+    storage.open_spider(spider)
+    return storage, spider
+
+def document(name, body, status=200):
+    url = f"{SITE}/docs/{name}.pdf"
+    return Request(url), Response(url, status=status, headers={"Content-Type": "application/pdf"}, body=body)
+
+def page(name, body=PAGE, status=200):
+    url = f"{SITE}/{name}"
+    return Request(url), Response(url, status=status, headers={"Content-Type": "text/html; charset=utf-8"}, body=body)
+
+# Helper function, the files holding the cache's bodies
+def body_files(storage):
+    return sorted(name for _, _, names in os.walk(os.path.join(storage.cachedir, "objects")) for name in names)
+
+def test_stored_responses_are_replayed(tmp_path):
+    storage, spider = open_cache(tmp_path)
+    for request, response in [page("general-policies"), document("manual", b"%PDF-1.7 manual")]:
+        storage.store_response(spider, request, response)
+        cached = storage.retrieve_response(spider, request)
+        assert (cached.url, cached.status, cached.body) == (response.url, 200, response.body)
+        assert cached.headers.get(b"Content-Type") == response.headers.get(b"Content-Type")
+
+    # Pages are gzipped on disk, and documents kept as they are
+    assert [name.endswith(".gz") for name in body_files(storage)].count(True) == 1
+    assert storage.retrieve_response(spider, Request(f"{SITE}/docs/missing.pdf")) is None
+
+def test_not_modified_responses_are_not_cached(tmp_path):
+    storage, spider = open_cache(tmp_path)
+    request, response = page("general-policies", body=b"", status=304)
+    storage.store_response(spider, request, response)
+
+    assert storage.retrieve_response(spider, request) is None
+    assert body_files(storage) == []
+
+def test_not_modified_response_keeps_the_full_response_cached(tmp_path):
+    storage, spider = open_cache(tmp_path)
+    request, response = page("general-policies")
+    storage.store_response(spider, request, response)
+    storage.store_response(spider, request.replace(headers={"If-None-Match": '"v1"'}), response.replace(status=304, body=b""))
+
+    cached = storage.retrieve_response(spider, request)
+    assert (cached.status, cached.body) == (200, PAGE)
+
+def test_least_recently_used_responses_are_evicted(tmp_path, clock):
+    storage, spider = open_cache(tmp_path, HTTPCACHE_MAX_SIZE=2500)
+    manuals = {name: document(name, name.encode() * (1000 // len(name))) for name in ["alpha", "bravo", "delta"]}
+    storage.store_response(spider, *manuals["alpha"])
+    storage.store_response(spider, *manuals["bravo"])
+    # Reading alpha back makes bravo the least recently used
+    assert storage.retrieve_response(spider, manuals["alpha"][0]) is not None
+
+    storage.store_response(spider, *manuals["delta"])
+
+    assert storage.retrieve_response(spider, manuals["bravo"][0]) is None
+    assert storage.retrieve_response(spider, manuals["alpha"][0]) is not None
+    assert storage.retrieve_response(spider, manuals["delta"][0]) is not None
+    assert len(body_files(storage)) == 2 and storage.size <= 2500 * httpcache.EVICTION_TARGET
+    assert spider.crawler.stats.get_value("httpcache/evicted") == 1
+
+def test_shared_body_is_stored_once_and_kept_until_unused(tmp_path, clock):
+    storage, spider = open_cache(tmp_path, HTTPCACHE_MAX_SIZE=2500)
+    form = b"%PDF-1.7 form" * 100
+    first, second = document("form", form), document("form-copy", form)
+    notice = document("notice", b"n" * 700)
+    for request, response in [first, notice, second]:
+        storage.store_response(spider, request, response)
+    assert len(body_files(storage)) == 2
+    assert spider.crawler.stats.get_value("httpcache/deduplicated") == 1
+
+    # Pushing the cache over its limit evicts the form's first response, which frees nothing since the second still uses its body, and
+    # then the notice
+    storage.store_response(spider, *document("manual", b"m" * 700))
+
+    assert storage.retrieve_response(spider, first[0]) is None
+    assert storage.retrieve_response(spider, notice[0]) is None
+    assert storage.retrieve_response(spider, second[0]).body == form
+    assert len(body_files(storage)) == 2
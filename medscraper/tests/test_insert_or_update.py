@@ -0,0 +1,148 @@
+# Tests pinning how insert_or_update merges records into the master table, for each of its branches; records are matched on every column
+# but the timestamps, and only the files not already in the table are ever added
+import pandas as pd
+import pytest
+from scrapy.settings import Settings
+from medscraper.metadata import MASTER_TABLE_COLUMNS, MasterTableIndex
+from medscraper.pipelines import MedscraperPipeline
+
+SITE = "https://ahca.myflorida.com/medicaid/rules"
+EARLIER = "01/01/2025 09:00:00 AM"
+LATER = "02/01/2025 09:00:00 AM"
+
+def doc(name):
+    return f"{SITE}/docs/{name}.pdf"
+
+def record(file_urls, state="Florida", site_path=SITE, checked=LATER):
+    return {
+        "file_urls": list(file_urls),
+        "package_state": state,
+        "package_site_path": site_path,
+        "package_file_count": len(file_urls),
+        "package_retrieval_date": checked,
+        "package_last_checked": checked
+    }
+
+# Helper function, a master table holding the given records, as the pipeline keeps it in memory
+def table(*records):
+    return pd.DataFrame([dict(r, package_last_checked=EARLIER, package_retrieval_date=EARLIER) for r in records], columns=MASTER_TABLE_COLUMNS)
+
+@pytest.fixture
+def pipeline(tmp_path):
+    return MedscraperPipeline(str(tmp_path), settings=Settings())
+
+# Helper function, merging the records into the table one after another, then adding the rows the pipeline buffered to it
+def merge(pipeline, df, *records):
+    for r in records:
+        df = pipeline.insert_or_update(df, r)
+    return pipeline.commit_rows(df)
+
+def files(df):
+    return [list(urls) for urls in df["file_urls"]]
+
+def test_all_new_files_are_appended(pipeline):
+    df = merge(pipeline, table(record([doc("a")])), record([doc("b"), doc("c")]))
+
+    assert files(df) == [[doc("a")], [doc("b"), doc("c")]]
+    assert list(df["package_file_count"]) == [1, 2]
+    assert list(df["package_last_checked"]) == [EARLIER, LATER]
+
+def test_new_record_into_empty_table(pipeline):
+    df = merge(pipeline, table(), record([doc("a")]))
+
+    assert files(df) == [[doc("a")]]
+
+def test_exact_match_only_updates_its_timestamp(pipeline):
+    df = merge(pipeline, table(record([doc("a"), doc("b")]), record([doc("c")])), record([doc("a"), doc("b")]))
+
+    assert files(df) == [[doc("a"), doc("b")], [doc("c")]]
+    assert list(df["package_last_checked"]) == [LATER, EARLIER]
+    # The retrieval date is left as it was
+    assert list(df["package_retrieval_date"]) == [EARLIER, EARLIER]
+
+def test_exact_match_without_files_only_updates_its_timestamp(pipeline):
+    df = merge(pipeline, table(record([])), record([]))
+
+    assert len(df) == 1
+    assert list(df["package_last_checked"]) == [LATER]
+
+def test_all_duplicate_files_update_every_row_holding_them(pipeline):
+    # The record's files are spread over two rows, so it matches neither exactly; it adds nothing new, so both rows are marked as checked
+    existing = table(record([doc("a")]), record([doc("b")]), record([doc("c")]))
+    df = merge(pipeline, existing, record([doc("a"), doc("b")]))
+
+    assert files(df) == [[doc("a")], [doc("b")], [doc("c")]]
+    assert list(df["package_last_checked"]) == [LATER, LATER, EARLIER]
+
+def test_all_duplicate_files_from_another_site_path(pipeline):
+    # Found again on another page, the same files still only mark the rows holding them as checked
+    df = merge(pipeline, table(record([doc("a")])), record([doc("a")], site_path=f"{SITE}/other"))
+
+    assert len(df) == 1
+    assert list(df["package_site_path"]) == [SITE]
+    assert list(df["package_last_checked"]) == [LATER]
+
+def test_partly_duplicate_files_append_only_the_new_ones(pipeline):
+    df = merge(pipeline, table(record([doc("a"), doc("b")])), record([doc("d"), doc("a"), doc("c"), doc("b")]))
+
+    # The new files keep the order they were scraped in
+    assert files(df) == [[doc("a"), doc("b")], [doc("d"), doc("c")]]
+    assert list(df["package_file_count"]) == [2, 2]
+    assert list(df["package_last_checked"]) == [EARLIER, LATER]
+
+def test_partly_duplicate_files_matching_a_row_of_the_new_ones(pipeline):
+    # Once the duplicates are taken out, what's left of the record is a row already in the table, which is only marked as checked
+    existing = table(record([doc("a")]), record([doc("b")]))
+    df = merge(pipeline, existing, record([doc("a"), doc("b")]), record([doc("a"), doc("b"), doc("c")]), record([doc("b"), doc("c")]))
+
+    assert files(df) == [[doc("a")], [doc("b")], [doc("c")]]
+    assert list(df["package_last_checked"]) == [LATER, LATER, LATER]
+
+def test_rows_read_back_from_csv_are_updated_in_place(pipeline):
+    # Tables loaded from the bucket hold their file lists as strings, and their rows are updated where they are, without adding any
+    existing = table(record([doc("a")]), record([doc("b")]))
+    existing["file_urls"] = existing["file_urls"].astype(str)
+    rows = len(existing)
+
+    df = merge(pipeline, existing, record([doc("b")]), record([doc("a")], site_path=f"{SITE}/other"))
+
+    assert len(df) == rows
+    assert list(df.index) == [0, 1]
+    assert list(df["file_urls"]) == [str([doc("a")]), str([doc("b")])]
+    assert list(df["package_last_checked"]) == [LATER, LATER]
+
+def test_rows_added_during_the_crawl_are_updated_before_they_are_written(pipeline):
+    # Rows appended by earlier records are still buffered in the index, and are matched and updated the same as the table's own
+    df = table(record([doc("a")]))
+    df = pipeline.insert_or_update(df, record([doc("b")], checked=EARLIER))
+    df = pipeline.insert_or_update(df, record([doc("b")]))
+    df = pipeline.commit_rows(df)
+
+    assert files(df) == [[doc("a")], [doc("b")]]
+    assert list(df["package_last_checked"]) == [EARLIER, LATER]
+
+def test_new_rows_keep_the_order_they_were_scraped_in(pipeline):
+    scraped = [record([doc(f"m{i}")], state=state) for i, state in enumerate(["Florida", "Alabama", "Florida", "Georgia", "Alabama"])]
+    df = merge(pipeline, table(record([doc("a")])), *scraped)
+
+    assert files(df) == [[doc("a")]] + [[doc(f"m{i}")] for i in range(5)]
+    assert list(df["package_state"]) == ["Florida", "Florida", "Alabama", "Florida", "Georgia", "Alabama"]
+    assert list(df.index) == list(range(6))
+
+def test_index_is_rebuilt_for_another_table(pipeline):
+    first = merge(pipeline, table(record([doc("a")])), record([doc("b")]))
+    second = merge(pipeline, table(record([doc("b")])), record([doc("b")]))
+
+    assert files(first) == [[doc("a")], [doc("b")]]
+    assert files(second) == [[doc("b")]]
+    assert list(second["package_last_checked"]) == [LATER]
+
+def test_index_finds_rows_by_file_and_by_values():
+    df = table(record([doc("a"), doc("b")]), record([doc("b")]), record([doc("c")], state="Alabama"))
+    compare_cols = ["file_urls", "package_state", "package_site_path", "package_file_count"]
+    index = MasterTableIndex(df, compare_cols)
+
+    assert index.rows_with_files(((doc("b"),), "Florida", SITE, 1)) == [0, 1]
+    assert index.find(((doc("c"),), "Alabama", SITE, 1)) == [2]
+    assert index.find(((doc("c"),), "Florida", SITE, 1)) == []
+    assert index.is_current(df, compare_cols)
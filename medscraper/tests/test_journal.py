@@ -0,0 +1,157 @@
+# Tests for the write-ahead journal and recovering from it: a crawl that's killed between writes of the tables leaves its journal behind,
+# and the next crawl replays it into the freshly loaded tables and manifests, storing them before any segment is removed
+import os
+import json
+import argparse
+import pytest
+from botocore.exceptions import ClientError
+from conftest import BUCKET, open_pipeline
+from medscraper.journal import CrawlJournal
+from medscraper.metadata import MetadataStore
+from medscraper.commands import crawl_sharded
+
+SITE = "https://ahca.myflorida.com/medicaid/rules"
+HASH_INDEX_KEY = "doc-data/hash_index.json"
+
+def record(name, checked="02/01/2025 09:00:00 AM"):
+    return {
+        "file_urls": [f"{SITE}/docs/{name}.pdf"],
+        "package_retrieval_date": checked,
+        "package_last_checked": checked,
+        "package_site_path": SITE,
+        "package_file_count": 1,
+        "package_state": "Florida"
+    }
+
+# Helper function, leaving a journal behind the way a crawl killed partway does: entries appended to an open segment that's never sealed,
+# the last of them cut short mid-write
+def killed_crawl(directory, records, manifest_changes=()):
+    journal = CrawlJournal(directory)
+    journal.open()
+    for r in records:
+        journal.record(r)
+    for name, value in manifest_changes:
+        journal.manifest_set(HASH_INDEX_KEY, name, value)
+    journal.file.write('{"record": {"file_urls": ["cut sho')
+    journal.close()
+
+def stored_table(s3, settings):
+    return MetadataStore(s3, BUCKET, settings.get("METADATA_LOCAL_DIR")).load("master_table")
+
+def stored_manifest(s3, key):
+    return json.loads(s3.get_object(Bucket=BUCKET, Key=key)["Body"].read())
+
+# Helper function, standing in for MetadataStore.save with a bucket that's refusing writes
+def refuse(self, name, table):
+    raise ClientError({"Error": {"Code": "SlowDown", "Message": "Please reduce your request rate."}}, "PutObject")
+
+def journal_dir(settings):
+    return settings.get("METADATA_JOURNAL_DIR")
+
+def test_replay_reads_every_whole_entry_in_order(tmp_path):
+    killed_crawl(str(tmp_path), [record("a"), record("b")], [("objects/1", "1")])
+    journal = CrawlJournal(str(tmp_path))
+    journal.open()
+
+    entries = list(journal.replay())
+    assert [entry["record"]["file_urls"] for entry in entries[:2]] == [[f"{SITE}/docs/a.pdf"], [f"{SITE}/docs/b.pdf"]]
+    # The entry cut short by the crawl dying is skipped
+    assert entries[2:] == [{"manifest": HASH_INDEX_KEY, "name": "objects/1", "value": "1"}]
+
+def test_leftover_segments_are_kept_until_replayed(tmp_path):
+    killed_crawl(str(tmp_path), [record("a")])
+    journal = CrawlJournal(str(tmp_path))
+    journal.open()
+    leftover = journal.recovered
+
+    # A checkpoint taken before the leftover segments are stored only discards this crawl's own segments
+    journal.discard(journal.seal())
+    assert journal.segments()[:len(leftover)] == leftover
+
+    journal.replayed()
+    journal.discard(journal.seal())
+    assert journal.segments() == [journal.segment]
+
+def test_crawl_recovers_a_killed_crawls_journal(s3, project_settings):
+    killed_crawl(journal_dir(project_settings), [record("a"), record("b")], [("objects/1", "1")])
+
+    pipeline = open_pipeline(project_settings)
+
+    # The records and manifest changes are stored straight away, before anything is crawled
+    assert len(stored_table(s3, project_settings)) == 2
+    assert stored_manifest(s3, HASH_INDEX_KEY) == {"objects/1": "1"}
+    assert pipeline.crawler.stats.get_value("journal/recovered_records") == 2
+    # With everything stored, only the segment the crawl appends to is left
+    assert pipeline.journal.segments() == [pipeline.journal.segment]
+
+def test_replaying_records_already_in_the_table_adds_no_rows(s3, project_settings):
+    killed_crawl(journal_dir(project_settings), [record("a")], [("objects/1", "1")])
+    open_pipeline(project_settings).journal.close()
+    assert len(stored_table(s3, project_settings)) == 1
+
+    # The next crawl died partway through a checkpoint: the tables and manifests were stored, but the segments they cover weren't removed
+    killed_crawl(journal_dir(project_settings), [record("a")], [("objects/1", "1")])
+    open_pipeline(project_settings).journal.close()
+
+    assert len(stored_table(s3, project_settings)) == 1
+    assert stored_manifest(s3, HASH_INDEX_KEY) == {"objects/1": "1"}
+
+def test_recovered_segments_are_kept_if_storing_them_fails(s3, project_settings, monkeypatch):
+    killed_crawl(journal_dir(project_settings), [record("a")])
+    leftover = CrawlJournal(journal_dir(project_settings)).segments()
+
+    monkeypatch.setattr(MetadataStore, "save", refuse)
+    pipeline = open_pipeline(project_settings)
+
+    assert stored_table(s3, project_settings) is None
+    assert pipeline.journal.segments()[:len(leftover)] == leftover
+    # The crawl closes without storing either, and leaves the journal for the next one
+    pipeline.close_spider(None)
+    assert CrawlJournal(journal_dir(project_settings)).segments()[:len(leftover)] == leftover
+
+def test_tables_that_failed_to_store_are_stored_again_at_close(s3, project_settings, monkeypatch):
+    killed_crawl(journal_dir(project_settings), [record("a")])
+    monkeypatch.setattr(MetadataStore, "save", refuse)
+    pipeline = open_pipeline(project_settings)
+    assert stored_table(s3, project_settings) is None
+
+    monkeypatch.undo()
+    pipeline.close_spider(None)
+
+    assert len(stored_table(s3, project_settings)) == 1
+    assert CrawlJournal(journal_dir(project_settings)).segments() == []
+
+@pytest.fixture
+def merge_only(project_settings, monkeypatch):
+    merged = []
+    monkeypatch.setattr(crawl_sharded, "merge_shards", lambda settings, s3_client, shards: merged.append(shards) or True)
+    plan_path = os.path.join(project_settings.get("METADATA_LOCAL_DIR"), "shards", "plan.json")
+    os.makedirs(os.path.dirname(plan_path))
+    with open(plan_path, "w", encoding="utf-8") as f:
+        json.dump({"shard-0": ["Florida"], "shard-1": ["Alabama"]}, f)
+
+    def run():
+        command = crawl_sharded.Command()
+        command.settings = project_settings
+        command.run([], argparse.Namespace(merge_only=True, states=None, shards=2, set=[]))
+        return command
+    run.merged = merged
+    run.plan_path = plan_path
+    return run
+
+def test_shards_with_journal_segments_left_arent_merged(project_settings, merge_only):
+    killed_crawl(os.path.join(os.path.dirname(journal_dir(project_settings)), "shards", "shard-1", "journal"), [record("a")])
+
+    command = merge_only()
+
+    assert command.exitcode == 1
+    assert merge_only.merged == []
+    # The plan is kept, to merge once the shard has been run again
+    assert os.path.exists(merge_only.plan_path)
+
+def test_shards_without_journal_segments_are_merged(project_settings, merge_only):
+    command = merge_only()
+
+    assert not getattr(command, "exitcode", 0)
+    assert merge_only.merged == [[("shard-0", ["Florida"]), ("shard-1", ["Alabama"])]]
+    assert not os.path.exists(merge_only.plan_path)
@@ -0,0 +1,63 @@
+# Tests for documents stored before objects were content-addressed, under policy-docs/full/<file name> and with no hash index or document
+# manifest entry for them: the first content-addressed crawl has to compare them against that object rather than report them as new
+import hashlib
+import pytest
+from scrapy import Request
+from scrapy.http import Response
+from conftest import BUCKET, open_pipeline, result_of
+from medscraper.items import load_package
+
+SITE = "https://ahca.myflorida.com/medicaid/rules"
+URL = f"{SITE}/docs/manual.pdf"
+LEGACY_KEY = "policy-docs/full/manual.pdf"
+STORED = b"%PDF stored by an earlier crawl"
+
+@pytest.fixture
+def pipeline(s3, project_settings):
+    return open_pipeline(project_settings, METADATA_JOURNAL_ENABLED=False)
+
+# Helper function, downloading the document for a package and working out what its contents mean for it
+def fetch(pipeline, body):
+    item = load_package(SITE, "Florida", [URL])
+    response = Response(URL, body=body, status=200)
+    result = result_of(pipeline.media_downloaded(response, Request(URL), pipeline.spiderinfo, item=item))
+    return pipeline.file_stored(result, URL, item)
+
+def test_unchanged_document_stored_under_its_old_name_is_up_to_date(s3, pipeline):
+    s3.put_object(Bucket=BUCKET, Key=LEGACY_KEY, Body=STORED)
+
+    result = fetch(pipeline, STORED)
+
+    assert result["status"] == "uptodate"
+    assert pipeline.hash_index.get(LEGACY_KEY) == hashlib.sha256(STORED).hexdigest()
+
+def test_changed_document_stored_under_its_old_name_is_a_new_version(s3, pipeline):
+    s3.put_object(Bucket=BUCKET, Key=LEGACY_KEY, Body=STORED)
+
+    result = fetch(pipeline, b"%PDF changed since")
+
+    assert result["status"] == "downloaded"
+    assert pipeline.previous_hash(URL, load_package(SITE, "Florida", [URL])) == hashlib.sha256(b"%PDF changed since").hexdigest()
+    assert pipeline.hash_index.get(LEGACY_KEY) == hashlib.sha256(STORED).hexdigest()
+
+def test_old_object_without_a_stored_hash_gets_one(s3, pipeline):
+    s3.put_object(Bucket=BUCKET, Key=LEGACY_KEY, Body=STORED)
+
+    fetch(pipeline, STORED)
+
+    # Hashed from the bucket once, and the hash copied into the object's metadata so it's never read back again
+    assert s3.head_object(Bucket=BUCKET, Key=LEGACY_KEY)["Metadata"]["sha256"] == hashlib.sha256(STORED).hexdigest()
+
+def test_document_never_stored_before_is_new(s3, pipeline):
+    result = fetch(pipeline, STORED)
+
+    assert result["status"] == "downloaded"
+    assert LEGACY_KEY not in pipeline.hash_index
+    # The new object is stored content-addressed
+    assert s3.head_object(Bucket=BUCKET, Key=result["path"])["Metadata"]["sha256"] == result["checksum"]
+
+def test_old_object_is_only_looked_up_once(s3, pipeline):
+    s3.put_object(Bucket=BUCKET, Key=LEGACY_KEY, Body=STORED)
+    fetch(pipeline, STORED)
+
+    assert not pipeline.is_unindexed(URL)
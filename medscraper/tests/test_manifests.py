@@ -0,0 +1,57 @@
+# Tests for loading and saving the manifests: only a manifest that doesn't exist falls back to the seed manifest or the local mirror, and
+# any other error reading it is raised rather than carrying on with fewer entries than the bucket holds
+import json
+import logging
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from conftest import BUCKET
+from medscraper.manifests import Manifest
+
+KEY = "doc-data/hash_index.json"
+SEED_KEY = "doc-data/seed/hash_index.json"
+
+def manifest(s3, tmp_path, seed_key=None):
+    return Manifest(s3, BUCKET, KEY, str(tmp_path / "hash_index.json"), seed_key=seed_key)
+
+def put(s3, key, entries):
+    s3.put_object(Bucket=BUCKET, Key=key, Body=json.dumps(entries))
+
+def test_loads_the_bucket_copy(s3, tmp_path):
+    put(s3, KEY, {"a": "1"})
+    assert manifest(s3, tmp_path).load().entries == {"a": "1"}
+
+def test_missing_manifest_starts_from_its_seed(s3, tmp_path):
+    put(s3, SEED_KEY, {"a": "1"})
+    assert manifest(s3, tmp_path, seed_key=SEED_KEY).load().entries == {"a": "1"}
+
+def test_missing_manifest_falls_back_to_the_local_mirror(s3, tmp_path):
+    (tmp_path / "hash_index.json").write_text(json.dumps({"a": "1"}))
+    loaded = manifest(s3, tmp_path).load()
+
+    assert loaded.entries == {"a": "1"}
+    # Written back to the bucket on the next save
+    assert loaded.dirty
+
+def test_manifest_missing_everywhere_is_empty(s3, tmp_path):
+    assert manifest(s3, tmp_path).load().entries == {}
+
+@pytest.mark.parametrize("code,status", [("AccessDenied", 403), ("SlowDown", 503), ("InternalError", 500)])
+def test_other_errors_are_raised_instead_of_falling_back(s3, tmp_path, code, status):
+    (tmp_path / "hash_index.json").write_text(json.dumps({"a": "1"}))
+    with Stubber(s3) as stubber:
+        stubber.add_client_error("get_object", service_error_code=code, http_status_code=status)
+        with pytest.raises(ClientError):
+            manifest(s3, tmp_path, seed_key=SEED_KEY).load()
+
+def test_failed_save_is_logged_and_kept_for_the_next_one(s3, tmp_path, caplog):
+    saved = manifest(s3, tmp_path)
+    saved.set("a", "1")
+    with Stubber(s3) as stubber, caplog.at_level(logging.WARNING, logger="medscraper.manifests"):
+        stubber.add_client_error("put_object", service_error_code="SlowDown", http_status_code=503)
+        assert not saved.save()
+
+    assert "Failed to save" in caplog.text
+    assert saved.dirty
+    # The local mirror is written either way
+    assert json.loads((tmp_path / "hash_index.json").read_text()) == {"a": "1"}
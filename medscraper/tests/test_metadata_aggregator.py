@@ -0,0 +1,30 @@
+# Tests for when the metadata aggregator writes the master table back out
+from medscraper.metadata import MetadataAggregator
+
+# Helper function, an aggregator over a plain list, recording every write it makes
+def aggregator(writes, **kwargs):
+    return MetadataAggregator(lambda: [], lambda table, record: table + [record], lambda table: writes.append(list(table)), **kwargs)
+
+def test_writes_once_enough_records_come_in():
+    writes = []
+    metadata = aggregator(writes, flush_interval=60, flush_items=2)
+    metadata.add("a")
+    assert writes == []
+    metadata.add("b")
+    assert writes == [["a", "b"]]
+
+def test_writes_waiting_records_once_the_interval_passes_without_new_ones():
+    writes = []
+    metadata = aggregator(writes, flush_interval=60, flush_items=100)
+    metadata.add("a")
+    metadata.flush_if_due()
+    assert writes == []
+
+    metadata.last_flush -= 61
+    metadata.flush_if_due()
+    assert writes == [["a"]]
+
+    # Nothing new to write the next time the interval passes
+    metadata.last_flush -= 61
+    metadata.flush_if_due()
+    assert writes == [["a"]]
@@ -0,0 +1,59 @@
+# Tests for reading the metadata tables back from the s3 bucket: only a table that doesn't exist yet loads as None, and any other error is
+# raised, so a crawl never starts from an empty table and writes it over the real one
+import pandas as pd
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+from conftest import BUCKET
+from medscraper.metadata import MASTER_TABLE_COLUMNS, MetadataStore
+
+SITE = "https://ahca.myflorida.com/medicaid/rules"
+
+def table(*states):
+    return pd.DataFrame([{
+        "file_urls": [f"{SITE}/docs/{i}.pdf"],
+        "package_state": state,
+        "package_site_path": SITE,
+        "package_file_count": 1,
+        "package_retrieval_date": "01/01/2025 09:00:00 AM",
+        "package_last_checked": "01/01/2025 09:00:00 AM"
+    } for i, state in enumerate(states)], columns=MASTER_TABLE_COLUMNS)
+
+@pytest.fixture(params=["csv", "parquet", "partitioned"])
+def store(request, s3, tmp_path):
+    table_format = "csv" if request.param == "csv" else "parquet"
+    return MetadataStore(s3, BUCKET, str(tmp_path), table_format=table_format, partition_by_state=request.param == "partitioned")
+
+def test_saved_table_loads_back(store):
+    store.save("master_table", table("Florida", "Alabama", "Florida"))
+
+    loaded = store.load("master_table")
+    assert sorted(loaded["package_state"]) == ["Alabama", "Florida", "Florida"]
+    assert list(loaded.columns) == MASTER_TABLE_COLUMNS
+
+def test_loads_only_the_given_states(store):
+    store.save("master_table", table("Florida", "Alabama", "Florida"))
+
+    assert list(store.load("master_table", states=["Alabama"])["package_state"]) == ["Alabama"]
+
+def test_missing_table_loads_as_none(store):
+    assert store.load("master_table") is None
+
+@pytest.mark.parametrize("code,status", [("AccessDenied", 403), ("SlowDown", 503)])
+def test_other_errors_are_raised(s3, tmp_path, code, status):
+    store = MetadataStore(s3, BUCKET, str(tmp_path))
+    with Stubber(s3) as stubber:
+        stubber.add_client_error("get_object", service_error_code=code, http_status_code=status)
+        with pytest.raises(ClientError):
+            store.load("master_table")
+
+def test_partition_that_cant_be_read_fails_the_whole_load(s3, tmp_path):
+    store = MetadataStore(s3, BUCKET, str(tmp_path), table_format="parquet", partition_by_state=True)
+    store.save("master_table", table("Florida", "Alabama"))
+    listing = s3.list_objects_v2(Bucket=BUCKET, Prefix="doc-data/master_table/")
+
+    with Stubber(s3) as stubber:
+        stubber.add_response("list_objects_v2", {"Contents": listing["Contents"], "IsTruncated": False})
+        stubber.add_client_error("get_object", service_error_code="SlowDown", http_status_code=503)
+        with pytest.raises(ClientError):
+            store.load("master_table")
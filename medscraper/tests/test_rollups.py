@@ -0,0 +1,87 @@
+# Tests for the rollups kept up to date row by row instead of grouping the whole master table on every write; after any mix of rebuilds
+# and added rows they have to come out the same as build_rollups over the full table
+import pandas as pd
+from medscraper.metadata import MASTER_TABLE_COLUMNS, RollupCounters, build_rollups
+
+FLORIDA = "https://ahca.myflorida.com/medicaid/rules"
+FLORIDA_POLICIES = "https://ahca.myflorida.com/medicaid/policies"
+TENNESSEE = "https://www.tn.gov/tenncare/policy"
+
+def record(state, site_path, file_count):
+    return {"package_state": state, "package_site_path": site_path, "package_file_count": file_count}
+
+# Rows spread over states and site paths, including the missing values groupby leaves out
+RECORDS = [
+    record("Florida", FLORIDA, 3),
+    record("Tennessee", TENNESSEE, 2),
+    record("Florida", FLORIDA_POLICIES, 1),
+    record("Florida", FLORIDA, 4),
+    record("Tennessee", None, 5),
+    record(None, TENNESSEE, 7),
+    record("Tennessee", TENNESSEE, float("nan")),
+]
+
+# Helper function, building a master table from records the way the pipeline stores them
+def master_table(records):
+    return pd.DataFrame.from_records(records, columns=MASTER_TABLE_COLUMNS)
+
+# Helper function, checking two sets of rollup tables hold the same groups and totals
+def assert_same_rollups(rollups, expected):
+    for table, expected_table in zip(rollups, expected):
+        assert table.index.equals(expected_table.index)
+        assert table['package_file_count'].astype(float).tolist() == expected_table['package_file_count'].astype(float).tolist()
+
+def test_rebuild_matches_a_full_recompute():
+    table = master_table(RECORDS)
+    rollups = RollupCounters()
+    rollups.rebuild(table)
+
+    assert_same_rollups(rollups.tables(), build_rollups(table))
+    assert rollups.verify(table) is None
+
+def test_added_rows_keep_the_rollups_matching_a_full_recompute():
+    rollups = RollupCounters()
+    rollups.rebuild(master_table(RECORDS[:2]))
+    for i in range(2, len(RECORDS)):
+        rollups.add(RECORDS[i])
+        table = master_table(RECORDS[:i + 1])
+        assert_same_rollups(rollups.tables(), build_rollups(table))
+        assert rollups.verify(table) is None
+
+def test_rows_added_before_the_first_rebuild_are_counted_once():
+    rollups = RollupCounters()
+    for row in RECORDS:
+        rollups.add(row)
+    table = master_table(RECORDS)
+    rollups.rebuild(table)
+
+    assert rollups.verify(table) is None
+
+def test_rebuild_replaces_the_running_totals():
+    rollups = RollupCounters()
+    rollups.rebuild(master_table(RECORDS))
+    table = master_table(RECORDS[:1])
+    rollups.rebuild(table)
+
+    assert_same_rollups(rollups.tables(), build_rollups(table))
+
+def test_mismatch_returns_the_recomputed_tables():
+    table = master_table(RECORDS)
+    rollups = RollupCounters()
+    rollups.rebuild(table)
+    # A row that never made it into the master table
+    rollups.add(record("Florida", FLORIDA, 10))
+
+    mismatch = rollups.verify(table)
+
+    assert mismatch is not None
+    assert_same_rollups(mismatch, build_rollups(table))
+
+def test_mismatch_on_a_missing_group_is_caught():
+    table = master_table(RECORDS)
+    rollups = RollupCounters()
+    rollups.rebuild(table)
+    # A new site path with nothing in it changes the groups but none of the totals
+    rollups.add(record("Florida", f"{FLORIDA}/archive", 0))
+
+    assert rollups.verify(table) is not None
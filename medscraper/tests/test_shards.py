@@ -0,0 +1,141 @@
+# Tests for sharded crawls: a shard picking its own tables back up when it's run again, and merging the shards' tables back into the
+# shared ones
+import os
+import re
+import json
+import pandas as pd
+import pytest
+from botocore.exceptions import ClientError
+from conftest import BUCKET, crawl_pipeline
+from medscraper.manifests import Manifest
+from medscraper.metadata import MASTER_TABLE_COLUMNS, MetadataStore
+from medscraper.shards import merge_master_tables, merge_shards, shard_path
+
+SITE = "https://ahca.myflorida.com/medicaid/rules"
+EARLIER = "01/01/2025 09:00:00 AM"
+LATER = "02/01/2025 09:00:00 AM"
+
+def row(state, name, checked=EARLIER):
+    return {
+        "file_urls": [f"{SITE}/docs/{name}.pdf"],
+        "package_state": state,
+        "package_site_path": SITE,
+        "package_file_count": 1,
+        "package_retrieval_date": checked,
+        "package_last_checked": checked
+    }
+
+def table(*rows):
+    return pd.DataFrame(list(rows), columns=MASTER_TABLE_COLUMNS)
+
+# Helper function, the documents in each row of a table, by name; tables read back from CSV hold their file urls as strings
+def names(df):
+    return [",".join(re.findall(r"/docs/(\w+)\.pdf", str(urls))) for urls in df["file_urls"]]
+
+def shared_store(s3, settings):
+    return MetadataStore(s3, settings.get("S3_BUCKET"), settings.get("METADATA_LOCAL_DIR"))
+
+def test_shard_starts_from_its_states_rows_in_the_shared_table(s3, project_settings):
+    shared_store(s3, project_settings).save("master_table", table(row("Florida", "a"), row("Alabama", "b")))
+    pipeline = crawl_pipeline(project_settings, SHARD_NAME="shard-0", CRAWL_STATES="Florida")
+
+    assert names(pipeline.fetch_doc_data("master_table")) == ["a"]
+
+def test_shard_run_again_after_a_checkpoint_keeps_the_rows_it_wrote(s3, project_settings):
+    shared_store(s3, project_settings).save("master_table", table(row("Florida", "a"), row("Alabama", "b")))
+
+    # The first run checkpoints a new row into the shard's copy of the table (discarding its journal), then dies or is paused
+    first = crawl_pipeline(project_settings, SHARD_NAME="shard-0", CRAWL_STATES="Florida")
+    assert first.save_tables([("master_table", table(row("Florida", "a"), row("Florida", "c")))])
+
+    # Run again, the shard picks up its own copy rather than starting over from the shared table
+    resumed = crawl_pipeline(project_settings, SHARD_NAME="shard-0", CRAWL_STATES="Florida")
+    assert names(resumed.fetch_doc_data("master_table")) == ["a", "c"]
+    # The shared table is left as it was until the shards are merged
+    assert names(shared_store(s3, project_settings).load("master_table")) == ["a", "b"]
+
+# Helper function, a shard's folder of tables in the s3 bucket and the local doc-data folder
+def shard_store(s3, settings, shard):
+    return MetadataStore(s3, settings.get("S3_BUCKET"), os.path.join(settings.get("METADATA_LOCAL_DIR"), "shards", shard),
+                         prefix=f"doc-data/shards/{shard}")
+
+def shard_keys(s3, shard):
+    return [obj["Key"] for obj in s3.list_objects_v2(Bucket=BUCKET, Prefix=f"doc-data/shards/{shard}/").get("Contents", [])]
+
+def test_merging_disjoint_states_appends_them_shard_by_shard():
+    merged = merge_master_tables(None, [(["Florida"], table(row("Florida", "a"), row("Florida", "b"))), (["Alabama"], table(row("Alabama", "c")))])
+
+    assert names(merged) == ["a", "b", "c"]
+
+def test_merged_states_keep_their_rows_in_place_with_new_rows_after_them():
+    shared = table(row("Florida", "a"), row("Alabama", "b"), row("Florida", "c"), row("Georgia", "g"))
+    # Each shard's copy starts with its states' rows from the shared table, in their original order, and adds its new rows after them
+    florida = table(row("Florida", "a", checked=LATER), row("Florida", "c"), row("Florida", "d"))
+    alabama = table(row("Alabama", "b", checked=LATER), row("Alabama", "e"))
+
+    merged = merge_master_tables(shared, [(["Florida"], florida), (["Alabama"], alabama)])
+
+    assert names(merged) == ["a", "b", "c", "g", "d", "e"]
+    assert list(merged["package_last_checked"]) == [LATER, LATER, EARLIER, EARLIER, EARLIER, EARLIER]
+
+def test_shard_without_a_table_keeps_its_states_shared_rows():
+    shared = table(row("Florida", "a"), row("Alabama", "b"))
+
+    merged = merge_master_tables(shared, [(["Florida"], None), (["Alabama"], table(row("Alabama", "b"), row("Alabama", "c")))])
+
+    assert names(merged) == ["a", "b", "c"]
+
+def test_merged_table_keeps_the_shared_columns_and_a_fresh_index():
+    shared = table(row("Florida", "a"), row("Alabama", "b"))
+    # A shard's table read back in another column order, with an index of its own
+    florida = table(row("Florida", "a"), row("Florida", "c"))[list(reversed(MASTER_TABLE_COLUMNS))]
+    florida.index = [10, 11]
+
+    merged = merge_master_tables(shared, [(["Florida"], florida)])
+
+    assert list(merged.columns) == MASTER_TABLE_COLUMNS
+    assert list(merged.index) == [0, 1, 2]
+    assert names(merged) == ["a", "b", "c"]
+
+def test_shard_table_shorter_than_its_shared_rows_is_refused():
+    with pytest.raises(ValueError):
+        merge_master_tables(table(row("Florida", "a"), row("Florida", "b")), [(["Florida"], table(row("Florida", "a")))])
+
+SHARDS = [("shard-0", ["Florida"]), ("shard-1", ["Alabama"])]
+
+@pytest.fixture
+def crawled_shards(s3, project_settings):
+    shared_store(s3, project_settings).save("master_table", table(row("Florida", "a"), row("Alabama", "b")))
+    shard_store(s3, project_settings, "shard-0").save("master_table", table(row("Florida", "a"), row("Florida", "c")))
+    shard_store(s3, project_settings, "shard-1").save("master_table", table(row("Alabama", "b"), row("Alabama", "d")))
+    hash_index = Manifest(s3, BUCKET, "doc-data/shards/shard-0/hash_index.json", shard_path(project_settings.get("HASH_INDEX_PATH"), "shard-0"))
+    hash_index.set("objects/c", "c")
+    assert hash_index.save()
+
+def test_merge_stores_the_shards_and_removes_them(s3, project_settings, crawled_shards):
+    assert merge_shards(project_settings, s3, SHARDS)
+
+    assert names(shared_store(s3, project_settings).load("master_table")) == ["a", "b", "c", "d"]
+    assert json.loads(s3.get_object(Bucket=BUCKET, Key="doc-data/hash_index.json")["Body"].read()) == {"objects/c": "c"}
+    # The rollups are rebuilt from the merged master table
+    assert shared_store(s3, project_settings).load("state_table") is not None
+    assert shard_keys(s3, "shard-0") == shard_keys(s3, "shard-1") == []
+    assert not os.path.exists(os.path.join(project_settings.get("METADATA_LOCAL_DIR"), "shards", "shard-0"))
+
+def test_shards_are_kept_when_the_merged_tables_cant_be_stored(s3, project_settings, crawled_shards, monkeypatch):
+    def refuse(self, name, table):
+        raise ClientError({"Error": {"Code": "SlowDown", "Message": "Please reduce your request rate."}}, "PutObject")
+    monkeypatch.setattr(MetadataStore, "save", refuse)
+
+    assert not merge_shards(project_settings, s3, SHARDS)
+
+    assert names(shared_store(s3, project_settings).load("master_table")) == ["a", "b"]
+    assert shard_keys(s3, "shard-0") and shard_keys(s3, "shard-1")
+
+def test_shards_are_kept_when_a_merged_manifest_cant_be_stored(s3, project_settings, crawled_shards, monkeypatch):
+    monkeypatch.setattr(Manifest, "write", lambda self, entries: False)
+
+    assert not merge_shards(project_settings, s3, SHARDS)
+
+    assert "doc-data/shards/shard-0/hash_index.json" in shard_keys(s3, "shard-0")
+    assert os.path.exists(os.path.join(project_settings.get("METADATA_LOCAL_DIR"), "shards", "shard-0"))